@@ -1,23 +1,27 @@
 """ Aviatrix Controller HA Lambda script """
 
+import abc
 import time
 import os
+import contextlib
+import concurrent.futures
 import uuid
 import json
+import base64
+import hashlib
+import logging
+import random
+import re
+import socket
+import ssl
+import sys
 import threading
-import urllib.request
-import urllib.error
 import urllib.parse
-from urllib.error import HTTPError
-from urllib.request import build_opener, HTTPHandler, Request
-import traceback
-import urllib3
-from urllib3.exceptions import InsecureRequestWarning
-import requests
 import boto3
 import botocore
+import botocore.waiter
+import transport
 import version
-urllib3.disable_warnings(InsecureRequestWarning)
 
 MAX_LOGIN_TIMEOUT = 800
 WAIT_DELAY = 30
@@ -26,26 +30,307 @@ INITIAL_SETUP_WAIT = 180
 INITIAL_SETUP_DELAY = 10
 
 INITIAL_SETUP_API_WAIT = 20
+
+CONTROLLER_PORT = 443
+
+READINESS_PROBE_TIMEOUT = 5
+READINESS_BACKOFF_BASE = 1
+READINESS_BACKOFF_CAP = 10
+
 AMI_ID = 'https://aviatrix-download.s3-us-west-2.amazonaws.com/AMI_ID/ami_id.json'
+# The catalog is kept in memory and in /tmp for warm containers, revalidated with its ETag
+# once older than the TTL. The copy in /tmp is used, however old, when AMI_ID is unreachable
+AMI_CATALOG_TTL = 3600
+AMI_CATALOG_TIMEOUT = 10
+AMI_CATALOG_CACHE = '/tmp/aviatrix_ami_catalog.json'
 MAXIMUM_BACKUP_AGE = 24 * 3600 * 3   # 3 days
 
+# Configuration set by the CFT. The rest of the environment is state written by this script.
+# In fleet mode the configuration of each controller is kept with its state
+CONTROLLER_KEYS = ['AVIATRIX_TAG', 'API_PRIVATE_ACCESS', 'SUBNETLIST', 'S3_BUCKET_BACK',
+                   'NOTIF_EMAIL', 'CUSTOMER_ID', 'WARM_POOL', 'WARM_POOL_ROLE_ARN']
+STATIC_KEYS = CONTROLLER_KEYS + ['STATE_BACKEND', 'STATE_TABLE', 'STATE_BUCKET', 'FLEET_MODE',
+                                  'LOG_LEVEL']
+STATE_KEYS = ['EIP', 'AMI_ID', 'VPC_ID', 'INST_TYPE', 'KEY_NAME', 'CTRL_SUBNET', 'PRIV_IP',
+              'INST_ID', 'S3_BUCKET_REGION', 'TOPIC_ARN', 'IAM_ARN', 'MONITORING', 'DISKS', 'TAGS',
+              'TMP_SG_GRP', 'TMP_SG_EXPIRES', 'WARM_SG_GRP', 'WARM_SG_EXPIRES', 'WARM_INST_ID',
+              'WARM_VERSION', 'FAILOVER_INST_ID', 'FAILOVER_STEP', 'EIP_ALLOC_ID', 'HEALTH_WINDOW']
+STATE_PREFIX = 'aviatrix-ha-state/'
+BACKUP_PREFIX = 'CloudN_'
+BACKUP_CONFIG_SUFFIX = '_save_cloudx_config.enc'
+BACKUP_VERSION_SUFFIX = '_save_cloudx_version.txt'
+BACKUP_INDEX_KEY = STATE_PREFIX + 'backup-index.json'
+# Failovers trust the entry of the controller in the index while it is younger than this, as
+# kept up to date by S3 notifications. Older, they check the backup object itself
+BACKUP_INDEX_TTL = 300
+# Checksum manifest written by the producer of a backup, next to it: JSON with sha256 and
+# optionally size, or the output of sha256sum
+BACKUP_CHECKSUM_SUFFIX = '.sha256'
+INTEGRITY_RANGE_SIZE = 8 * 1024 * 1024
+INTEGRITY_CHUNK_SIZE = 256 * 1024
+STATE_WRITE_RETRIES = 3
+
+# Properties of the Custom::SetupHA resource registering a controller in fleet mode
+FLEET_PROPERTIES = {'AviatrixTag': 'AVIATRIX_TAG', 'SubnetList': 'SUBNETLIST',
+                    'S3BucketBack': 'S3_BUCKET_BACK', 'PrivateAccess': 'API_PRIVATE_ACCESS',
+                    'NotifEmail': 'NOTIF_EMAIL', 'CustomerId': 'CUSTOMER_ID',
+                    'WarmPool': 'WARM_POOL', 'WarmPoolRoleArn': 'WARM_POOL_ROLE_ARN'}
+
+# Checkpoints of an HA event, in order. An invocation handling the same instance resumes
+# after the last one saved
+FAILOVER_STEPS = ['eip_assigned', 'sg_opened', 'initial_setup_started', 'initial_setup_done',
+                  'account_created', 'restore_submitted', 'restore_done']
+# An HA event is handed over to a new invocation when less time than this is left
+CONTINUATION_MARGIN = 60
+MAX_CONTINUATIONS = 3
+
+ASG_NOTIFICATION_TYPES = ['autoscaling:EC2_INSTANCE_LAUNCH',
+                          'autoscaling:EC2_INSTANCE_LAUNCH_ERROR']
+# Polling of an ASG of the same name still being deleted, before creating it
+ASG_PENDING_DELETE_WAIT = 10
+ASG_DELETE_WAIT_ATTEMPTS = 30
+ASG_WAITER_MODEL = {
+    'version': 2,
+    'waiters': {
+        'GroupNotExists': {
+            'operation': 'DescribeAutoScalingGroups',
+            'delay': ASG_PENDING_DELETE_WAIT,
+            'maxAttempts': ASG_DELETE_WAIT_ATTEMPTS,
+            'acceptors': [
+                {'matcher': 'path', 'argument': 'length(AutoScalingGroups) > `0`',
+                 'expected': False, 'state': 'success'},
+                {'matcher': 'path', 'argument': 'length(AutoScalingGroups) > `0`',
+                 'expected': True, 'state': 'retry'}]}}}
+
+# Leases of ASG notifications are given up when the event is done, and otherwise outlive the
+# invocation by this much in case it times out holding them. The launch error lease is kept
+# for the debounce window, launch errors within it of the first one are dropped
+LEASE_MARGIN = 120
+LAUNCH_ERROR_DEBOUNCE = 300
+# Security group and expiry of the temporary 443 rule, per invocation that opened it. A
+# failover and the set up of a standby open the same security group. The rule is reverted
+# when neither relies on it any more, or once the invocation that opened it must be over
+TMP_SG_SLOTS = {'failover': ('TMP_SG_GRP', 'TMP_SG_EXPIRES'),
+                'standby': ('WARM_SG_GRP', 'WARM_SG_EXPIRES')}
+TMP_SG_HOLD = 900 + LEASE_MARGIN
+
+WARM_POOL_HOOK_SUFFIX = '-warm-pool'
+# The lambda completes the hook once initial setup is done. Past the timeout the instance goes
+# to the warm pool anyway and initial setup runs during the failover as without a warm pool
+WARM_POOL_HOOK_TIMEOUT = 900
+METRICS_NAMESPACE = 'AviatrixControllerHA'
+
+# Scheduled health checks probe the API again every HEALTH_PROBE_INTERVAL seconds while it
+# fails. The controller is set Unhealthy once HEALTH_FAILURE_THRESHOLD probes in a row failed.
+# The results of the last HEALTH_WINDOW_SIZE probes are kept in the state. Instances launched
+# less than HEALTH_CHECK_GRACE seconds ago are not probed
+HEALTH_PROBE_INTERVAL = 15
+HEALTH_FAILURE_THRESHOLD = 4
+HEALTH_WINDOW_SIZE = 20
+HEALTH_CHECK_GRACE = 600
+
+# Values of these keys are masked in log records, as key=value, "key": value or 'key': value
+REDACTED_KEYS = ['password', 'pwd', 'CID', 'customer_id', 'AVIATRIX_PASS_BACK',
+                 'AWS_SECRET_KEY_BACK']
+REDACTED = '***'
+_REDACT_PATTERN = re.compile(
+    r"""(['"]?\b(?:%s)['"]?\s*[:=]\s*['"]?)[^'"&,\s}]+""" % "|".join(REDACTED_KEYS),
+    re.IGNORECASE)
+
+
+class LogContext:
+    """ Fields added to every log record: the correlation ID of the event being handled,
+    which continuations of the event keep, and secrets seen during the event, such as
+    controller CIDs, masked wherever they appear"""
+
+    def __init__(self):
+        self.correlation_id = None
+        self.secrets = set()
+
+    def start(self, correlation_id):
+        """ Start logging for a new event"""
+        self.correlation_id = correlation_id
+        self.secrets = set()
+
+    def add_secret(self, value):
+        """ Mask value in the records of the event"""
+        if value:
+            self.secrets.add(str(value))
+
+    def redact(self, text):
+        """ text with secret values masked"""
+        text = _REDACT_PATTERN.sub(r'\1' + REDACTED, text)
+        for secret in self.secrets:
+            text = text.replace(secret, REDACTED)
+        return text
+
+
+LOG_CONTEXT = LogContext()
+
+
+class RedactingFilter(logging.Filter):
+    """ Formats the message and the exception of a record with secrets masked. Only records
+    of an enabled level reach it, so their arguments are formatted lazily"""
+
+    def filter(self, record):
+        try:
+            message = record.getMessage()
+        except (TypeError, ValueError):
+            # Logging must not fail the event over a format string that does not match
+            message = "%s %s" % (record.msg, record.args)
+        record.msg = LOG_CONTEXT.redact(message)
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        if record.exc_text:
+            record.exc_text = LOG_CONTEXT.redact(record.exc_text)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON document per record, with the controller and the correlation ID, so that
+    the records of an event can be found with a CloudWatch Logs Insights query. CloudWatch
+    timestamps every record already"""
+
+    def format(self, record):
+        document = {'level': record.levelname, 'message': record.getMessage(),
+                    'correlation_id': LOG_CONTEXT.correlation_id,
+                    'controller': os.environ.get('AVIATRIX_TAG')}
+        if record.exc_text:
+            document['exception'] = record.exc_text
+        return json.dumps(document)
+
+
+class StdoutHandler(logging.Handler):
+    """ Writes to the current sys.stdout, which the lambda runtime sends to CloudWatch"""
+
+    def emit(self, record):
+        try:
+            sys.stdout.write(self.format(record) + '\n')
+        except Exception:  # pylint: disable=broad-except
+            self.handleError(record)
+
+
+def configure_logger(level=None):
+    """ The logger of the module, at the LOG_LEVEL environment variable, INFO by default"""
+    logger = logging.getLogger('aviatrix_ha')
+    if not logger.handlers:
+        handler = StdoutHandler()
+        handler.addFilter(RedactingFilter())
+        handler.setFormatter(JsonFormatter())
+        logger.addHandler(handler)
+        # The root logger of the lambda runtime would log every record a second time
+        logger.propagate = False
+    level = logging.getLevelName((level or os.environ.get('LOG_LEVEL') or 'INFO').upper())
+    logger.setLevel(level if isinstance(level, int) else logging.INFO)
+    return logger
+
+
+LOGGER = configure_logger()
+
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def aws_client(service, region=None):
+    """ boto3 client for service in region, created once per lambda container and reused
+    by warm invocations and threads"""
+    with _CLIENTS_LOCK:
+        if (service, region) not in _CLIENTS:
+            _CLIENTS[(service, region)] = boto3.client(service, region_name=region)
+        return _CLIENTS[(service, region)]
+
 
 class AvxError(Exception):
     """ Error class for Aviatrix exceptions"""
 
 
-print('Loading function')
+class FailoverTimeline:
+    """ Records the monotonic start and end of each phase of an event. Emitted as CloudWatch
+    Embedded Metric Format (EMF) metrics and one JSON summary record"""
+
+    def __init__(self, event_type):
+        self.event_type = event_type
+        self.controller = os.environ.get('AVIATRIX_TAG', '')
+        self.start = time.monotonic()
+        self.phases = []
+        self.outcome = None
+        self.attributes = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Context manager timing one phase. Phases may be entered more than once"""
+        start = time.monotonic()
+        status = 'error'
+        try:
+            yield
+            status = 'ok'
+        finally:
+            self.record(name, start, time.monotonic(), status)
+
+    def record(self, name, start, end, status='ok'):
+        """ Record a phase measured by the caller"""
+        self.phases.append({'phase': name, 'start': round(start - self.start, 3),
+                            'end': round(end - self.start, 3),
+                            'duration': round(end - start, 3), 'status': status})
+
+    def durations(self):
+        """ Total seconds spent in each phase, in the order the phases were first entered"""
+        totals = {}
+        for entry in self.phases:
+            totals[entry['phase']] = totals.get(entry['phase'], 0) + entry['duration']
+        return totals
+
+    def emit(self):
+        """ Print one EMF document per phase, one for the total and the summary record"""
+        outcome = self.outcome or 'error'
+        total = round(time.monotonic() - self.start, 3)
+        timestamp = int(time.time() * 1000)
+        for name, duration in self.durations().items():
+            print(json.dumps({
+                '_aws': {'Timestamp': timestamp,
+                         'CloudWatchMetrics': [{
+                             'Namespace': METRICS_NAMESPACE,
+                             'Dimensions': [['Controller', 'EventType', 'Phase'], ['Phase']],
+                             'Metrics': [{'Name': 'PhaseDuration', 'Unit': 'Seconds'}]}]},
+                'Controller': self.controller, 'EventType': self.event_type,
+                'Phase': name, 'PhaseDuration': round(duration, 3),
+                'correlation_id': LOG_CONTEXT.correlation_id}))
+        print(json.dumps({
+            '_aws': {'Timestamp': timestamp,
+                     'CloudWatchMetrics': [{
+                         'Namespace': METRICS_NAMESPACE,
+                         'Dimensions': [['Controller', 'EventType', 'Outcome'],
+                                        ['EventType', 'Outcome']],
+                         'Metrics': [{'Name': 'EventDuration', 'Unit': 'Seconds'}]}]},
+            'Controller': self.controller, 'EventType': self.event_type,
+            'Outcome': outcome, 'EventDuration': total,
+            'correlation_id': LOG_CONTEXT.correlation_id}))
+        print(json.dumps(dict({'record': 'ha_timeline', 'controller': self.controller,
+                               'correlation_id': LOG_CONTEXT.correlation_id,
+                               'event_type': self.event_type, 'outcome': outcome,
+                               'duration': total, 'phases': self.phases}, **self.attributes)))
+
+
+LOGGER.info('Loading function')
+
+
+def correlation_id(event, context):
+    """ ID of the records of an event. Continuations of the event keep it"""
+    if isinstance(event, dict) and event.get('CorrelationId'):
+        return event['CorrelationId']
+    return getattr(context, 'aws_request_id', None) or uuid.uuid4().hex
 
 
 def lambda_handler(event, context):
     """ Entry point of the lambda script"""
+    LOG_CONTEXT.start(correlation_id(event, context))
     try:
         _lambda_handler(event, context)
     except AvxError as err:
-        print('Operation failed due to: ' + str(err))
+        LOGGER.error("Operation failed due to: %s", err)
     except Exception as err:    # pylint: disable=broad-except
-        print(str(traceback.format_exc()))
-        print("Lambda function failed due to " + str(err))
+        LOGGER.exception("Lambda function failed due to %s", err)
 
 
 def _lambda_handler(event, context):
@@ -55,22 +340,31 @@ def _lambda_handler(event, context):
          made by Cloud formation template.
         sns_event - Request from sns to attach elastic ip to new instance
          created after controller failover. """
-    # scheduled_event = False
     sns_event = False
-    print("Version: %s Event: %s" % (version.VERSION, event))
+    health_check = health_check_event(event)
+    reset_backup_store()
+    LOGGER.info("Version: %s", version.VERSION)
+    LOGGER.debug("Event: %s", event)
     try:
         cf_request = event["StackId"]
-        print("From CFT")
+        LOGGER.info("From CFT")
     except (KeyError, AttributeError, TypeError):
         cf_request = None
-        print("Not from CFT")
+        LOGGER.info("Not from CFT")
     try:
         sns_event = event["Records"][0]["EventSource"] == "aws:sns"
-        print("From SNS Event")
+        LOGGER.info("From SNS Event")
     except (AttributeError, IndexError, KeyError, TypeError):
         pass
+    if health_check:
+        LOGGER.info("From a scheduled health check")
+    backup_records = s3_event_records(event)
+    if backup_records:
+        LOGGER.info("From S3 Event")
+        handle_backup_notification(backup_records)
+        return
     if os.environ.get("TESTPY") == "True":
-        print("Testing")
+        LOGGER.info("Testing")
         client = boto3.client(
             'ec2', region_name=os.environ["AWS_TEST_REGION"],
             aws_access_key_id=os.environ["AWS_ACCESS_KEY_BACK"],
@@ -80,32 +374,71 @@ def _lambda_handler(event, context):
             aws_access_key_id=os.environ["AWS_ACCESS_KEY_BACK"],
             aws_secret_access_key=os.environ["AWS_SECRET_KEY_BACK"])
     else:
-        client = boto3.client('ec2')
-        lambda_client = boto3.client('lambda')
-
-    tmp_sg = os.environ.get('TMP_SG_GRP', '')
-    if tmp_sg:
-        print("Lambda probably did not complete last time. Reverting sg %s" % tmp_sg)
-        update_env_dict(lambda_client, context, {'TMP_SG_GRP': ''})
-        restore_security_group_access(client, tmp_sg)
+        client = aws_client('ec2')
+        lambda_client = aws_client('lambda')
+
+    config = {}
+    if fleet_mode():
+        try:
+            config = activate_controller(event)
+        except AvxError as err:
+            if not cf_request:
+                raise
+            LOGGER.error("%s", err)
+            send_response(event, context, 'FAILED' if event.get('RequestType') == 'Create'
+                          else 'SUCCESS', str(err))
+            return
+    store = state_store(lambda_client, context)
+    lease_name, lease_ttl = event_lease(event)
+    lease = None
+    if lease_name:
+        # Continuations take over the lease of the invocation they continue
+        lease = store.lease(lease_name, event.get('LeaseOwner') or context.aws_request_id)
+        if not lease.acquire(lease_ttl or
+                             context.get_remaining_time_in_millis() / 1000 + LEASE_MARGIN):
+            LOGGER.info("Event is already being handled. Dropping the duplicate")
+            return
+    store.load()
+    if fleet_mode() and cf_request and event.get('RequestType') == 'Create':
+        # Registers the controller
+        store.update(config)
+    elif fleet_mode() and not cf_request and not os.environ.get('S3_BUCKET_BACK'):
+        raise AvxError("Controller %s is not registered" % os.environ.get('AVIATRIX_TAG'))
+    if health_check:
+        try:
+            check_controller_health(client, store)
+        finally:
+            lease.release()
+        return
+    lifecycle_action = sns_lifecycle_action(event)
+    if lifecycle_action:
+        try:
+            handle_lifecycle_action(client, store, lifecycle_action)
+        finally:
+            lease.release()
+        return
+    revert_stale_security_groups(client, store)
+    instance_name = os.environ.get('AVIATRIX_TAG')
     try:
-        instance_name = os.environ.get('AVIATRIX_TAG')
-        controller_instanceobj = client.describe_instances(
-            Filters=[
-                {'Name': 'instance-state-name', 'Values': ['running']},
-                {'Name': 'tag:Name', 'Values': [instance_name]}]
-        )['Reservations'][0]['Instances'][0]
+        if cf_request and event.get("RequestType") == 'Create':
+            controller_instanceobj = find_controller_instance(client)
+        else:
+            # The launched instance for ASG notifications, the saved controller otherwise
+            instance_id = sns_instance_id(event) or os.environ.get('INST_ID')
+            if not instance_id:
+                raise AvxError("No controller instance ID was saved")
+            controller_instanceobj = find_controller_instance(client, instance_id)
     except Exception as err:
         err_reason = "Can't find Controller instance with name tag %s. %s" % (instance_name,
                                                                               str(err))
-        print(err_reason)
+        LOGGER.error("%s", err_reason)
         if cf_request:
-            print("From CF Request")
+            LOGGER.info("From CF Request")
             if event.get("RequestType", None) == 'Create':
-                print("Create Event")
+                LOGGER.info("Create Event")
                 send_response(event, context, 'FAILED', err_reason)
                 return
-            print("Ignoring delete CFT for no Controller")
+            LOGGER.info("Ignoring delete CFT for no Controller")
             # While deleting cloud formation template, this lambda function
             # will be called to delete AssignEIP resource. If the controller
             # instance is not present, then cloud formation will be stuck
@@ -115,32 +448,38 @@ def _lambda_handler(event, context):
 
         try:
             sns_msg_event = (json.loads(event["Records"][0]["Sns"]["Message"]))['Event']
-            print(sns_msg_event)
+            LOGGER.debug("%s", sns_msg_event)
         except (KeyError, IndexError, ValueError) as err:
             raise AvxError("1.Could not parse SNS message %s" % str(err)) from err
         if not sns_msg_event == "autoscaling:EC2_INSTANCE_LAUNCH_ERROR":
-            print("Not from launch error. Exiting")
+            LOGGER.warning("Not from launch error. Exiting")
+            if lease:
+                lease.release()
             return
-        print("From the instance launch error. Will attempt to re-create Auto scaling group")
+        LOGGER.warning("From the instance launch error. Will attempt to re-create Auto scaling "
+                       "group")
 
     if cf_request:
+        timeline = FailoverTimeline("cft_" + str(event.get("RequestType", "")).lower())
         try:
             response_status, err_reason = handle_cloud_formation_request(
-                client, event, lambda_client, controller_instanceobj, context, instance_name)
+                client, event, store, controller_instanceobj, context, instance_name, timeline)
         except AvxError as err:
             err_reason = str(err)
-            print(err_reason)
+            LOGGER.error("%s", err_reason)
             response_status = 'FAILED'
         except Exception as err:       # pylint: disable=broad-except
             err_reason = str(err)
-            print(traceback.format_exc())
+            LOGGER.exception("CFT request failed")
             response_status = 'FAILED'
 
         # Send response to CFT.
         if response_status not in ['SUCCESS', 'FAILED']:
             response_status = 'FAILED'
         send_response(event, context, response_status, err_reason)
-        print("Sent {} to CFT.".format(response_status))
+        LOGGER.info("Sent %s to CFT.", response_status)
+        timeline.outcome = response_status.lower()
+        timeline.emit()
     elif sns_event:
         try:
             sns_msg_json = json.loads(event["Records"][0]["Sns"]["Message"])
@@ -148,100 +487,348 @@ def _lambda_handler(event, context):
             sns_msg_desc = sns_msg_json.get('Description', "")
         except (KeyError, IndexError, ValueError) as err:
             raise AvxError("2. Could not parse SNS message %s" % str(err)) from err
-        print("SNS Event %s Description %s " % (sns_msg_event, sns_msg_desc))
-        if sns_msg_event == "autoscaling:EC2_INSTANCE_LAUNCH":
-            print("Instance launched from Autoscaling")
-            handle_ha_event(client, lambda_client, controller_instanceobj, context)
+        LOGGER.info("SNS Event %s Description %s ", sns_msg_event, sns_msg_desc)
+        if sns_msg_event == "autoscaling:EC2_INSTANCE_LAUNCH" and \
+                is_entering_warm_pool(sns_msg_json):
+            LOGGER.info("Instance launched into the warm pool. Nothing to restore")
+            lease.release()
+        elif sns_msg_event == "autoscaling:EC2_INSTANCE_LAUNCH":
+            LOGGER.info("Instance launched from Autoscaling")
+            timeline = FailoverTimeline("ha_event")
+            continued = dict(event, LeaseOwner=lease.owner,
+                             CorrelationId=LOG_CONTEXT.correlation_id)
+            continuation = Continuation(context, continued)
+            try:
+                handle_ha_event(client, store, controller_instanceobj, timeline, continuation)
+            finally:
+                timeline.emit()
+                # A continuation takes the lease over. Duplicates arriving once the event is
+                # done find the instance saved as the controller
+                if not continuation.handed_over:
+                    lease.release()
         elif sns_msg_event == "autoscaling:TEST_NOTIFICATION":
-            print("Successfully received Test Event from ASG")
+            LOGGER.info("Successfully received Test Event from ASG")
         elif sns_msg_event == "autoscaling:EC2_INSTANCE_LAUNCH_ERROR":
             # and "The security group" in sns_msg_desc and "does not exist in VPC" in sns_msg_desc:
-            print("Instance launch error, recreating with new security group configuration")
-            sg_id = create_new_sg(client)
-            ami_id = os.environ.get('AMI_ID')
-            inst_type = os.environ.get('INST_TYPE')
-            key_name = os.environ.get('KEY_NAME')
-            delete_resources(None, detach_instances=False)
-            setup_ha(ami_id, inst_type, None, key_name, [sg_id], context, attach_instance=False)
+            LOGGER.warning("Instance launch error, relaunching with new security group "
+                           "configuration")
+            try:
+                sg_id = create_new_sg(client)
+                ami_id = os.environ.get('AMI_ID')
+                inst_type = os.environ.get('INST_TYPE')
+                key_name = os.environ.get('KEY_NAME')
+                setup_ha(ami_id, inst_type, None, key_name, [sg_id], context, store,
+                         attach_instance=False)
+            except Exception:
+                lease.release()
+                raise
+            store.commit()
     else:
-        print("Unknown source. Not from CFT or SNS")
+        LOGGER.info("Unknown source. Not from CFT or SNS")
 
 
-def handle_cloud_formation_request(client, event, lambda_client, controller_instanceobj, context,
-                                   instance_name):
+def sns_instance_id(event):
+    """ EC2InstanceId of an ASG notification, None for other events"""
+    try:
+        return json.loads(event["Records"][0]["Sns"]["Message"]).get('EC2InstanceId') or None
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+def sns_lifecycle_action(event):
+    """ Message of an ASG lifecycle hook notification, None for other events"""
+    try:
+        message = json.loads(event["Records"][0]["Sns"]["Message"])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
+    if isinstance(message, dict) and message.get('LifecycleActionToken'):
+        return message
+    return None
+
+
+def find_controller_instance(client, instance_id=None):
+    """ The running controller instance. Looked up by ID when known, which must carry the name
+    tag. Otherwise scans for the name tag, which must match exactly one running instance"""
+    instance_name = os.environ.get('AVIATRIX_TAG')
+    if instance_id:
+        reservations = client.describe_instances(InstanceIds=[instance_id])['Reservations']
+        instances = [inst for res in reservations for inst in res['Instances']
+                     if inst['State']['Name'] == 'running']
+        if not instances:
+            raise AvxError("Instance %s is not running" % instance_id)
+        tags = {tag['Key']: tag['Value'] for tag in instances[0].get('Tags', [])}
+        if tags.get('Name') != instance_name:
+            raise AvxError("Instance %s does not have the name tag %s" % (instance_id,
+                                                                          instance_name))
+        return instances[0]
+    paginator = client.get_paginator('describe_instances')
+    instances = [inst for page in paginator.paginate(Filters=[
+        {'Name': 'instance-state-name', 'Values': ['running']},
+        {'Name': 'tag:Name', 'Values': [instance_name]}])
+                 for res in page['Reservations'] for inst in res['Instances']]
+    if not instances:
+        raise AvxError("No running instance has the name tag %s" % instance_name)
+    if len(instances) > 1:
+        raise AvxError("%d running instances have the name tag %s: %s. Only the controller may"
+                       " use it" % (len(instances), instance_name,
+                                    ", ".join(inst['InstanceId'] for inst in instances)))
+    return instances[0]
+
+
+def handle_cloud_formation_request(client, event, store, controller_instanceobj, context,
+                                   instance_name, timeline):
     """Handle Requests from cloud formation"""
     response_status = 'SUCCESS'
     err_reason = ''
     if event['RequestType'] == 'Create':
         try:
-            os.environ['TOPIC_ARN'] = 'N/A'
-            os.environ['S3_BUCKET_REGION'] = ""
-            set_environ(client, lambda_client, controller_instanceobj, context)
-            print("Environment variables have been set.")
+            response_status, err_reason = handle_cft_create(client, store, controller_instanceobj,
+                                                            context, timeline)
+        finally:
+            with timeline.phase('commit_state'):
+                store.commit()
+    elif event['RequestType'] == 'Delete':
+        try:
+            LOGGER.info("Trying to delete lambda created resources")
+            inst_id = controller_instanceobj['InstanceId']
+            with timeline.phase('delete_resources'):
+                delete_resources(inst_id, context)
+                store.delete()
         except Exception as err:
-            err_reason = "Failed to setup environment variables %s" % str(err)
-            print(err_reason)
-            return 'FAILED', err_reason
+            err_reason = "Failed to delete lambda created resources. %s" % str(err)
+            LOGGER.error("%s", err_reason)
+            LOGGER.warning("You'll have to manually delete Auto Scaling group,"
+                           " Launch template, and SNS topic, all with name %s.", instance_name)
+            response_status = 'FAILED'
+    return response_status, err_reason
 
+
+def handle_cft_create(client, store, controller_instanceobj, context, timeline):
+    """ Verify the controller and setup HA. The caller commits the state"""
+    try:
+        # A topic left by an earlier Create is reused by setup_ha
+        store.update({'TOPIC_ARN': os.environ.get('TOPIC_ARN') or 'N/A', 'S3_BUCKET_REGION': ""})
+        with timeline.phase('set_environ'):
+            set_environ(client, store, controller_instanceobj)
+        LOGGER.info("Environment variables have been set.")
+    except Exception as err:
+        err_reason = "Failed to setup environment variables %s" % str(err)
+        LOGGER.error("%s", err_reason)
+        return 'FAILED', err_reason
+
+    def check_iam():
         if not verify_iam(controller_instanceobj):
-            return 'FAILED', 'IAM role aviatrix-role-ec2 could not be verified to be attached to' \
-                             ' controller'
+            raise AvxError('IAM role aviatrix-role-ec2 could not be verified to be attached'
+                           ' to controller')
+
+    def check_bucket():
         bucket_status, bucket_region = verify_bucket(controller_instanceobj)
-        os.environ['S3_BUCKET_REGION'] = bucket_region
-        update_env_dict(lambda_client, context, {"S3_BUCKET_REGION": bucket_region})
+        store.update({"S3_BUCKET_REGION": bucket_region})
         if not bucket_status:
-            return 'FAILED', 'Unable to verify S3 bucket'
+            raise AvxError('Unable to verify S3 bucket')
+
+    def check_backup_file(_):
         backup_file_status, backup_file = verify_backup_file(controller_instanceobj)
         if not backup_file_status:
-            return 'FAILED', 'Cannot find backup file in the bucket'
+            raise AvxError('Cannot find backup file in the bucket')
+        return backup_file
+
+    def check_backup_age(backup_file):
         if not is_backup_file_is_recent(backup_file):
-            return 'FAILED', f'Backup file is older than {MAXIMUM_BACKUP_AGE}'
+            raise AvxError(f'Backup file is older than {MAXIMUM_BACKUP_AGE}')
+
+    def check_backup_index(_):
+        # The index only speeds up failovers. Without it they check the backup object
+        try:
+            backup_index(max_age=0)
+        except Exception as err:  # pylint: disable=broad-except
+            LOGGER.warning("Could not index the backups. %s", err)
+
+    def check_eip():
         if not assign_eip(client, controller_instanceobj, None):
-            return 'FAILED', 'Failed to associate EIP or EIP was not found.' \
-                             ' Please attach an EIP to the controller before enabling HA'
-        if not _check_ami_id(controller_instanceobj['ImageId']):
-            return 'FAILED', "AMI is not latest. Cannot enable Controller HA. Please backup" \
-                             "/restore to the latest AMI before enabling controller HA"
+            raise AvxError('Failed to associate EIP or EIP was not found.'
+                           ' Please attach an EIP to the controller before enabling HA')
+        store.update({'EIP_ALLOC_ID': eip_allocation_id(client, os.environ.get('EIP'))})
 
-        print("Verified AWS and controller Credentials and backup file, EIP and AMI ID")
-        print("Trying to setup HA")
+    def check_ami():
+        if not _check_ami_id(controller_instanceobj['ImageId']):
+            raise AvxError("AMI is not latest. Cannot enable Controller HA. Please backup"
+                           "/restore to the latest AMI before enabling controller HA")
+
+    _, failures = run_checks([('verify_iam', check_iam, []),
+                              ('verify_bucket', check_bucket, []),
+                              ('verify_backup_file', check_backup_file, ['verify_bucket']),
+                              ('backup_check', check_backup_age, ['verify_backup_file']),
+                              ('index_backups', check_backup_index, ['verify_bucket']),
+                              ('assign_eip', check_eip, []),
+                              ('check_ami_id', check_ami, [])], timeline)
+    if failures:
+        return 'FAILED', '; '.join(failures)
+
+    LOGGER.info("Verified AWS and controller Credentials and backup file, EIP and AMI ID")
+    LOGGER.info("Trying to setup HA")
+    try:
+        ami_id = controller_instanceobj['ImageId']
+        inst_id = controller_instanceobj['InstanceId']
+        inst_type = controller_instanceobj['InstanceType']
+        key_name = controller_instanceobj.get('KeyName', '')
+        sgs = [sg_['GroupId'] for sg_ in controller_instanceobj['SecurityGroups']]
+        with timeline.phase('setup_ha'):
+            setup_ha(ami_id, inst_type, inst_id, key_name, sgs, context, store)
+    except Exception as err:
+        err_reason = "Failed to setup HA. %s" % str(err)
+        LOGGER.error("%s", err_reason)
+        return 'FAILED', err_reason
+    return 'SUCCESS', ''
+
+
+def run_checks(checks, timeline=None):
+    """ Runs checks on a thread pool, each as soon as the checks it depends on have passed.
+    checks is a list of (name, function, dependencies). function is called with the results
+    of its dependencies and fails by raising an exception. Checks depending on a failed check
+    are skipped. Returns a tuple of (results by name, failure reasons in the order of checks)"""
+    pending = {name: (function, dependencies) for name, function, dependencies in checks}
+    results = {}
+    failures = {}
+    running = {}
+
+    def timed(name, function, *args):
+        if timeline is None:
+            return function(*args)
+        with timeline.phase(name):
+            return function(*args)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(checks) or 1) as pool:
+        while pending or running:
+            scheduled = True
+            while scheduled:
+                scheduled = False
+                for name, (function, dependencies) in list(pending.items()):
+                    if any(dependency in failures for dependency in dependencies):
+                        LOGGER.warning("Skipping %s since a check it depends on failed", name)
+                        failures[name] = None
+                    elif all(dependency in results for dependency in dependencies):
+                        running[pool.submit(timed, name, function,
+                                            *[results[dep] for dep in dependencies])] = name
+                    else:
+                        continue
+                    del pending[name]
+                    scheduled = True
+            if not running:
+                if pending:
+                    raise AvxError("Checks %s depend on unknown checks" % list(pending))
+                break
+            done, _ = concurrent.futures.wait(running,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except AvxError as err:
+                    failures[name] = str(err)
+                except Exception as err:  # pylint: disable=broad-except
+                    LOGGER.exception("Check %s failed", name)
+                    failures[name] = "%s failed. %s" % (name, str(err))
+    reasons = [failures[name] for name, _, _ in checks if failures.get(name)]
+    for reason in reasons:
+        LOGGER.warning("%s", reason)
+    return results, reasons
+
+
+class AmiCatalog:
+    """ Latest AMI of each image type and region, as published at AMI_ID, with the set of
+    all its AMI IDs for lookups"""
+
+    def __init__(self, url, catalog, etag=None, fetched=0):
+        self.url = url
+        self.catalog = catalog
+        self.etag = etag
+        self.fetched = fetched
+        self.ami_ids = frozenset(ami for images in catalog.values() for ami in images.values())
+
+    def __contains__(self, ami_id):
+        return ami_id in self.ami_ids
+
+    def fresh(self):
+        """ Whether the catalog was fetched or revalidated within AMI_CATALOG_TTL"""
+        return time.time() - self.fetched < AMI_CATALOG_TTL
+
+    def save(self):
+        """ Write the catalog to AMI_CATALOG_CACHE for the next container"""
+        tmp_file = "%s.%s" % (AMI_CATALOG_CACHE, uuid.uuid4().hex)
         try:
-            ami_id = controller_instanceobj['ImageId']
-            inst_id = controller_instanceobj['InstanceId']
-            inst_type = controller_instanceobj['InstanceType']
-            key_name = controller_instanceobj.get('KeyName', '')
-            sgs = [sg_['GroupId'] for sg_ in controller_instanceobj['SecurityGroups']]
-            setup_ha(ami_id, inst_type, inst_id, key_name, sgs, context)
-        except Exception as err:
-            response_status = 'FAILED'
-            err_reason = "Failed to setup HA. %s" % str(err)
-            print(err_reason)
-    elif event['RequestType'] == 'Delete':
+            with open(tmp_file, 'w') as fileh:
+                json.dump({'url': self.url, 'etag': self.etag, 'fetched': self.fetched,
+                           'catalog': self.catalog}, fileh)
+            os.replace(tmp_file, AMI_CATALOG_CACHE)
+        except OSError as err:
+            LOGGER.warning("Could not cache the AMI catalog. %s", err)
+            with contextlib.suppress(OSError):
+                os.remove(tmp_file)
+
+    @classmethod
+    def load(cls, path, url=None):
+        """ Catalog read from a cache file, None if there is none. A cache file of another
+        url is ignored"""
         try:
-            print("Trying to delete lambda created resources")
-            inst_id = controller_instanceobj['InstanceId']
-            delete_resources(inst_id)
-        except Exception as err:
-            err_reason = "Failed to delete lambda created resources. %s" % str(err)
-            print(err_reason)
-            print("You'll have to manually delete Auto Scaling group,"
-                  " Launch Configuration, and SNS topic, all with"
-                  " name {}.".format(instance_name))
-            response_status = 'FAILED'
-    return response_status, err_reason
+            with open(path) as fileh:
+                content = json.load(fileh)
+        except (OSError, ValueError):
+            return None
+        if 'catalog' not in content:
+            return None
+        if url is not None and content.get('url') != url:
+            return None
+        return cls(content.get('url'), content['catalog'], content.get('etag'),
+                   content.get('fetched', 0))
+
+
+_AMI_CATALOG = {}
+
+
+def ami_catalog():
+    """ The AMI catalog from memory or /tmp while it is fresh. Otherwise it is fetched, with
+    If-None-Match when a cached copy has an ETag. When AMI_ID cannot be reached, a stale
+    copy is used"""
+    cached = _AMI_CATALOG.get(AMI_ID)
+    source = 'memory'
+    if cached is None:
+        cached = AmiCatalog.load(AMI_CATALOG_CACHE, AMI_ID)
+        source = AMI_CATALOG_CACHE
+    if cached is not None and cached.fresh():
+        _AMI_CATALOG[AMI_ID] = cached
+        LOGGER.info("Using the AMI catalog cached in %s", source)
+        return cached
+    headers = {'If-None-Match': cached.etag} if cached is not None and cached.etag else {}
+    try:
+        resp = transport.request('GET', AMI_ID, headers=headers, timeout=AMI_CATALOG_TIMEOUT)
+        if resp.status_code == 304:
+            LOGGER.info("AMI catalog has not changed")
+            cached.fetched = time.time()
+            catalog = cached
+        else:
+            resp.raise_for_status()
+            catalog = AmiCatalog(AMI_ID, json.loads(resp.content), resp.headers.get('ETag'),
+                                 time.time())
+    except (transport.TransportError, ValueError) as err:
+        LOGGER.warning("Could not fetch the AMI catalog from %s. %s", AMI_ID, err)
+        if cached is None:
+            raise AvxError("AMI catalog is not available") from err
+        LOGGER.info("Using the stale AMI catalog from %s", source)
+        return cached
+    catalog.save()
+    _AMI_CATALOG[AMI_ID] = catalog
+    return catalog
 
 
 def _check_ami_id(ami_id):
     """ Check if AMI is latest"""
-    print("Verifying AMI ID")
-    resp = requests.get(AMI_ID)
-    ami_dict = json.loads(resp.content)
-    for image_type in ami_dict:
-        if ami_id in list(ami_dict[image_type].values()):
-            print("AMI is valid")
-            return True
-    print("AMI is not latest. Cannot enable Controller HA. Please backup restore to the latest AMI"
-          "before enabling controller HA")
+    LOGGER.info("Verifying AMI ID")
+    if ami_id in ami_catalog():
+        LOGGER.info("AMI is valid")
+        return True
+    LOGGER.error("AMI is not latest. Cannot enable Controller HA. Please backup restore to the"
+                 " latest AMI before enabling controller HA")
     return False
 
 
@@ -281,72 +868,631 @@ def create_new_sg(client):
     return sg_id
 
 
-def update_env_dict(lambda_client, context, replace_dict):
-    """ Update particular variables in the Environment variables in lambda"""
-    env_dict = {
-        'EIP': os.environ.get('EIP'),
-        'AMI_ID': os.environ.get('AMI_ID'),
-        'VPC_ID': os.environ.get('VPC_ID'),
-        'INST_TYPE': os.environ.get('INST_TYPE'),
-        'KEY_NAME': os.environ.get('KEY_NAME'),
-        'CTRL_SUBNET': os.environ.get('CTRL_SUBNET'),
-        'AVIATRIX_TAG': os.environ.get('AVIATRIX_TAG'),
-        'API_PRIVATE_ACCESS': os.environ.get('API_PRIVATE_ACCESS', "False"),
-        'PRIV_IP': os.environ.get('PRIV_IP'),
-        'INST_ID': os.environ.get('INST_ID'),
-        'SUBNETLIST': os.environ.get('SUBNETLIST'),
-        'S3_BUCKET_BACK': os.environ.get('S3_BUCKET_BACK'),
-        'S3_BUCKET_REGION': os.environ.get('S3_BUCKET_REGION', ''),
-        'TOPIC_ARN': os.environ.get('TOPIC_ARN'),
-        'NOTIF_EMAIL': os.environ.get('NOTIF_EMAIL'),
-        'IAM_ARN': os.environ.get('IAM_ARN'),
-        'MONITORING': os.environ.get('IAM_ARN'),
-        'DISKS': os.environ.get('DISKS'),
-        'TAGS': os.environ.get('TAGS', '[]'),
-        'TMP_SG_GRP': os.environ.get('TMP_SG_GRP', ''),
-        # 'AVIATRIX_USER_BACK': os.environ.get('AVIATRIX_USER_BACK'),
-        # 'AVIATRIX_PASS_BACK': os.environ.get('AVIATRIX_PASS_BACK'),
-    }
-    env_dict.update(replace_dict)
-    os.environ.update(replace_dict)
+class StateStore(abc.ABC):
+    """ Failover state that changes at run time: the controller instance, its IPs, the SNS
+    topic and the temporary security group. Updates are applied to os.environ right away
+    and buffered until commit, which is called once per phase boundary"""
+    name = ''
+
+    def __init__(self):
+        self.pending = {}
+
+    def load(self):
+        """ Apply the committed state to os.environ. In fleet mode it includes the
+        configuration of the controller"""
+        keys = STATE_KEYS + CONTROLLER_KEYS if fleet_mode() else STATE_KEYS
+        state = {key: value for key, value in self._read().items() if key in keys}
+        os.environ.update(state)
+        return state
+
+    def update(self, values):
+        """ Buffer state updates"""
+        os.environ.update(values)
+        self.pending.update(values)
+
+    def commit(self):
+        """ Write the buffered updates in one request"""
+        if not self.pending:
+            return
+        self._write(dict(self.pending))
+        LOGGER.info("Committed %s to the %s state store", ", ".join(sorted(self.pending)),
+                    self.name)
+        self.pending.clear()
+
+    def delete(self):
+        """ Remove the state of the controller"""
+
+    def lease(self, name, owner):  # pylint: disable=unused-argument
+        """ Lease name of the controller for owner. The lambda environment has no conditional
+        writes, so no lease is taken"""
+        return NoLease(owner)
+
+    def _read(self):
+        return {}
+
+    @abc.abstractmethod
+    def _write(self, values):
+        """ Persist values, the buffered updates"""
+
+
+class LambdaEnvStateStore(StateStore):
+    """ State kept in the environment variables of the lambda function"""
+    name = 'lambda environment'
+
+    def __init__(self, lambda_client, function_name):
+        super().__init__()
+        self.lambda_client = lambda_client
+        self.function_name = function_name
+
+    def _read(self):
+        return self.lambda_client.get_function_configuration(
+            FunctionName=self.function_name).get('Environment', {}).get('Variables', {})
+
+    def _write(self, values):
+        for attempt in range(STATE_WRITE_RETRIES):
+            # Other invocations may have written since this one started. Only values change
+            env_dict = dict(self._read(), **values)
+            try:
+                self.lambda_client.update_function_configuration(
+                    FunctionName=self.function_name, Environment={'Variables': env_dict})
+                return
+            except botocore.exceptions.ClientError as err:
+                if "ResourceConflictException" not in str(err) or \
+                        attempt == STATE_WRITE_RETRIES - 1:
+                    raise
+                LOGGER.info("Previous configuration update is still in progress. Waiting")
+                self.lambda_client.get_waiter('function_updated').wait(
+                    FunctionName=self.function_name)
+
+
+class S3StateStore(StateStore):
+    """ State kept in a JSON object written with conditional requests"""
+    name = 's3'
+
+    def __init__(self, bucket, key):
+        super().__init__()
+        self.client = aws_client('s3')
+        self.bucket = bucket
+        self.key = key
+        self.state = {}
+        self.etag = None
+        self.conditional = s3_conditional_writes(self.client)
+        if not self.conditional:
+            LOGGER.warning("botocore %s cannot send conditional writes. State is written "
+                           "without them and no lease is taken", botocore.__version__)
+
+    def _read(self):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.key)
+        except botocore.exceptions.ClientError as err:
+            if err.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey'):
+                raise
+            self.state, self.etag = {}, None
+        else:
+            self.state = json.loads(response['Body'].read())
+            self.etag = response['ETag']
+        return self.state
+
+    def _write(self, values):
+        for _ in range(STATE_WRITE_RETRIES):
+            state = dict(self.state, **values)
+            condition = {}
+            if self.conditional:
+                condition = {'IfMatch': self.etag} if self.etag else {'IfNoneMatch': '*'}
+            try:
+                response = self.client.put_object(Bucket=self.bucket, Key=self.key,
+                                                  Body=json.dumps(state).encode(),
+                                                  ContentType='application/json', **condition)
+            except botocore.exceptions.ClientError as err:
+                if err.response.get('Error', {}).get('Code') not in \
+                        ('PreconditionFailed', 'ConditionalRequestConflict'):
+                    raise
+                LOGGER.info("State object changed since it was read. Merging")
+                self._read()
+            else:
+                self.state, self.etag = state, response['ETag']
+                return
+        raise AvxError("Could not write state to s3://%s/%s" % (self.bucket, self.key))
+
+    def delete(self):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key)
+
+    def lease(self, name, owner):
+        if not self.conditional:
+            return NoLease(owner)
+        return S3Lease(self.bucket, lease_key(name), owner)
+
+
+class DynamoDbStateStore(StateStore):
+    """ State kept in a DynamoDB item, versioned for conditional writes"""
+    name = 'dynamodb'
+
+    def __init__(self, table, controller):
+        super().__init__()
+        self.client = aws_client('dynamodb')
+        self.table = table
+        self.controller = controller
+        self.state = {}
+        self.version = None
+
+    def _read(self):
+        item = self.client.get_item(TableName=self.table,
+                                    Key={'controller': {'S': self.controller}},
+                                    ConsistentRead=True).get('Item')
+        if item is None:
+            self.state, self.version = {}, None
+        else:
+            self.state = json.loads(item['state']['S'])
+            self.version = int(item['version']['N'])
+        return self.state
+
+    def _write(self, values):
+        for _ in range(STATE_WRITE_RETRIES):
+            state = dict(self.state, **values)
+            version = (self.version or 0) + 1
+            if self.version is None:
+                condition = {'ConditionExpression': 'attribute_not_exists(controller)'}
+            else:
+                condition = {'ConditionExpression': 'version = :version',
+                             'ExpressionAttributeValues': {':version': {'N': str(self.version)}}}
+            try:
+                self.client.put_item(TableName=self.table,
+                                     Item={'controller': {'S': self.controller},
+                                           'version': {'N': str(version)},
+                                           'state': {'S': json.dumps(state)}},
+                                     **condition)
+            except botocore.exceptions.ClientError as err:
+                if "ConditionalCheckFailedException" not in str(err):
+                    raise
+                LOGGER.info("State item changed since it was read. Merging")
+                self._read()
+            else:
+                self.state, self.version = state, version
+                return
+        raise AvxError("Could not write state to table %s" % self.table)
+
+    def delete(self):
+        self.client.delete_item(TableName=self.table, Key={'controller': {'S': self.controller}})
+
+    def lease(self, name, owner):
+        return DynamoDbLease(self.table, '%s#lease#%s' % (self.controller, name), owner)
+
+
+def s3_conditional_writes(client):
+    """ Whether the botocore of the runtime can send PutObject with If-Match and
+    If-None-Match. Older ones reject them before sending the request"""
+    members = client.meta.service_model.operation_model('PutObject').input_shape.members
+    return 'IfMatch' in members and 'IfNoneMatch' in members
+
+
+class NoLease:
+    """ Lease of a state store that cannot take one. Duplicate deliveries are handled
+    again"""
+
+    def __init__(self, owner):
+        self.owner = owner
+
+    @staticmethod
+    def acquire(ttl):  # pylint: disable=unused-argument
+        """ Always succeeds"""
+        return True
+
+    @staticmethod
+    def release():
+        """ Nothing to give up"""
+
+
+def lease_key(name):
+    """ S3 key of the lease name of the controller"""
+    return STATE_PREFIX + 'leases/%s/%s.json' % (os.environ.get('AVIATRIX_TAG'), name)
+
+
+class S3Lease:
+    """ Claim of an invocation on an event, so that duplicate deliveries of the event are
+    dropped. Taken with a conditional write of a JSON object and given a TTL, after which
+    another invocation can take it over. The owner can take it again, to renew it"""
+
+    def __init__(self, bucket, key, owner):
+        self.client = aws_client('s3')
+        self.bucket = bucket
+        self.key = key
+        self.owner = owner
+
+    def acquire(self, ttl):
+        """ Take the lease for ttl seconds. Returns False if another owner holds it"""
+        body = json.dumps({'owner': self.owner, 'expires': time.time() + ttl}).encode()
+        condition = {'IfNoneMatch': '*'}
+        for _ in range(STATE_WRITE_RETRIES):
+            try:
+                self.client.put_object(Bucket=self.bucket, Key=self.key, Body=body,
+                                       ContentType='application/json', **condition)
+                return True
+            except botocore.exceptions.ClientError as err:
+                if client_error_code(err) not in ('PreconditionFailed',
+                                                  'ConditionalRequestConflict'):
+                    raise
+            held, etag = self._read()
+            if held and held.get('owner') != self.owner and held.get('expires', 0) > time.time():
+                LOGGER.info("Lease %s is held by %s", self.key, held.get('owner'))
+                return False
+            condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        return False
 
-    lambda_client.update_function_configuration(FunctionName=context.function_name,
-                                                Environment={'Variables': env_dict})
-    print("Updated environment dictionary")
+    def release(self):
+        """ Give the lease up if it is still ours"""
+        held, _ = self._read()
+        if held and held.get('owner') == self.owner:
+            self.client.delete_object(Bucket=self.bucket, Key=self.key)
+
+    def _read(self):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.key)
+        except botocore.exceptions.ClientError as err:
+            if client_error_code(err) not in ('404', 'NoSuchKey'):
+                raise
+            return None, None
+        return json.loads(response['Body'].read()), response['ETag']
+
+
+class DynamoDbLease:
+    """ S3Lease kept in an item of the state table"""
+
+    def __init__(self, table, key, owner):
+        self.client = aws_client('dynamodb')
+        self.table = table
+        self.key = key
+        self.owner = owner
+
+    def acquire(self, ttl):
+        """ Take the lease for ttl seconds. Returns False if another owner holds it"""
+        now = time.time()
+        try:
+            self.client.put_item(
+                TableName=self.table,
+                Item={'controller': {'S': self.key}, 'owner': {'S': self.owner},
+                      'expires': {'N': str(int(now + ttl))}},
+                ConditionExpression='attribute_not_exists(controller) OR #owner = :owner'
+                                    ' OR #expires < :now',
+                ExpressionAttributeNames={'#owner': 'owner', '#expires': 'expires'},
+                ExpressionAttributeValues={':owner': {'S': self.owner},
+                                           ':now': {'N': str(int(now))}})
+        except botocore.exceptions.ClientError as err:
+            if client_error_code(err) != 'ConditionalCheckFailedException':
+                raise
+            LOGGER.info("Lease %s is held by another invocation", self.key)
+            return False
+        return True
+
+    def release(self):
+        """ Give the lease up if it is still ours"""
+        try:
+            self.client.delete_item(TableName=self.table, Key={'controller': {'S': self.key}},
+                                    ConditionExpression='#owner = :owner',
+                                    ExpressionAttributeNames={'#owner': 'owner'},
+                                    ExpressionAttributeValues={':owner': {'S': self.owner}})
+        except botocore.exceptions.ClientError as err:
+            if client_error_code(err) != 'ConditionalCheckFailedException':
+                raise
 
 
-def login_to_controller(ip_addr, username, pwd):
-    """ Logs into the controller and returns the cid"""
-    base_url = "https://" + ip_addr + "/v1/api"
-    url = base_url + "?action=login&username=" + username + "&password=" + \
-          urllib.parse.quote(pwd, '%')
+def event_lease(event):
+    """ (lease name, TTL) of an ASG notification, (None, None) for other events. Launch
+    notifications are keyed by instance and destination, lifecycle actions by their token
+    and launch errors share one lease, held for the debounce window. Health checks of a
+    controller do not overlap"""
+    if health_check_event(event):
+        return 'health', HEALTH_FAILURE_THRESHOLD * (HEALTH_PROBE_INTERVAL +
+                                                     4 * READINESS_PROBE_TIMEOUT)
     try:
-        response = requests.get(url, verify=False)
-    except Exception as err:
-        print("Can't connect to controller with elastic IP %s. %s" % (ip_addr,
-                                                                      str(err)))
-        raise AvxError(str(err)) from err
-    response_json = response.json()
-    print(response_json)
+        message = json.loads(event["Records"][0]["Sns"]["Message"])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None, None
+    if not isinstance(message, dict):
+        return None, None
+    if message.get('LifecycleActionToken'):
+        return 'lifecycle-%s' % message['LifecycleActionToken'], None
+    if message.get('Event') == 'autoscaling:EC2_INSTANCE_LAUNCH' and message.get('EC2InstanceId'):
+        return 'launch-%s-%s' % (message['EC2InstanceId'],
+                                 message.get('Destination') or 'AutoScalingGroup'), None
+    if message.get('Event') == 'autoscaling:EC2_INSTANCE_LAUNCH_ERROR':
+        return 'launch-error', LAUNCH_ERROR_DEBOUNCE
+    return None, None
+
+
+def fleet_mode():
+    """ Whether one deployment handles many controllers"""
+    return os.environ.get('FLEET_MODE') == "True"
+
+
+def activate_controller(event):
+    """ Fleet mode: point the environment at the controller the event is for. It is named by
+    the AviatrixTag property of CFT requests, with the rest of its configuration, by the ASG
+    name of notifications and by the HealthCheck of scheduled health checks. Returns the
+    configuration from the CFT request"""
+    if os.environ.get('STATE_BACKEND') not in ('s3', 'dynamodb'):
+        raise AvxError("Fleet mode needs the s3 or dynamodb state backend")
+    if os.environ.get('STATE_BACKEND') == 's3' and not os.environ.get('STATE_BUCKET'):
+        raise AvxError("Fleet mode with the s3 state backend needs STATE_BUCKET")
+    config = {}
+    properties = event.get('ResourceProperties') if isinstance(event, dict) else None
+    if properties:
+        for prop, key in FLEET_PROPERTIES.items():
+            value = properties.get(prop)
+            if isinstance(value, list):
+                value = ",".join(value)
+            if value is not None:
+                config[key] = str(value)
+        name = config.get('AVIATRIX_TAG')
+    else:
+        try:
+            name = json.loads(event["Records"][0]["Sns"]["Message"]).get('AutoScalingGroupName')
+        except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+            name = None
+        if not name and isinstance(event, dict) and isinstance(event.get('HealthCheck'), str):
+            name = event['HealthCheck']
+    if not name:
+        raise AvxError("Fleet mode: could not tell which controller the event is for")
+    # Nothing may leak from the controller handled by the previous invocation
+    for key in CONTROLLER_KEYS + STATE_KEYS:
+        os.environ.pop(key, None)
+    os.environ.update(config)
+    os.environ['AVIATRIX_TAG'] = name
+    LOGGER.info("Handling controller %s", name)
+    return config
+
+
+def state_store(lambda_client, context):
+    """ StateStore selected by the STATE_BACKEND environment variable"""
+    backend = os.environ.get('STATE_BACKEND') or 'lambda'
+    controller = os.environ.get('AVIATRIX_TAG')
+    if backend == 's3':
+        return S3StateStore(os.environ.get('STATE_BUCKET') or os.environ.get('S3_BUCKET_BACK'),
+                            STATE_PREFIX + controller + '.json')
+    if backend == 'dynamodb':
+        return DynamoDbStateStore(os.environ.get('STATE_TABLE'), controller)
+    return LambdaEnvStateStore(lambda_client, context.function_name)
+
+
+def controller_api_url(ip_addr):
+    """ Base URL of the controller REST API"""
+    if CONTROLLER_PORT == 443:
+        return "https://" + ip_addr + "/v1/api"
+    return "https://%s:%d/v1/api" % (ip_addr, CONTROLLER_PORT)
+
+
+class ControllerApiClient:
+    """ Keep-alive client for the controller REST API. Holds the CID of the session and
+    logs in again by itself when the controller reports that the session has expired"""
+
+    def __init__(self, ip_addr, username, pwd):
+        self.ip_addr = ip_addr
+        self.base_url = controller_api_url(ip_addr)
+        self.username = username
+        self.pwd = pwd
+        self.cid = None
+        self.fallback = None
+        self.session = transport.HttpSession(verify=False)
+
+    def login(self, switch=True):
+        """ Logs into the controller and returns the cid. When the controller cannot be
+        reached, tries the address of the fallback client once"""
+        params = {"action": "login", "username": self.username, "password": self.pwd}
+        try:
+            response = self.session.get(self.base_url, params=params)
+        except Exception as err:
+            LOGGER.warning("Can't connect to controller with IP %s. %s", self.ip_addr, err)
+            if switch and self.use_fallback():
+                return self.login(switch=False)
+            raise AvxError(str(err)) from err
+        try:
+            response_json = response.json()
+        except ValueError as err:
+            raise AvxError("Unable to create session. %s" % str(err)) from err
+        LOGGER.debug("%s", response_json)
+        try:
+            self.cid = response_json['CID']
+            LOG_CONTEXT.add_secret(self.cid)
+            LOGGER.info("Created new session with CID %s", self.cid)
+        except KeyError as err:
+            LOGGER.error("Unable to create session. %s", err)
+            raise AvxError("Unable to create session. {}".format(err)) from err
+        return self.cid
+
+    def use_fallback(self):
+        """ Swap the address and the connections with the fallback client. Returns whether
+        there is one"""
+        other = self.fallback
+        if other is None:
+            return False
+        self.ip_addr, other.ip_addr = other.ip_addr, self.ip_addr
+        self.base_url, other.base_url = other.base_url, self.base_url
+        self.session, other.session = other.session, self.session
+        LOGGER.info("Switching the controller API from %s to %s", other.ip_addr, self.ip_addr)
+        return True
+
+    def is_session_expired(self, reason):
+        """ Check if the reason returned by the API says that the CID is no longer valid"""
+        return reason == 'CID is invalid or expired.' or \
+            "Invalid session. Please login again." in reason or \
+            f"Session {self.cid} not found" in reason or \
+            f"Session {self.cid} expired" in reason
+
+    def post(self, data, relogin=True):
+        """ Post an API request with the session CID and return the response json.
+        Connection errors are raised to the caller"""
+        if self.cid is None:
+            self.login()
+        response_json = self.session.post(self.base_url, data=dict(data, CID=self.cid)).json()
+        if relogin and self.is_session_expired(response_json.get('reason', '')):
+            LOGGER.info("Session %s is no longer valid. Logging in again", self.cid)
+            try:
+                self.login()
+            except AvxError:
+                return response_json
+            return self.post(data, relogin=False)
+        return response_json
+
+
+def backoff_delays(base=None, cap=None):
+    """ Yields exponentially increasing delays with jitter, capped at cap seconds"""
+    base = READINESS_BACKOFF_BASE if base is None else base
+    cap = READINESS_BACKOFF_CAP if cap is None else cap
+    attempt = 0
+    while True:
+        delay = min(cap, base * 2 ** attempt)
+        yield delay / 2 + random.uniform(0, delay / 2)
+        attempt += 1
+
+
+def probe_controller(ip_addr, timeout=None):
+    """ Cheap readiness probe. First a TCP/TLS handshake on 443, then an API request.
+    Returns a tuple of (ready, reason)"""
+    timeout = READINESS_PROBE_TIMEOUT if timeout is None else timeout
+    try:
+        with socket.create_connection((ip_addr, CONTROLLER_PORT), timeout=timeout) as sock:
+            # pylint: disable=protected-access
+            with ssl._create_unverified_context().wrap_socket(sock, server_hostname=ip_addr):
+                pass
+    except (OSError, ssl.SSLError) as err:
+        return False, "TLS handshake failed: %s" % str(err)
+    try:
+        response = transport.request('GET', controller_api_url(ip_addr), verify=False,
+                                     timeout=timeout)
+        response.json()
+    except transport.TransportError as err:
+        return False, "API request failed: %s" % str(err)
+    except ValueError:
+        return False, "API is not serving JSON yet (HTTP %s)" % response.status_code
+    return True, ""
+
+
+def wait_for_controller(ip_addr, max_wait, stop=None):
+    """ Probes the controller with jittered exponential backoff until its API answers,
+    max_wait seconds pass or the stop event is set. Returns a tuple of (ready, seconds
+    waited)"""
+    start = time.monotonic()
+    delays = backoff_delays()
+    probes = 0
+    while True:
+        probes += 1
+        ready, reason = probe_controller(ip_addr)
+        waited = time.monotonic() - start
+        if ready:
+            LOGGER.info("Controller %s is ready after %.1fs and %d probes", ip_addr, waited, probes)
+            return True, waited
+        if waited >= max_wait or (stop and stop.is_set()):
+            LOGGER.warning("Controller %s is not ready after %.1fs and %d probes. %s",
+                           ip_addr, waited, probes, reason)
+            return False, waited
+        delay = min(next(delays), max_wait - waited)
+        if stop:
+            stop.wait(delay)
+        else:
+            time.sleep(delay)
+
+
+def health_check_event(event):
+    """ Whether event is a scheduled health check: the input {"HealthCheck": ...} of an
+    EventBridge rule, or the scheduled event itself. In fleet mode HealthCheck is the name of
+    the controller"""
+    if not isinstance(event, dict):
+        return False
+    return bool(event.get('HealthCheck')) or (event.get('source') == 'aws.events' and
+                                              event.get('detail-type') == 'Scheduled Event')
+
+
+def consecutive_failures(window):
+    """ Number of failed probes at the end of window, a string of probe results, 1 for a
+    success and 0 for a failure"""
+    return len(window) - len(window.rstrip('0'))
+
+
+def probe_api_paths(paths):
+    """ Probe the controller through each (name, address) of paths until one answers.
+    Returns a tuple of (healthy, reason)"""
+    reasons = []
+    for name, address in paths:
+        ready, reason = probe_controller(address)
+        if ready:
+            return True, ""
+        reasons.append("%s %s: %s" % (name, address, reason))
+    return False, ". ".join(reasons)
+
+
+def check_controller_health(client, store):
+    """ Scheduled health check. Probes the API of the controller and, while it fails, again
+    every HEALTH_PROBE_INTERVAL seconds until HEALTH_FAILURE_THRESHOLD probes in a row failed.
+    The instance is then set Unhealthy so that the ASG replaces it, the EC2 status checks
+    pass while only the API hangs. Results are kept in HEALTH_WINDOW so that failures add up
+    across invocations. Returns whether the instance was set Unhealthy"""
+    inst_id = os.environ.get('INST_ID')
+    if not inst_id:
+        LOGGER.info("No controller instance ID was saved. Not probing")
+        return False
+    # A checkpoint of the saved controller is left over, its failover is done
+    failover = os.environ.get('FAILOVER_STEP') and os.environ.get('FAILOVER_INST_ID') != inst_id
+    if failover or 'failover' in security_group_holders(os.environ.get('TMP_SG_GRP')):
+        LOGGER.info("Failover from %s in progress. Not probing", inst_id)
+        return False
     try:
-        cid = response_json['CID']
-        print("Created new session with CID {}\n".format(cid))
-    except KeyError as err:
-        print("Unable to create session. {}".format(err))
-        raise AvxError("Unable to create session. {}".format(err)) from err
-    return cid
+        instance = client.describe_instances(
+            InstanceIds=[inst_id])['Reservations'][0]['Instances'][0]
+    except (botocore.exceptions.ClientError, IndexError) as err:
+        LOGGER.info("Controller instance %s not found. Not probing: %s", inst_id, err)
+        return False
+    if instance['State']['Name'] != 'running':
+        LOGGER.info("Controller instance %s is %s. Not probing", inst_id,
+                    instance['State']['Name'])
+        return False
+    uptime = time.time() - instance['LaunchTime'].timestamp()
+    if uptime < HEALTH_CHECK_GRACE:
+        LOGGER.info("Controller instance %s was launched %ds ago. Not probing", inst_id, uptime)
+        return False
+    paths = controller_api_paths(os.environ.get('EIP'), os.environ.get('PRIV_IP'))
+    saved = os.environ.get('HEALTH_WINDOW', '')
+    window = saved
+    for probe in range(HEALTH_FAILURE_THRESHOLD):
+        if probe:
+            time.sleep(HEALTH_PROBE_INTERVAL)
+        healthy, reason = probe_api_paths(paths)
+        window = (window + ('1' if healthy else '0'))[-HEALTH_WINDOW_SIZE:]
+        if healthy:
+            break
+        LOGGER.warning("Controller instance %s failed a health check. %s", inst_id, reason)
+        if consecutive_failures(window) >= HEALTH_FAILURE_THRESHOLD:
+            break
+    # The window starts at its first failure, a healthy controller has nothing to write
+    window = window[window.find('0'):] if '0' in window else ''
+    failures = consecutive_failures(window)
+    LOGGER.info("Controller instance %s failed %d of the last %d health checks, %d in a row",
+                inst_id, window.count('0'), HEALTH_WINDOW_SIZE, failures)
+    unhealthy = failures >= HEALTH_FAILURE_THRESHOLD
+    if unhealthy:
+        # Reset before the ASG launches the replacement, whose failover writes the state too
+        window = ''
+    if window != saved:
+        store.update({'HEALTH_WINDOW': window})
+        store.commit()
+    if unhealthy:
+        LOGGER.error("Controller instance %s failed %d health checks in a row. Setting it "
+                     "Unhealthy", inst_id, failures)
+        try:
+            aws_client('autoscaling').set_instance_health(
+                InstanceId=inst_id, HealthStatus='Unhealthy', ShouldRespectGracePeriod=False)
+        except botocore.exceptions.ClientError as err:
+            raise AvxError("Could not set controller instance %s Unhealthy: %s" %
+                           (inst_id, str(err))) from err
+    return unhealthy
 
 
-def set_environ(client, lambda_client, controller_instanceobj, context,
-                eip=None):
-    """ Sets Environment variables """
+def set_environ(client, store, controller_instanceobj, eip=None):
+    """ Sets the state of the controller instance """
     if eip is None:
         # From cloud formation. EIP is not known at this point. So get from controller inst
         eip = controller_instanceobj[
             'NetworkInterfaces'][0]['Association'].get('PublicIp')
     else:
         eip = os.environ.get('EIP')
-    sns_topic_arn = os.environ.get('TOPIC_ARN')
     inst_id = controller_instanceobj['InstanceId']
     ami_id = controller_instanceobj['ImageId']
     vpc_id = controller_instanceobj['VpcId']
@@ -365,19 +1511,21 @@ def set_environ(client, lambda_client, controller_instanceobj, context,
         if not key.startswith("aws:"):
             tags_stripped.append(tag)
 
+    attached = [volume.get('Ebs', {})
+                for volume in controller_instanceobj.get('BlockDeviceMappings', {})
+                if volume.get('Ebs', {}).get('Status', 'detached') == 'attached']
+    volumes = describe_volumes(client, [ebs.get('VolumeId') for ebs in attached])
     disks = []
-    for volume in controller_instanceobj.get('BlockDeviceMappings', {}):
-        ebs = volume.get('Ebs', {})
-        if ebs.get('Status', 'detached') == 'attached':
-            vol_id = ebs.get('VolumeId')
-            vol = client.describe_volumes(VolumeIds=[vol_id])['Volumes'][0]
-            disks.append({"VolumeId": vol_id,
-                          "DeleteOnTermination": ebs.get('DeleteOnTermination'),
-                          "VolumeType": vol["VolumeType"],
-                          "Size": vol["Size"],
-                          "Iops": vol.get("Iops", ""),
-                          "Encrypted": vol["Encrypted"],
-                          })
+    for ebs in attached:
+        vol_id = ebs.get('VolumeId')
+        vol = volumes[vol_id]
+        disks.append({"VolumeId": vol_id,
+                      "DeleteOnTermination": ebs.get('DeleteOnTermination'),
+                      "VolumeType": vol["VolumeType"],
+                      "Size": vol["Size"],
+                      "Iops": vol.get("Iops", ""),
+                      "Encrypted": vol["Encrypted"],
+                      })
 
     env_dict = {
         'EIP': eip,
@@ -386,33 +1534,20 @@ def set_environ(client, lambda_client, controller_instanceobj, context,
         'INST_TYPE': inst_type,
         'KEY_NAME': keyname,
         'CTRL_SUBNET': ctrl_subnet,
-        'AVIATRIX_TAG': os.environ.get('AVIATRIX_TAG'),
-        'API_PRIVATE_ACCESS': os.environ.get('API_PRIVATE_ACCESS', "False"),
         'PRIV_IP': priv_ip,
         'INST_ID': inst_id,
-        'SUBNETLIST': os.environ.get('SUBNETLIST'),
-        'S3_BUCKET_BACK': os.environ.get('S3_BUCKET_BACK'),
-        'S3_BUCKET_REGION': os.environ.get('S3_BUCKET_REGION', ''),
-        'TOPIC_ARN': sns_topic_arn,
-        'NOTIF_EMAIL': os.environ.get('NOTIF_EMAIL'),
         'IAM_ARN': iam_arn,
         'MONITORING': monitoring,
         'DISKS': json.dumps(disks),
         'TAGS': json.dumps(tags_stripped),
-        'TMP_SG_GRP': os.environ.get('TMP_SG_GRP', ''),
-        # 'AVIATRIX_USER_BACK': os.environ.get('AVIATRIX_USER_BACK'),
-        # 'AVIATRIX_PASS_BACK': os.environ.get('AVIATRIX_PASS_BACK'),
         }
-    print("Setting environment %s" % env_dict)
-
-    lambda_client.update_function_configuration(FunctionName=context.function_name,
-                                                Environment={'Variables': env_dict})
-    os.environ.update(env_dict)
+    LOGGER.debug("Setting environment %s", env_dict)
+    store.update(env_dict)
 
 
 def verify_iam(controller_instanceobj):
     """ Verify IAM roles"""
-    print("Verifying IAM roles ")
+    LOGGER.info("Verifying IAM roles ")
     iam_arn = controller_instanceobj.get('IamInstanceProfile', {}).get('Arn', '')
     if not iam_arn:
         return False
@@ -421,70 +1556,567 @@ def verify_iam(controller_instanceobj):
 
 def verify_bucket(controller_instanceobj):
     """ Verify S3 and controller account credentials """
-    print("Verifying bucket")
+    LOGGER.info("Verifying bucket")
     try:
-        s3_client = boto3.client('s3')
+        s3_client = aws_client('s3')
         resp = s3_client.get_bucket_location(Bucket=os.environ.get('S3_BUCKET_BACK'))
     except Exception as err:
-        print("S3 bucket used for backup is not "
-              "valid. %s" % str(err))
+        LOGGER.error("S3 bucket used for backup is not valid. %s", err)
         return False, ""
     try:
-        bucket_region = resp['LocationConstraint']
+        # Buckets in us-east-1 have a null location constraint
+        bucket_region = resp['LocationConstraint'] or 'us-east-1'
     except KeyError:
-        print("Key LocationConstraint not found in get_bucket_location response %s" % resp)
+        LOGGER.warning("Key LocationConstraint not found in get_bucket_location response %s", resp)
         return False, ""
 
-    print("S3 bucket is valid.")
+    LOGGER.info("S3 bucket is valid.")
     eip = controller_instanceobj[
         'NetworkInterfaces'][0]['Association'].get('PublicIp')
-    print(eip)
+    LOGGER.debug("%s", eip)
 
     # login_to_controller(eip, os.environ.get('AVIATRIX_USER_BACK'),
     #                     os.environ.get('AVIATRIX_PASS_BACK'))
     return True, bucket_region
 
 
+class BackupStore:
+    """ Read access to the backup bucket. Existence and age checks use HEAD, small objects
+    like the version file are read into memory. Both are memoized per key"""
+
+    def __init__(self, bucket, region):
+        self.bucket = bucket
+        self.region = region
+        self.client = aws_client('s3', region or None)
+        self.lock = threading.Lock()
+        self.heads = {}
+        self.bodies = {}
+        self.index = None
+
+    @staticmethod
+    def _is_missing(err):
+        return err.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+    def head(self, key):
+        """ Returns the HEAD metadata (ContentLength, ETag, LastModified) of key or None if
+        the object does not exist"""
+        with self.lock:
+            if key in self.heads:
+                return self.heads[key]
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=key)
+        except botocore.exceptions.ClientError as err:
+            if not self._is_missing(err):
+                raise
+            head = None
+        with self.lock:
+            self.heads[key] = head
+        return head
+
+    def read(self, key):
+        """ Returns the content of a small object as bytes or None if it does not exist"""
+        with self.lock:
+            if key in self.bodies:
+                return self.bodies[key]
+        try:
+            body = self.client.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+        except botocore.exceptions.ClientError as err:
+            if not self._is_missing(err):
+                raise
+            body = None
+        with self.lock:
+            self.bodies[key] = body
+        return body
+
+    def forget(self, key):
+        """ Drop what was memoized of key, after it was written"""
+        with self.lock:
+            self.heads.pop(key, None)
+            self.bodies.pop(key, None)
+
+
+_BACKUP_STORES = {}
+
+
+def backup_store():
+    """ BackupStore of the configured bucket. Memoized until reset_backup_store is called at
+    the start of the next invocation"""
+    key = (os.environ.get('S3_BUCKET_BACK'), os.environ.get('S3_BUCKET_REGION', ''))
+    store = _BACKUP_STORES.get(key)
+    if store is None:
+        store = _BACKUP_STORES.setdefault(key, BackupStore(*key))
+    return store
+
+
+def reset_backup_store():
+    """ Forget objects read by a previous invocation"""
+    _BACKUP_STORES.clear()
+
+
+def parse_backup_key(key):
+    """ Returns (private IP, suffix) of a backup object key, or (None, None) for other keys"""
+    for suffix in (BACKUP_CONFIG_SUFFIX, BACKUP_VERSION_SUFFIX):
+        if key.startswith(BACKUP_PREFIX) and key.endswith(suffix):
+            return key[len(BACKUP_PREFIX):-len(suffix)], suffix
+    return None, None
+
+
+class BackupIndex:
+    """ Manifest of the backups in the bucket, kept in BACKUP_INDEX_KEY. Maps the private IP
+    of every controller that backed up to the object versions of its configuration backup,
+    newest first, and to its version file with the parsed controller version. It is built
+    from a paginated listing of the bucket, and then kept up to date one controller at a time,
+    from S3 notifications or by listing the backups of the controller that failed"""
+
+    def __init__(self, store):
+        self.store = store
+        self.client = store.client
+        self.bucket = store.bucket
+        self.generated = 0
+        self.backups = {}
+        self.etag = None
+
+    def _read(self):
+        """ Read the manifest. Returns False if there is none"""
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=BACKUP_INDEX_KEY)
+        except botocore.exceptions.ClientError as err:
+            if not BackupStore._is_missing(err):  # pylint: disable=protected-access
+                raise
+            self.etag = None
+            self.generated = 0
+            self.backups = {}
+            return False
+        manifest = json.loads(response['Body'].read())
+        self.etag = response['ETag']
+        self.generated = manifest.get('generated', 0)
+        self.backups = manifest.get('backups', {})
+        return True
+
+    def _write(self, conditional=False):
+        """ Write the manifest. When conditional, fails if it changed since it was read"""
+        kwargs = {}
+        if conditional and s3_conditional_writes(self.client):
+            kwargs = {'IfMatch': self.etag} if self.etag else {'IfNoneMatch': '*'}
+        response = self.client.put_object(
+            Bucket=self.bucket, Key=BACKUP_INDEX_KEY, ContentType='application/json',
+            Body=json.dumps({'generated': self.generated, 'backups': self.backups}).encode(),
+            **kwargs)
+        self.etag = response.get('ETag')
+
+    def load(self, max_age=None):
+        """ Read the manifest. When it is missing or older than max_age, the bucket is listed
+        again"""
+        if self.read_fresh(max_age):
+            return self
+        return self.refresh()
+
+    def read_fresh(self, max_age=None, priv_ip=None):
+        """ Read the manifest. Returns whether it is younger than max_age, or the entry of
+        priv_ip if given"""
+        max_age = BACKUP_INDEX_TTL if max_age is None else max_age
+        found = self._read()
+        indexed = self.generated
+        if priv_ip:
+            indexed = max(indexed, (self.backups.get(priv_ip) or {}).get('indexed', 0))
+        if found and time.time() - indexed < max_age:
+            LOGGER.info("Backup index of %d controllers is %.0fs old", len(self.backups),
+                        time.time() - indexed)
+            return True
+        return False
+
+    def refresh(self):
+        """ Rebuild the index from a listing of every backup object version. Version files
+        are only read again when their ETag changed"""
+        previous = {priv_ip: entry.get('version_file')
+                    for priv_ip, entry in self.backups.items()}
+        backups = {}
+        paginator = self.client.get_paginator('list_object_versions')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=BACKUP_PREFIX):
+            for obj in page.get('Versions', []):
+                priv_ip, suffix = parse_backup_key(obj['Key'])
+                if not priv_ip:
+                    continue
+                entry = backups.setdefault(priv_ip, {'config': [], 'version_file': None})
+                item = self._item(obj['Key'], obj.get('VersionId') or 'null',
+                                  obj['LastModified'], obj['Size'], obj['ETag'],
+                                  obj.get('IsLatest', True))
+                if suffix == BACKUP_CONFIG_SUFFIX:
+                    entry['config'].append(item)
+                elif item['latest']:
+                    entry['version_file'] = item
+        for entry in backups.values():
+            entry['config'].sort(key=lambda item: -item['last_modified'])
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(lambda priv_ip: self._parse_version(backups[priv_ip],
+                                                              previous.get(priv_ip)),
+                          backups))
+        self.backups = backups
+        self.generated = time.time()
+        self._write()
+        LOGGER.info("Indexed the backups of %d controllers", len(backups))
+        return self
+
+    def refresh_controller(self, priv_ip):
+        """ Rebuild the entry of the controller that had priv_ip from list_controller"""
+        entry = self.list_controller(priv_ip)
+        self._save_entry(priv_ip, lambda current: current.update(entry))
+        return self
+
+    def list_controller(self, priv_ip):
+        """ Entry of the controller that had priv_ip, without writing it. The versions of its
+        configuration backup are listed newest first, no further back than MAXIMUM_BACKUP_AGE,
+        so the cost does not grow with the other controllers or the old versions in the
+        bucket"""
+        config_key = BACKUP_PREFIX + priv_ip + BACKUP_CONFIG_SUFFIX
+        version_key = BACKUP_PREFIX + priv_ip + BACKUP_VERSION_SUFFIX
+        oldest = time.time() - MAXIMUM_BACKUP_AGE
+        config = []
+        paginator = self.client.get_paginator('list_object_versions')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=config_key):
+            versions = [obj for obj in page.get('Versions', []) if obj['Key'] == config_key]
+            config.extend(self._item(obj['Key'], obj.get('VersionId') or 'null',
+                                     obj['LastModified'], obj['Size'], obj['ETag'],
+                                     obj.get('IsLatest', True)) for obj in versions)
+            if versions and versions[-1]['LastModified'].timestamp() < oldest:
+                break
+        config.sort(key=lambda item: -item['last_modified'])
+        head = self.store.head(version_key)
+        entry = {'config': config, 'indexed': time.time(), 'version_file': self._item(
+            version_key, head.get('VersionId') or 'null', head['LastModified'],
+            head['ContentLength'], head['ETag'], True) if head else None}
+        self._parse_version(entry, (self.backups.get(priv_ip) or {}).get('version_file'))
+        LOGGER.info("Listed %d versions of the backup of %s", len(config), priv_ip)
+        return entry
+
+    def _save_entry(self, priv_ip, update):
+        """ Read the manifest, apply update to the entry of priv_ip and write it back. Read
+        again when the manifest changed in the meantime"""
+        for _ in range(STATE_WRITE_RETRIES):
+            self._read()
+            update(self.backups.setdefault(priv_ip, {'config': [], 'version_file': None}))
+            try:
+                self._write(conditional=True)
+                return
+            except botocore.exceptions.ClientError as err:
+                if "PreconditionFailed" not in str(err) and \
+                        "ConditionalRequestConflict" not in str(err):
+                    raise
+                LOGGER.info("Backup index changed while updating %s. Retrying", priv_ip)
+        raise AvxError("Could not update the backup index of %s" % priv_ip)
+
+    @staticmethod
+    def _item(key, version_id, last_modified, size, etag, latest):
+        return {'key': key, 'version_id': version_id, 'last_modified': last_modified.timestamp(),
+                'size': size, 'etag': etag, 'latest': latest}
+
+    def _parse_version(self, entry, previous):
+        """ Set the controller version parsed from the version file of entry"""
+        version_file = entry.get('version_file')
+        if not version_file:
+            return
+        if previous and previous.get('etag') == version_file['etag'] and 'version' in previous:
+            version_file['version'] = previous['version']
+            return
+        try:
+            version_file['version'] = parse_controller_version(
+                self.store.read(version_file['key']).decode())
+        except Exception as err:  # pylint: disable=broad-except
+            LOGGER.warning("Could not parse %s. %s", version_file['key'], err)
+            version_file['version'] = None
+
+    def record(self, key):
+        """ Update the index with the current version of one backup object"""
+        priv_ip, suffix = parse_backup_key(key)
+        if not priv_ip:
+            return
+        self._read()
+        if priv_ip not in self.backups:
+            self.refresh_controller(priv_ip)
+            return
+        head = self.client.head_object(Bucket=self.bucket, Key=key)
+        item = self._item(key, head.get('VersionId') or 'null', head['LastModified'],
+                          head['ContentLength'], head['ETag'], True)
+
+        def update(entry):
+            if suffix == BACKUP_CONFIG_SUFFIX:
+                # Without versioning, the object is replaced under the version ID null
+                entry['config'] = [item] + [dict(other, latest=False)
+                                            for other in entry['config']
+                                            if other['version_id'] != item['version_id']]
+            else:
+                previous = entry.get('version_file')
+                entry['version_file'] = item
+                self._parse_version(entry, previous)
+        self._save_entry(priv_ip, update)
+        LOGGER.info("Indexed %s", key)
+
+    def newest_backup(self, priv_ip, max_age=None):
+        """ Newest configuration backup of the controller that had priv_ip that can be
+        restored: the newest object version not empty and younger than max_age. Returns its
+        index item with the parsed controller version, or None. Items of older object
+        versions have to be made current with promote_backup to be restored"""
+        max_age = MAXIMUM_BACKUP_AGE if max_age is None else max_age
+        entry = self.backups.get(priv_ip)
+        if not entry or not entry['config']:
+            LOGGER.info("No backup of %s in the index", priv_ip)
+            return None
+        now = time.time()
+        usable = [item for item in entry['config']
+                  if item['size'] > 0 and now - item['last_modified'] < max_age]
+        if usable and usable[0]['latest']:
+            backup = dict(usable[0], version=(entry.get('version_file') or {}).get('version'))
+            LOGGER.info("Newest backup is %s of %d bytes, %.0fs old, version %s",
+                        backup['key'], backup['size'], now - backup['last_modified'],
+                        backup['version'])
+            return backup
+        if usable:
+            LOGGER.warning("Current version of %s is not usable. Object version %s from %.0fs "
+                           "ago is", usable[0]['key'], usable[0]['version_id'],
+                           now - usable[0]['last_modified'])
+            return dict(usable[0])
+        LOGGER.info("No backup of %s younger than %d seconds", priv_ip, max_age)
+        return None
+
+
+def backup_index(max_age=None):
+    """ BackupIndex of the configured bucket, loaded once per invocation"""
+    store = backup_store()
+    if store.index is None:
+        store.index = BackupIndex(store).load(max_age)
+    return store.index
+
+
+def select_backup(priv_ip):
+    """ Newest usable backup of the controller that had priv_ip, as a backup index item. From
+    the backup index when its entry is fresh. Otherwise the backup object is checked with a
+    HEAD, and the versions of the backup are only listed when it cannot be restored. Nothing
+    is written to the index. Returns None if there is no usable backup"""
+    index = BackupIndex(backup_store())
+    try:
+        if index.read_fresh(priv_ip=priv_ip):
+            return index.newest_backup(priv_ip)
+    except Exception as err:  # pylint: disable=broad-except
+        LOGGER.info("Backup index is not available. %s", err)
+    key = BACKUP_PREFIX + priv_ip + BACKUP_CONFIG_SUFFIX
+    if is_backup_file_is_recent(key) and backup_store().head(key)['ContentLength'] > 0:
+        head = backup_store().head(key)
+        return BackupIndex._item(  # pylint: disable=protected-access
+            key, head.get('VersionId') or 'null', head['LastModified'], head['ContentLength'],
+            head['ETag'], True)
+    try:
+        index.backups[priv_ip] = index.list_controller(priv_ip)
+    except botocore.exceptions.ClientError as err:
+        LOGGER.info("Could not list the versions of the backup of %s. %s", priv_ip, err)
+        return None
+    return index.newest_backup(priv_ip)
+
+
+def promote_backup(backup):
+    """ Make the object version of backup the current one, with the version file written
+    with it, as the controller restores the current version of the key. Returns the index
+    item of the copy"""
+    if backup is None or backup['latest']:
+        return backup
+    store = backup_store()
+    version_key = BACKUP_PREFIX + parse_backup_key(backup['key'])[0] + BACKUP_VERSION_SUFFIX
+    paginator = store.client.get_paginator('list_object_versions')
+    version_files = [obj for page in paginator.paginate(Bucket=store.bucket, Prefix=version_key)
+                     for obj in page.get('Versions', []) if obj['Key'] == version_key]
+    copies = [(backup['key'], backup['version_id'])]
+    if version_files:
+        # The version file written with the backup is the one closest to it in time
+        written = min(version_files, key=lambda obj: abs(
+            obj['LastModified'].timestamp() - backup['last_modified']))
+        copies.insert(0, (version_key, written['VersionId']))
+    for key, version_id in copies:
+        LOGGER.warning("Copying object version %s of %s over the current one", version_id, key)
+        store.client.copy_object(Bucket=store.bucket, Key=key, CopySource={
+            'Bucket': store.bucket, 'Key': key, 'VersionId': version_id})
+        store.forget(key)
+    head = store.head(backup['key'])
+    return BackupIndex._item(  # pylint: disable=protected-access
+        backup['key'], head.get('VersionId') or 'null', head['LastModified'],
+        head['ContentLength'], head['ETag'], True)
+
+
+def s3_event_records(event):
+    """ (bucket, region, event name, key) of the records of an S3 notification"""
+    records = []
+    try:
+        for record in event["Records"]:
+            if record.get("eventSource") == "aws:s3":
+                records.append((record["s3"]["bucket"]["name"], record.get("awsRegion", ""),
+                                record["eventName"],
+                                urllib.parse.unquote_plus(record["s3"]["object"]["key"])))
+    except (AttributeError, KeyError, TypeError):
+        return []
+    return records
+
+
+def handle_backup_notification(records):
+    """ Keep the backup index of each bucket up to date with the backups written to it"""
+    indexes = {}
+    for bucket, region, event_name, key in records:
+        if not parse_backup_key(key)[0]:
+            continue
+        if (bucket, region) not in indexes:
+            indexes[(bucket, region)] = BackupIndex(BackupStore(bucket, region))
+        index = indexes[(bucket, region)]
+        if event_name.startswith("ObjectRemoved"):
+            index.refresh_controller(parse_backup_key(key)[0])
+        else:
+            index.record(key)
+
+
+def stream_digests(client, bucket, key, head, part_size, stop=None):
+    """ Read an object in ranged requests of INTEGRITY_RANGE_SIZE and hash it chunk by chunk,
+    in constant memory and without writing it anywhere. Parts of part_size bytes, as it was
+    uploaded in, are hashed on their own too. Returns the sha256 hex digest of the object and
+    a list of (md5, sha256) per part. Gives up with AvxError once stop is set"""
+    size = head['ContentLength']
+    version = {'VersionId': head['VersionId']} if head.get('VersionId') else {}
+    sha256 = hashlib.sha256()
+    parts = []
+    offset = 0
+    while offset < size:
+        end = min(offset + INTEGRITY_RANGE_SIZE, size)
+        body = client.get_object(Bucket=bucket, Key=key, Range='bytes=%d-%d' % (offset, end - 1),
+                                 IfMatch=head['ETag'], **version)['Body']
+        for chunk in body.iter_chunks(INTEGRITY_CHUNK_SIZE):
+            if stop is not None and stop.is_set():
+                body.close()
+                raise AvxError("Stopped reading %s" % key)
+            sha256.update(chunk)
+            while chunk:
+                if offset == len(parts) * part_size:
+                    parts.append((hashlib.md5(), hashlib.sha256()))
+                boundary = len(parts) * part_size
+                piece, chunk = chunk[:boundary - offset], chunk[boundary - offset:]
+                for digest in parts[-1]:
+                    digest.update(piece)
+                offset += len(piece)
+        if end != offset:
+            raise AvxError("Read %d bytes of %s instead of %d" % (offset, key, end))
+    return sha256.hexdigest(), parts
+
+
+def s3_digests(parts):
+    """ ETag and SHA-256 checksum that S3 gives an object uploaded in parts, from the
+    (md5, sha256) of each part"""
+    if len(parts) == 1:
+        return parts[0][0].hexdigest(), base64.b64encode(parts[0][1].digest()).decode()
+    suffix = '-%d' % len(parts)
+    etag = hashlib.md5(b''.join(md5.digest() for md5, _ in parts)).hexdigest()
+    checksum = hashlib.sha256(b''.join(sha256.digest() for _, sha256 in parts)).digest()
+    return etag + suffix, base64.b64encode(checksum).decode() + suffix
+
+
+def read_checksum_manifest(store, key):
+    """ Checksum manifest written by the producer of the backup key, as a dict with sha256
+    and optionally size, or None if there is none"""
+    body = store.read(key + BACKUP_CHECKSUM_SUFFIX)
+    if not body:
+        return None
+    text = body.decode().strip()
+    if text.startswith('{'):
+        return json.loads(text)
+    # sha256sum output: <hex digest>  <file name>
+    return {'sha256': text.split()[0].lower()}
+
+
+def verify_backup_integrity(backup, stop=None):
+    """ Check that a backup is complete before it is restored. Against the checksum manifest
+    its producer wrote next to it, without reading the backup when S3 keeps a SHA-256 of it.
+    Otherwise the backup is streamed and compared with the manifest, the SHA-256 checksum S3
+    keeps or its ETag, per part for multipart uploads. Returns a tuple of (intact, reason)"""
+    store = backup_store()
+    key = backup['key']
+    head = store.client.head_object(Bucket=store.bucket, Key=key, ChecksumMode='ENABLED')
+    size = head['ContentLength']
+    if size == 0:
+        return False, "%s is empty" % key
+    manifest = read_checksum_manifest(store, key)
+    if manifest and manifest.get('size', size) != size:
+        return False, "%s is %d bytes, the manifest says %d" % (key, size, manifest['size'])
+    etag = head['ETag'].strip('"')
+    checksum = head.get('ChecksumSHA256', '')
+    if ('-' in checksum) != ('-' in etag):
+        # S3 keeps the checksums of multipart uploads per part, like their ETag
+        checksum = ''
+    if manifest and checksum and '-' not in checksum:
+        if base64.b64decode(checksum).hex() != manifest['sha256']:
+            return False, "SHA-256 of %s does not match its checksum manifest" % key
+        return True, "SHA-256 of %s kept by S3 matches its checksum manifest" % key
+    if head.get('ServerSideEncryption') == 'aws:kms' or head.get('SSECustomerAlgorithm'):
+        # The ETag of these is not an MD5 of the content
+        etag = ''
+    if not manifest and not checksum and not etag:
+        return True, "%s has no checksum manifest, no S3 checksum and no MD5 ETag. It is " \
+                     "restored unverified" % key
+    part_size = size
+    if '-' in etag or '-' in checksum:
+        part_size = store.client.head_object(Bucket=store.bucket, Key=key,
+                                             PartNumber=1)['ContentLength']
+    start = time.monotonic()
+    sha256, parts = stream_digests(store.client, store.bucket, key, head, part_size, stop)
+    LOGGER.info("Hashed %d bytes of %s in %.1fs", size, key, time.monotonic() - start)
+    part_etag, part_checksum = s3_digests(parts)
+    if manifest:
+        if sha256 != manifest['sha256']:
+            return False, "SHA-256 of %s does not match its checksum manifest" % key
+        return True, "SHA-256 of %s matches its checksum manifest" % key
+    if checksum:
+        if checksum != part_checksum:
+            return False, "SHA-256 of %s does not match the checksum kept by S3" % key
+        return True, "SHA-256 of %s matches the checksum kept by S3" % key
+    if etag != part_etag:
+        return False, "MD5 of %s does not match its ETag" % key
+    return True, "MD5 of %s matches its ETag" % key
+
+
 def is_backup_file_is_recent(backup_file):
     """ Check if backup file is not older than MAXIMUM_BACKUP_AGE """
     try:
-        s3c = boto3.client('s3', region_name=os.environ['S3_BUCKET_REGION'])
         try:
-            file_obj = s3c.get_object(Key=backup_file, Bucket=os.environ.get('S3_BUCKET_BACK'))
+            head = backup_store().head(backup_file)
         except botocore.exceptions.ClientError as err:
-            print(str(err))
+            LOGGER.warning("%s", err)
+            return False
+        if head is None:
+            LOGGER.warning("The object %s does not exist.", backup_file)
             return False
-        age = time.time() - file_obj['LastModified'].timestamp()
+        age = time.time() - head['LastModified'].timestamp()
         if age < MAXIMUM_BACKUP_AGE:
-            print("Succesfully validated Backup file age")
+            LOGGER.info("Succesfully validated Backup file age")
             return True
-        print(f"File age {age} is older than the maximum allowed value of {MAXIMUM_BACKUP_AGE}")
+        LOGGER.warning("File age %s is older than the maximum allowed value of %s", age,
+                       MAXIMUM_BACKUP_AGE)
         return False
     except Exception as err:
-        print(f"Checking backup file age failed due to {str(err)}")
+        LOGGER.warning("Checking backup file age failed due to %s", err)
         return False
 
 
 def verify_backup_file(controller_instanceobj):
     """ Verify if s3 file exists"""
-    print("Verifying Backup file")
+    LOGGER.info("Verifying Backup file")
     try:
-        s3c = boto3.client('s3', region_name=os.environ['S3_BUCKET_REGION'])
         priv_ip = controller_instanceobj['NetworkInterfaces'][0]['PrivateIpAddress']
         version_file = "CloudN_" + priv_ip + "_save_cloudx_version.txt"
         retrieve_controller_version(version_file)
         s3_file = "CloudN_" + priv_ip + "_save_cloudx_config.enc"
         try:
-            with open('/tmp/tmp.enc', 'wb') as data:
-                s3c.download_fileobj(os.environ.get('S3_BUCKET_BACK'), s3_file, data)
+            head = backup_store().head(s3_file)
         except botocore.exceptions.ClientError as err:
-            if err.response['Error']['Code'] == "404":
-                print("The object %s does not exist." % s3_file)
-                return False, ""
-            print(str(err))
+            LOGGER.warning("%s", err)
             return False, ""
+        if head is None:
+            LOGGER.warning("The object %s does not exist.", s3_file)
+            return False, ""
+        LOGGER.info("Backup file %s is %d bytes", s3_file, head['ContentLength'])
     except Exception as err:
-        print("Verify Backup failed %s" % str(err))
+        LOGGER.warning("Verify Backup failed %s", err)
         return False, ""
     else:
         return True, s3_file
@@ -492,77 +2124,67 @@ def verify_backup_file(controller_instanceobj):
 
 def retrieve_controller_version(version_file):
     """ Get the controller version from backup file"""
-    print("Retrieving version from file " + str(version_file))
-    s3c = boto3.client('s3', region_name=os.environ['S3_BUCKET_REGION'])
-    try:
-        with open('/tmp/version_ctrlha.txt', 'wb') as data:
-            s3c.download_fileobj(os.environ.get('S3_BUCKET_BACK'), version_file,
-                                 data)
-    except botocore.exceptions.ClientError as err:
-        if err.response['Error']['Code'] == "404":
-            print("The object does not exist.")
-            raise AvxError("The cloudx version file does not exist") from err
-        raise
-    if not os.path.exists('/tmp/version_ctrlha.txt'):
-        raise AvxError("Unable to open version file")
-    with open("/tmp/version_ctrlha.txt") as fileh:
-        buf = fileh.read()
-    print("Retrieved version " + str(buf))
+    LOGGER.info("Retrieving version from file %s", version_file)
+    body = backup_store().read(version_file)
+    if body is None:
+        LOGGER.warning("The object does not exist.")
+        raise AvxError("The cloudx version file does not exist")
+    buf = body.decode()
+    LOGGER.debug("Retrieved version %s", buf)
+    ctrl_version = parse_controller_version(buf)
+    LOGGER.info("Parsed version sucessfully %s", ctrl_version)
+    return ctrl_version
+
+
+def parse_controller_version(buf):
+    """ Controller version in the content of a version file"""
     if not buf:
         raise AvxError("Version file is empty")
-    print("Parsing version")
     try:
-        ctrl_version = ".".join(((buf[12:]).split("."))[:-1])
+        return ".".join(((buf[12:]).split("."))[:-1])
     except (KeyboardInterrupt, IndexError, ValueError) as err:
         raise AvxError("Could not decode version") from err
-    else:
-        print("Parsed version sucessfully " + str(ctrl_version))
-        return ctrl_version
 
 
-def get_initial_setup_status(ip_addr, cid):
+def get_initial_setup_status(api):
     """ Get status of the initial setup completion execution"""
-    print("Checking initial setup")
-    base_url = "https://" + ip_addr + "/v1/api"
-    post_data = {"CID": cid,
-                 "action": "initial_setup",
+    LOGGER.info("Checking initial setup")
+    post_data = {"action": "initial_setup",
                  "subaction": "check"}
     try:
-        response = requests.post(base_url, data=post_data, verify=False)
-    except requests.exceptions.ConnectionError as err:
-        print(str(err))
+        return api.post(post_data)
+    except transport.ConnectionFailed as err:
+        LOGGER.warning("%s", err)
         return {'return': False, 'reason': str(err)}
-    return response.json()
 
 
-def run_initial_setup(ip_addr, cid, ctrl_version):
-    """ Boots the fresh controller to the specific version"""
-    response_json = get_initial_setup_status(ip_addr, cid)
+def run_initial_setup(api, ctrl_version, started=None):
+    """ Boots the fresh controller to the specific version. started is called once the
+    controller accepted the request"""
+    response_json = get_initial_setup_status(api)
     if response_json.get('return') is True:
-        print("Initial setup is already done. Skipping")
+        LOGGER.info("Initial setup is already done. Skipping")
         return True
-    post_data = {"CID": cid,
-                 "target_version": ctrl_version,
+    post_data = {"target_version": ctrl_version,
                  "action": "initial_setup",
                  "subaction": "run"}
-    print("Trying to run initial setup %s\n" % str(post_data))
-    base_url = "https://" + ip_addr + "/v1/api"
+    LOGGER.info("Trying to run initial setup to version %s", ctrl_version)
     try:
-        response = requests.post(base_url, data=post_data, verify=False)
-    except requests.exceptions.ConnectionError as err:
+        response_json = api.post(post_data)
+    except transport.ConnectionFailed as err:
         if "Remote end closed connection without response" in str(err):
-            print("Server closed the connection while executing initial setup API."
-                  " Ignoring response")
+            LOGGER.warning("Server closed the connection while executing initial setup API."
+                           " Ignoring response")
             response_json = {'return': True, 'reason': 'Warning!! Server closed the connection'}
         else:
             raise AvxError("Failed to execute initial setup: " + str(err)) from err
-    else:
-        response_json = response.json()
         # Controllers running 6.4 and above would be unresponsive after initial_setup
-    print(response_json)
+    LOGGER.debug("%s", response_json)
+    if response_json.get('return') is True and started:
+        started()
     time.sleep(INITIAL_SETUP_API_WAIT)
     if response_json.get('return') is True:
-        print("Successfully initialized the controller")
+        LOGGER.info("Successfully initialized the controller")
     else:
         raise AvxError("Could not bring up the new controller to the "
                        "specific version")
@@ -588,7 +2210,7 @@ def temp_add_security_group_access(client, controller_instanceobj, api_private_a
     except botocore.exceptions.ClientError as err:
         if "InvalidPermission.Duplicate" in str(err):
             return True, sgs[0]
-        print(str(err))
+        LOGGER.error("%s", err)
         raise
     return False, sgs[0]
 
@@ -605,284 +2227,655 @@ def restore_security_group_access(client, sg_id):
                            ])
     except botocore.exceptions.ClientError as err:
         if "InvalidPermission.NotFound" not in str(err) and "InvalidGroup" not in str(err):
-            print(str(err))
+            LOGGER.warning("%s", err)
+
+
+def security_group_holders(sg_id):
+    """ Invocations of TMP_SG_SLOTS relying on the temporary rule of sg_id"""
+    return [slot for slot, (group_key, expires_key) in TMP_SG_SLOTS.items()
+            if os.environ.get(group_key) == sg_id and
+            float(os.environ.get(expires_key) or 0) > time.time()]
+
+
+def hold_security_group(store, slot, sg_id=None):
+    """ Record that the invocation of slot relies on the temporary rule of sg_id, or that it
+    no longer does without sg_id"""
+    group_key, expires_key = TMP_SG_SLOTS[slot]
+    store.update({group_key: sg_id or '',
+                  expires_key: str(int(time.time() + TMP_SG_HOLD)) if sg_id else ''})
 
 
-def handle_login_failure(priv_ip,
-                         client, lambda_client, controller_instanceobj, context,
-                         eip):
+def release_security_group(client, store, sg_id):
+    """ Revert the temporary rule of sg_id unless another invocation still relies on it. The
+    state is read again, the other invocation may have opened it after this one started"""
+    store.load()
+    holders = security_group_holders(sg_id)
+    if holders:
+        LOGGER.info("Not reverting sg %s. The %s in progress relies on it", sg_id, holders[0])
+        return
+    LOGGER.info("Reverting sg %s", sg_id)
+    restore_security_group_access(client, sg_id)
+
+
+def revert_stale_security_groups(client, store):
+    """ Revert the temporary rules of invocations that did not complete"""
+    for slot, (group_key, expires_key) in TMP_SG_SLOTS.items():
+        sg_id = os.environ.get(group_key)
+        if not sg_id:
+            continue
+        if float(os.environ.get(expires_key) or 0) > time.time():
+            LOGGER.info("Security group %s was opened by a %s in progress", sg_id, slot)
+            continue
+        LOGGER.info("Lambda probably did not complete last time. Reverting sg %s", sg_id)
+        hold_security_group(store, slot)
+        store.commit()
+        if not security_group_holders(sg_id):
+            restore_security_group_access(client, sg_id)
+
+
+def login_when_ready(api, max_wait, stop=None):
+    """ Log in as soon as the controller accepts connections, retrying failed logins with
+    backoff. Returns whether the login succeeded within max_wait seconds and before the stop
+    event was set"""
+    start = time.monotonic()
+    delays = backoff_delays()
+    while True:
+        remaining = max_wait - (time.monotonic() - start)
+        if remaining <= 0 or (stop and stop.is_set()):
+            return False
+        ready, _ = wait_for_controller(api.ip_addr, remaining, stop)
+        if not ready:
+            return False
+        try:
+            api.login(switch=False)
+        except Exception as err:  # pylint: disable=broad-except
+            LOGGER.warning("%s", err)
+            delay = next(delays)
+            LOGGER.warning("Login failed, trying again in %.1f", delay)
+            if stop:
+                stop.wait(delay)
+            else:
+                time.sleep(delay)
+        else:
+            return True
+
+
+def controller_api_paths(public_ip, private_ip):
+    """ (name, address) of the paths lambda may reach the controller API through, following
+    API_PRIVATE_ACCESS: True for the private IP, Both for both and the public IP otherwise"""
+    api_private_access = os.environ.get('API_PRIVATE_ACCESS')
+    if api_private_access == "True":
+        paths = [('private', private_ip)]
+    elif api_private_access == "Both":
+        paths = [('public', public_ip), ('private', private_ip)]
+    else:
+        paths = [('public', public_ip)]
+    return [(name, address) for name, address in paths if address]
+
+
+def login_first_path(paths, pwd, max_wait):
+    """ Log in through every (name, address) of paths at once. Returns the client of the
+    first address that logged in, with the client of the other as fallback, and the name of
+    its path. Nobody is logged in when no path answered within max_wait"""
+    apis = [(name, ControllerApiClient(address, "admin", pwd)) for name, address in paths]
+    if len(apis) == 1:
+        login_when_ready(apis[0][1], max_wait)
+        return apis[0][1], apis[0][0]
+    stop = threading.Event()
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(apis))
+    futures = {pool.submit(login_when_ready, api, max_wait, stop): index
+               for index, (_, api) in enumerate(apis)}
+    first = 0
+    try:
+        for future in concurrent.futures.as_completed(futures):
+            if future.result():
+                first = futures[future]
+                break
+    finally:
+        stop.set()
+        # A path that hangs must not hold up the failover
+        pool.shutdown(wait=False)
+    name, api = apis.pop(first)
+    api.fallback = apis[0][1]
+    if api.cid:
+        LOGGER.info("Controller API answered first through the %s IP %s. Keeping %s as fallback",
+                    name, api.ip_addr, api.fallback.ip_addr)
+    return api, name
+
+
+def wait_for_api(api, max_wait):
+    """ Wait for the controller through the address of api and the address of its fallback at
+    once, and switch api to the fallback when it answers first. Returns the seconds waited"""
+    if api.fallback is None:
+        return wait_for_controller(api.ip_addr, max_wait)[1]
+    start = time.monotonic()
+    stop = threading.Event()
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    futures = {pool.submit(wait_for_controller, address, max_wait, stop): address
+               for address in (api.ip_addr, api.fallback.ip_addr)}
+    try:
+        for future in concurrent.futures.as_completed(futures):
+            if future.result()[0]:
+                if futures[future] != api.ip_addr:
+                    api.use_fallback()
+                break
+    finally:
+        stop.set()
+        pool.shutdown(wait=False)
+    return time.monotonic() - start
+
+
+def handle_login_failure(priv_ip, client, store, controller_instanceobj, eip):
     """ Handle login failure through private IP"""
-    print("Checking for backup file")
+    LOGGER.info("Checking for backup file")
     new_version_file = "CloudN_" + priv_ip + "_save_cloudx_version.txt"
     try:
         retrieve_controller_version(new_version_file)
     except Exception as err:
-        print(str(err))
-        print("Could not retrieve new version file. Stopping instance. ASG will terminate and "
-              "launch a new instance")
+        LOGGER.warning("%s", err)
+        LOGGER.warning("Could not retrieve new version file. Stopping instance. ASG will "
+                       "terminate and launch a new instance")
         inst_id = controller_instanceobj['InstanceId']
-        print("Stopping %s" % inst_id)
+        LOGGER.info("Stopping %s", inst_id)
         client.stop_instances(InstanceIds=[inst_id])
     else:
-        print("Successfully retrieved version. Previous restore operation had succeeded. "
-              "Previous lambda may have exceeded 5 min. Updating lambda config")
-        set_environ(client, lambda_client, controller_instanceobj, context, eip)
+        LOGGER.info("Successfully retrieved version. Previous restore operation had succeeded. "
+                    "Previous lambda may have exceeded 5 min. Updating lambda config")
+        set_environ(client, store, controller_instanceobj, eip)
 
 
 def enable_t2_unlimited(client, inst_id):
     """ Modify instance credit to unlimited for T2 """
-    print("Enabling T2 unlimited for %s" % inst_id)
+    LOGGER.info("Enabling T2 unlimited for %s", inst_id)
     try:
         client.modify_instance_credit_specification(ClientToken=inst_id,
                                                     InstanceCreditSpecifications=[{
                                                         'InstanceId': inst_id,
                                                         'CpuCredits': 'unlimited'}])
     except botocore.exceptions.ClientError as err:
-        print(str(err))
+        LOGGER.warning("%s", err)
 
 
-def create_cloud_account(cid, controller_ip, account_name):
+def aws_account_number():
+    """ Account number of the lambda"""
+    return aws_client('sts').get_caller_identity()["Account"]
+
+
+def create_cloud_account(api, account_name, aws_acc_num=None):
     """ Create a temporary account to restore the backup"""
-    print("Creating temporary account")
-    client = boto3.client('sts')
-    aws_acc_num = client.get_caller_identity()["Account"]
-    base_url = "https://%s/v1/api" % controller_ip
-    post_data = {"CID": cid,
-                 "action": "setup_account_profile",
+    LOGGER.info("Creating temporary account")
+    if aws_acc_num is None:
+        aws_acc_num = aws_account_number()
+    post_data = {"action": "setup_account_profile",
                  "account_name": account_name,
                  "aws_account_number": aws_acc_num,
                  "aws_role_arn": "arn:aws:iam::%s:role/aviatrix-role-app" % aws_acc_num,
                  "aws_role_ec2": "arn:aws:iam::%s:role/aviatrix-role-ec2" % aws_acc_num,
                  "cloud_type": 1,
                  "aws_iam": "true"}
-    print("Trying to create account with data %s\n" % str(post_data))
+    LOGGER.debug("Trying to create account with data %s", post_data)
     try:
-        response = requests.post(base_url, data=post_data, verify=False)
-    except requests.exceptions.ConnectionError as err:
+        output = api.post(post_data)
+    except transport.ConnectionFailed as err:
         if "Remote end closed connection without response" in str(err):
-            print("Server closed the connection while executing create account API."
-                  " Ignoring response")
+            LOGGER.warning("Server closed the connection while executing create account API."
+                           " Ignoring response")
             output = {"return": True, 'reason': 'Warning!! Server closed the connection'}
             time.sleep(INITIAL_SETUP_DELAY)
         else:
             output = {"return": False, "reason": str(err)}
-    else:
-        output = response.json()
 
     return output
 
 
-def restore_backup(cid, controller_ip, s3_file, account_name):
+def restore_backup(api, s3_file, account_name):
     """ Restore backup from the s3 bucket"""
     restore_data = {
-        "CID": cid,
         "action": "restore_cloudx_config",
         "cloud_type": "1",
         "account_name": account_name,
         "file_name": s3_file,
         "bucket_name": os.environ.get('S3_BUCKET_BACK')}
-    print("Trying to restore config with data %s\n" % str(restore_data))
-    base_url = "https://" + controller_ip + "/v1/api"
+    LOGGER.info("Trying to restore config from %s", s3_file)
+    LOGGER.debug("Restore data %s", restore_data)
     try:
-        response = requests.post(base_url, data=restore_data, verify=False)
-    except requests.exceptions.ConnectionError as err:
+        response_json = api.post(restore_data)
+    except transport.ConnectionFailed as err:
         if "Remote end closed connection without response" in str(err):
-            print("Server closed the connection while executing restore_cloudx_config API."
-                  " Ignoring response")
+            LOGGER.warning("Server closed the connection while executing restore_cloudx_config"
+                           " API. Ignoring response")
             response_json = {"return": True, 'reason': 'Warning!! Server closed the connection'}
         else:
-            print(str(err))
+            LOGGER.warning("%s", err)
             response_json = {"return": False, "reason": str(err)}
-    else:
-        response_json = response.json()
 
     return response_json
 
 
-def set_customer_id(cid, controller_api_ip):
+def set_customer_id(api):
     """ Set the customer ID if set in environment to migrate to a different AMI type"""
-    print("Setting up Customer ID")
-    base_url = "https://" + controller_api_ip + "/v1/api"
-    post_data = {"CID": cid,
-                 "action": "setup_customer_id",
+    LOGGER.info("Setting up Customer ID")
+    post_data = {"action": "setup_customer_id",
                  "customer_id": os.environ.get("CUSTOMER_ID")}
     try:
-        response = requests.post(base_url, data=post_data, verify=False)
-    except requests.exceptions.ConnectionError as err:
+        response_json = api.post(post_data)
+    except transport.ConnectionFailed as err:
         if "Remote end closed connection without response" in str(err):
-            print("Server closed the connection while executing setup_customer_id API."
-                  " Ignoring response")
+            LOGGER.warning("Server closed the connection while executing setup_customer_id API."
+                           " Ignoring response")
             response_json = {"return": True, 'reason': 'Warning!! Server closed the connection'}
             time.sleep(WAIT_DELAY)
         else:
             response_json = {"return": False, "reason": str(err)}
-    else:
-        response_json = response.json()
 
     if response_json.get('return') is True:
-        print("Customer ID successfully programmed")
+        LOGGER.info("Customer ID successfully programmed")
     else:
-        print("Customer ID programming failed. DB restore will fail: " +
-              response_json.get('reason', ""))
+        LOGGER.error("Customer ID programming failed. DB restore will fail: %s",
+                     response_json.get('reason', ""))
+
+
+class RestorePrefetch:
+    """ Inputs of the restore that do not need the new controller: the version file, the
+    account number, the backup metadata and its integrity, and the T2 unlimited change. They
+    are fetched in the background while the new instance boots and joined when needed"""
+
+    def __init__(self, client, controller_instanceobj, priv_ip, timeline):
+        self.timeline = timeline
+        self.stop = threading.Event()
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=5)
+        self.futures = {}
+        self._submit('backup', self._select_backup, priv_ip)
+        self._submit('version', self._version, priv_ip)
+        self._submit('account', aws_account_number)
+        self._submit('integrity', self._verify_backup)
+        self._submit('t2_unlimited', enable_t2_unlimited, client,
+                     controller_instanceobj['InstanceId'])
+
+    def _submit(self, name, function, *args):
+        def timed():
+            with self.timeline.phase('prefetch_' + name):
+                return function(*args)
+        self.futures[name] = self.pool.submit(timed)
+
+    @staticmethod
+    def _select_backup(priv_ip):
+        return promote_backup(select_backup(priv_ip))
+
+    def _version(self, priv_ip):
+        # The version file may be replaced along with the backup
+        self.futures['backup'].exception()
+        return retrieve_controller_version("CloudN_" + priv_ip + "_save_cloudx_version.txt")
+
+    def _verify_backup(self):
+        backup = self.result('backup')
+        if not backup:
+            return False, "There is no backup to verify"
+        return verify_backup_integrity(backup, self.stop)
+
+    def result(self, name):
+        """ Wait for a prefetched value. Raises what its lookup raised"""
+        return self.futures[name].result()
+
+    def close(self):
+        """ Stop reading the backup and wait for the other lookups, including the ones nobody
+        asked for"""
+        self.stop.set()
+        self.pool.shutdown(wait=True)
+
+
+class FailoverCheckpoint:
+    """ Last step of FAILOVER_STEPS reached by the HA event of an instance, kept in the
+    state so that a later invocation for the same instance can resume after it"""
+
+    def __init__(self, store, inst_id):
+        self.store = store
+        self.inst_id = inst_id
+        self.step = ''
+        if os.environ.get('FAILOVER_INST_ID') == inst_id:
+            self.step = os.environ.get('FAILOVER_STEP', '')
+        if self.step:
+            LOGGER.info("Resuming the HA event of %s after %s", inst_id, self.step)
+
+    def reached(self, step):
+        """ Whether step was already done for the instance"""
+        return self.step in FAILOVER_STEPS and \
+            FAILOVER_STEPS.index(self.step) >= FAILOVER_STEPS.index(step)
+
+    def save(self, step, commit=True):
+        """ Record that step is done. Without commit, it is written with the next commit"""
+        self.step = step
+        self.store.update({'FAILOVER_INST_ID': self.inst_id, 'FAILOVER_STEP': step})
+        if commit:
+            self.store.commit()
+
+    def clear(self):
+        """ Forget the steps once the event is handled"""
+        self.step = ''
+        self.store.update({'FAILOVER_INST_ID': '', 'FAILOVER_STEP': ''})
+
+
+class Continuation:
+    """ Hands an HA event over to a new invocation of the lambda before this one times
+    out. The new invocation gets the same event and resumes from the checkpoint"""
+
+    def __init__(self, context, event):
+        self.context = context
+        self.event = event
+        self.handed_over = False
+
+    def remaining(self):
+        """ Seconds left before the hand over is due"""
+        return self.context.get_remaining_time_in_millis() / 1000 - CONTINUATION_MARGIN
+
+    def due(self):
+        """ Whether the event has to be handed over now"""
+        return self.remaining() <= 0
+
+    def hand_over(self):
+        """ Invoke the lambda asynchronously with the event"""
+        count = self.event.get('Continuation', 0) + 1
+        if count > MAX_CONTINUATIONS:
+            raise AvxError("HA event was not handled after %d continuations" %
+                           MAX_CONTINUATIONS)
+        LOGGER.info("Handing the HA event over to continuation %d", count)
+        aws_client('lambda').invoke(FunctionName=self.context.function_name,
+                                    InvocationType='Event',
+                                    Payload=json.dumps(dict(self.event, Continuation=count)))
+        self.handed_over = True
+
+
+class NoContinuation:
+    """ Continuation of an event handled without a time limit"""
+
+    @staticmethod
+    def remaining():
+        """ Seconds left before the hand over is due"""
+        return float('inf')
+
+    @staticmethod
+    def due():
+        """ Whether the event has to be handed over now"""
+        return False
 
+    @staticmethod
+    def hand_over():
+        """ Never called"""
+        raise AvxError("HA event cannot be handed over")
 
-def handle_ha_event(client, lambda_client, controller_instanceobj, context):
+
+def handle_ha_event(client, store, controller_instanceobj, timeline, continuation=None):
+    """ Restores the backup of the controller saved in the state to the newly launched
+    instance. Lookups that do not need the new controller start right away"""
+    old_inst_id = os.environ.get('INST_ID')
+    if old_inst_id == controller_instanceobj['InstanceId']:
+        LOGGER.info("Controller is already saved. Not restoring")
+        timeline.outcome = 'skipped'
+        return
+    prefetch = RestorePrefetch(client, controller_instanceobj, os.environ.get('PRIV_IP'),
+                               timeline)
+    try:
+        restore_controller(client, store, controller_instanceobj, timeline, prefetch,
+                           continuation or NoContinuation())
+    finally:
+        prefetch.close()
+
+
+def restore_controller(client, store, controller_instanceobj, timeline, prefetch,
+                       continuation):
     """ Restores the backup by doing the following
     1. Login to new controller
     2. Assign the EIP to the new controller
     3. Run initial setup to boot to specific version parsed from backup
-    4. Login again and restore the configuration """
-    old_inst_id = os.environ.get('INST_ID')
-    if old_inst_id == controller_instanceobj['InstanceId']:
-        print("Controller is already saved. Not restoring")
-        return
-    if not assign_eip(client, controller_instanceobj, os.environ.get('EIP')):
-        raise AvxError("Could not assign EIP")
+    4. Login again and restore the configuration
+    Each phase is recorded in timeline. Every step reached is checkpointed in the state, and
+    the steps already done for the instance are skipped. When the lambda is about to time
+    out, the event is handed over to a continuation invocation"""
+    checkpoint = FailoverCheckpoint(store, controller_instanceobj['InstanceId'])
+    if not checkpoint.reached('eip_assigned'):
+        with timeline.phase('assign_eip'):
+            eip_assigned = assign_eip(client, controller_instanceobj, os.environ.get('EIP'))
+        if not eip_assigned:
+            raise AvxError("Could not assign EIP")
+        store.update({'EIP_ALLOC_ID': eip_allocation_id(client, os.environ.get('EIP'))})
+        checkpoint.save('eip_assigned', commit=False)
     eip = os.environ.get('EIP')
+    if checkpoint.reached('restore_done'):
+        LOGGER.info("Backup was restored by a previous invocation. Updating lambda configuration")
+        finish_restore(client, store, controller_instanceobj, eip, checkpoint)
+        store.commit()
+        timeline.outcome = 'success'
+        return
     api_private_access = os.environ.get('API_PRIVATE_ACCESS')
     new_private_ip = controller_instanceobj.get(
         'NetworkInterfaces')[0].get('PrivateIpAddress')
-    print("New Private IP " + str(new_private_ip))
-    if api_private_access == "True":
-        controller_api_ip = new_private_ip
-        print("API Access to Controller will use Private IP : " + str(controller_api_ip))
-    else:
-        controller_api_ip = eip
-        print("API Access to Controller will use Public IP : " + str(controller_api_ip))
-
-    threading.Thread(target=enable_t2_unlimited,
-                     args=[client, controller_instanceobj['InstanceId']]).start()
-    duplicate, sg_modified = temp_add_security_group_access(client, controller_instanceobj,
-                                                            api_private_access)
-    print("0.0.0.0:443/0 rule is %s present %s" %
-          ("already" if duplicate else "not",
-           "" if duplicate else ". Modified Security group %s" % sg_modified))
-
-    priv_ip = os.environ.get('PRIV_IP')  # This private IP belongs to older terminated instance
-    s3_file = "CloudN_" + priv_ip + "_save_cloudx_config.enc"
-
-    if not is_backup_file_is_recent(s3_file):
+    LOGGER.info("New Private IP %s", new_private_ip)
+    api_paths = controller_api_paths(eip, new_private_ip)
+    LOGGER.info("API Access to Controller will use %s", " or ".join(
+        "%s IP : %s" % (name.capitalize(), address) for name, address in api_paths))
+
+    with timeline.phase('sg_change'):
+        duplicate, sg_modified = temp_add_security_group_access(client, controller_instanceobj,
+                                                                api_private_access)
+    LOGGER.info("0.0.0.0:443/0 rule is %s present %s", "already" if duplicate else "not",
+                "" if duplicate else ". Modified Security group %s" % sg_modified)
+    # A rule opened by the set up of a standby is held too, so that it is not reverted under
+    # this failover
+    held = not duplicate or bool(security_group_holders(sg_modified))
+
+    with timeline.phase('backup_check'):
+        backup = prefetch.result('backup')
+    if not backup:
         raise AvxError(f"HA event failed. Backup file does not exist or is older"
                        f" than {MAXIMUM_BACKUP_AGE}")
 
     try:
-        if not duplicate:
-            update_env_dict(lambda_client, context, {'TMP_SG_GRP': sg_modified})
-        total_time = 0
-        while total_time <= MAX_LOGIN_TIMEOUT:
-            try:
-                cid = login_to_controller(controller_api_ip, "admin", new_private_ip)
-            except Exception as err:
-                print(str(err))
-                print("Login failed, trying again in " + str(WAIT_DELAY))
-                total_time += WAIT_DELAY
-                time.sleep(WAIT_DELAY)
-            else:
-                break
-        if total_time >= MAX_LOGIN_TIMEOUT:
-            print("Could not login to the controller. Attempting to handle login failure")
-            handle_login_failure(controller_api_ip, client, lambda_client, controller_instanceobj,
-                                 context, eip)
+        if held:
+            hold_security_group(store, 'failover', sg_modified)
+        if not checkpoint.reached('sg_opened'):
+            checkpoint.save('sg_opened', commit=False)
+        store.commit()
+        login_start = time.monotonic()
+        api, api_path = login_first_path(api_paths, new_private_ip,
+                                         min(MAX_LOGIN_TIMEOUT, continuation.remaining()))
+        timeline.record('first_login', login_start, time.monotonic(),
+                        'ok' if api.cid else 'error')
+        if api.cid:
+            timeline.attributes['api_path'] = api_path
+        LOGGER.info("Waited %.1fs for the first login", time.monotonic() - login_start)
+        if api.cid is None and continuation.due():
+            continuation.hand_over()
+            timeline.outcome = 'continued'
+            return
+        if api.cid is None and checkpoint.reached('initial_setup_started'):
+            # Stopping it would throw away the initial setup
+            raise AvxError("Could not login to the controller after %s. Not stopping it" %
+                           checkpoint.step)
+        if api.cid is None:
+            LOGGER.warning("Could not login to the controller. Attempting to handle login failure")
+            handle_login_failure(api.ip_addr, client, store, controller_instanceobj, eip)
+            # The instance is stopped and replaced, or was restored already
+            checkpoint.clear()
+            timeline.outcome = 'login_failed'
             return
 
-        version_file = "CloudN_" + priv_ip + "_save_cloudx_version.txt"
-        ctrl_version = retrieve_controller_version(version_file)
+        with timeline.phase('integrity_check'):
+            intact, reason = prefetch.result('integrity')
+        LOGGER.info("%s", reason)
+        if not intact:
+            raise AvxError("HA event failed. The backup is damaged: " + reason)
+
+        ctrl_version = prefetch.result('version')
+        if os.environ.get('WARM_INST_ID') == controller_instanceobj['InstanceId']:
+            LOGGER.info("Instance is the standby from the warm pool, set up for version %s",
+                        os.environ.get('WARM_VERSION'))
+            if os.environ.get('WARM_VERSION') != ctrl_version:
+                # Initial setup does not run again on it. The ASG replaces it with a new
+                # instance, which is set up to the version of the backup
+                LOGGER.warning("The backup is of version %s. Replacing the standby",
+                               ctrl_version)
+                store.update({'WARM_INST_ID': '', 'WARM_VERSION': ''})
+                checkpoint.clear()
+                aws_client('autoscaling').set_instance_health(
+                    InstanceId=controller_instanceobj['InstanceId'], HealthStatus='Unhealthy',
+                    ShouldRespectGracePeriod=False)
+                timeline.outcome = 'standby_outdated'
+                return
 
-        initial_setup_complete = run_initial_setup(controller_api_ip, cid, ctrl_version)
+        if checkpoint.reached('initial_setup_started'):
+            initial_setup_complete = checkpoint.reached('initial_setup_done')
+            LOGGER.info("Initial setup was started by a previous invocation")
+        else:
+            with timeline.phase('run_initial_setup'):
+                initial_setup_complete = run_initial_setup(
+                    api, ctrl_version, lambda: checkpoint.save('initial_setup_started'))
+            if initial_setup_complete:
+                checkpoint.save('initial_setup_done')
+        setup_poll_start = time.monotonic()
 
         temp_acc_name = "tempacc"
 
         total_time = 0
         sleep = False
-        created_temp_acc = False
+        created_temp_acc = checkpoint.reached('account_created')
         login_complete = False
         response_json = {}
+        delays = backoff_delays()
         while total_time <= INITIAL_SETUP_WAIT:
+            if continuation.due():
+                continuation.hand_over()
+                timeline.outcome = 'continued'
+                return
             if sleep:
-                print("Waiting for safe initial setup completion, maximum of " +
-                      str(INITIAL_SETUP_WAIT - total_time) + " seconds remaining")
-                time.sleep(WAIT_DELAY)
+                delay = min(next(delays), INITIAL_SETUP_WAIT - total_time)
+                LOGGER.info("Waiting %.1fs for safe initial setup completion, maximum of %.1f "
+                            "seconds remaining", delay, INITIAL_SETUP_WAIT - total_time)
+                time.sleep(delay)
+                total_time += delay
             else:
-                print(f"{INITIAL_SETUP_WAIT - total_time} seconds remaining")
+                LOGGER.info("%.1f seconds remaining", INITIAL_SETUP_WAIT - total_time)
                 sleep = True
             if not login_complete:
                 # Need to login again as initial setup invalidates cid after waiting
-                print("Logging in again")
+                LOGGER.info("Logging in again")
                 try:
-                    cid = login_to_controller(controller_api_ip, "admin", new_private_ip)
+                    api.login()
                 except AvxError:  # It might not succeed since apache2 could restart
-                    print("Cannot connect to the controller")
+                    LOGGER.warning("Cannot connect to the controller")
                     sleep = False
-                    time.sleep(INITIAL_SETUP_DELAY)
-                    total_time += INITIAL_SETUP_DELAY
+                    total_time += wait_for_api(api, INITIAL_SETUP_WAIT - total_time)
                     continue
                 else:
                     login_complete = True
+                    delays = backoff_delays()
             if not initial_setup_complete:
-                response_json = get_initial_setup_status(controller_api_ip, cid)
-                print("Initial setup status %s" % response_json)
+                response_json = get_initial_setup_status(api)
+                LOGGER.debug("Initial setup status %s", response_json)
                 if response_json.get('return', False) is True:
                     initial_setup_complete = True
+                    timeline.record('initial_setup_poll', setup_poll_start, time.monotonic())
+                    checkpoint.save('initial_setup_done')
             if initial_setup_complete and not created_temp_acc:
-                response_json = create_cloud_account(cid, controller_api_ip, temp_acc_name)
-                print(response_json)
+                with timeline.phase('temp_account'):
+                    response_json = create_cloud_account(api, temp_acc_name,
+                                                         prefetch.result('account'))
+                LOGGER.debug("%s", response_json)
                 if response_json.get('return', False) is True:
                     created_temp_acc = True
                 elif "already exists" in response_json.get('reason', ''):
                     created_temp_acc = True
+                if created_temp_acc:
+                    checkpoint.save('account_created', commit=False)
             if created_temp_acc and initial_setup_complete:
                 if os.environ.get("CUSTOMER_ID"):  # Support for license migration scenario
-                    set_customer_id(cid, controller_api_ip)
-                response_json = restore_backup(cid, controller_api_ip, s3_file, temp_acc_name)
-                print(response_json)
+                    set_customer_id(api)
+                if not checkpoint.reached('restore_submitted'):
+                    checkpoint.save('restore_submitted')
+                with timeline.phase('restore_backup'):
+                    response_json = restore_backup(api, backup['key'], temp_acc_name)
+                LOGGER.debug("%s", response_json)
             if response_json.get('return', False) is True and created_temp_acc:
                 # If restore succeeded, update private IP to that of the new
                 #  instance now.
-                print("Successfully restored backup. Updating lambda configuration")
-                set_environ(client, lambda_client, controller_instanceobj, context, eip)
-                print("Updated lambda configuration")
-                print("Controller HA event has been successfully handled")
+                LOGGER.info("Successfully restored backup. Updating lambda configuration")
+                checkpoint.save('restore_done')
+                with timeline.phase('set_environ'):
+                    finish_restore(client, store, controller_instanceobj, eip, checkpoint)
+                LOGGER.info("Updated lambda configuration")
+                LOGGER.info("Controller HA event has been successfully handled")
+                timeline.outcome = 'success'
                 return
             if response_json.get('reason', '') == 'account_password required.':
-                print("API is not ready yet, requires account_password")
-                total_time += WAIT_DELAY
+                LOGGER.info("API is not ready yet, requires account_password")
             elif response_json.get('reason', '') == 'valid action required':
-                print("API is not ready yet")
-                total_time += WAIT_DELAY
-            elif response_json.get('reason', '') == 'CID is invalid or expired.' or \
-                    "Invalid session. Please login again." in response_json.get('reason', '') or\
-                    f"Session {cid} not found" in response_json.get('reason', '') or \
-                    f"Session {cid} expired" in response_json.get('reason', ''):
-                print("Service abrupty restarted")
+                LOGGER.info("API is not ready yet")
+            elif api.is_session_expired(response_json.get('reason', '')):
+                LOGGER.info("Service abrupty restarted")
                 sleep = False
                 try:
-                    cid = login_to_controller(controller_api_ip, "admin", new_private_ip)
+                    api.login()
                 except AvxError:
                     pass
             elif response_json.get('reason', '') == 'not run':
-                print('Initial setup not complete..waiting')
-                time.sleep(INITIAL_SETUP_DELAY)
-                total_time += INITIAL_SETUP_DELAY
-                sleep = False
+                LOGGER.info('Initial setup not complete..waiting')
             elif 'Remote end closed connection without response' in response_json.get('reason', ''):
-                print('Remote side closed the connection..waiting')
-                time.sleep(INITIAL_SETUP_DELAY)
-                total_time += INITIAL_SETUP_DELAY
+                LOGGER.info('Remote side closed the connection..waiting')
+                sleep = False
+                total_time += wait_for_api(api, INITIAL_SETUP_WAIT - total_time)
+            elif "Failed to establish a new connection" in response_json.get('reason', ''):
+                LOGGER.warning('Failed to connect to the controller')
                 sleep = False
-            elif "Failed to establish a new connection" in response_json.get('reason', '')\
-                    or "Max retries exceeded with url" in response_json.get('reason', ''):
-                print('Failed to connect to the controller')
-                total_time += WAIT_DELAY
+                total_time += wait_for_api(api, INITIAL_SETUP_WAIT - total_time)
             else:
-                print("Restoring backup failed due to " +
-                      str(response_json.get('reason', '')))
+                LOGGER.error("Restoring backup failed due to %s", response_json.get('reason', ''))
+                checkpoint.clear()
+                timeline.outcome = 'restore_failed'
                 return
         raise AvxError("Restore failed, did not update lambda config")
     finally:
-        if not duplicate:
-            print("Reverting sg %s" % sg_modified)
-            update_env_dict(lambda_client, context, {'TMP_SG_GRP': ''})
-            restore_security_group_access(client, sg_modified)
+        if held:
+            hold_security_group(store, 'failover')
+        with timeline.phase('commit_state'):
+            store.commit()
+        if held:
+            release_security_group(client, store, sg_modified)
+
+
+def finish_restore(client, store, controller_instanceobj, eip, checkpoint):
+    """ Save the restored instance as the controller and forget the checkpoint"""
+    set_environ(client, store, controller_instanceobj, eip)
+    checkpoint.clear()
+    if os.environ.get('WARM_INST_ID') == controller_instanceobj['InstanceId']:
+        # The standby was used up. The ASG launches the next one
+        store.update({'WARM_INST_ID': '', 'WARM_VERSION': ''})
+    if os.environ.get('HEALTH_WINDOW'):
+        # Failed probes of the previous instance do not count against this one
+        store.update({'HEALTH_WINDOW': ''})
+
+
+_EIP_ALLOCATIONS = {}
+
+
+def eip_allocation_id(client, eip, refresh=False):
+    """ Allocation ID of the EIP. Memoized and saved in the state as EIP_ALLOC_ID, so that
+    failovers do not describe the addresses"""
+    if not refresh:
+        if eip in _EIP_ALLOCATIONS:
+            return _EIP_ALLOCATIONS[eip]
+        if eip == os.environ.get('EIP') and os.environ.get('EIP_ALLOC_ID'):
+            return os.environ['EIP_ALLOC_ID']
+    _EIP_ALLOCATIONS[eip] = client.describe_addresses(
+        PublicIps=[eip]).get('Addresses')[0].get('AllocationId')
+    return _EIP_ALLOCATIONS[eip]
+
+
+def describe_volumes(client, volume_ids):
+    """ Volumes by ID, described in one paginated request"""
+    if not volume_ids:
+        return {}
+    paginator = client.get_paginator('describe_volumes')
+    return {volume['VolumeId']: volume for page in paginator.paginate(VolumeIds=volume_ids)
+            for volume in page['Volumes']}
 
 
 def assign_eip(client, controller_instanceobj, eip):
@@ -892,90 +2885,73 @@ def assign_eip(client, controller_instanceobj, eip):
         if eip is None:
             cf_req = True
             eip = controller_instanceobj['NetworkInterfaces'][0]['Association'].get('PublicIp')
-        eip_alloc_id = client.describe_addresses(
-            PublicIps=[eip]).get('Addresses')[0].get('AllocationId')
-        client.associate_address(AllocationId=eip_alloc_id,
-                                 InstanceId=controller_instanceobj['InstanceId'])
+        try:
+            client.associate_address(AllocationId=eip_allocation_id(client, eip),
+                                     InstanceId=controller_instanceobj['InstanceId'])
+        except botocore.exceptions.ClientError as err:
+            if client_error_code(err) != 'InvalidAllocationID.NotFound':
+                raise
+            # The EIP was released and allocated again since its ID was saved
+            client.associate_address(AllocationId=eip_allocation_id(client, eip, refresh=True),
+                                     InstanceId=controller_instanceobj['InstanceId'])
     except Exception as err:
         if cf_req and "InvalidAddress.NotFound" in str(err):
-            print("EIP %s was not found. Please attach an EIP to the controller before enabling HA"
-                  % eip)
+            LOGGER.error("EIP %s was not found. Please attach an EIP to the controller before "
+                         "enabling HA", eip)
             return False
-        print("Failed in assigning EIP %s" % str(err))
+        LOGGER.warning("Failed in assigning EIP %s", err)
         return False
     else:
-        print("Assigned/verified elastic IP")
+        LOGGER.info("Assigned/verified elastic IP")
         return True
 
 
 def validate_keypair(key_name):
     """ Validates Keypairs"""
+    client = aws_client('ec2')
     try:
-        client = boto3.client('ec2')
-        response = client.describe_key_pairs()
+        client.describe_key_pairs(KeyNames=[key_name])
     except botocore.exceptions.ClientError as err:
-        raise AvxError(str(err)) from err
-    key_aws_list = [key['KeyName'] for key in response['KeyPairs']]
-    if key_name not in key_aws_list:
-        print("Key does not exist. Creating")
+        if client_error_code(err) != 'InvalidKeyPair.NotFound':
+            raise AvxError(str(err)) from err
+        LOGGER.warning("Key does not exist. Creating")
         try:
-            client = boto3.client('ec2')
             client.create_key_pair(KeyName=key_name)
         except botocore.exceptions.ClientError as err:
             raise AvxError(str(err)) from err
     else:
-        print("Key exists")
+        LOGGER.info("Key exists")
 
 
 def validate_subnets(subnet_list):
     """ Validates subnets"""
     vpc_id = os.environ.get('VPC_ID')
     if not vpc_id:
-        print("New creation. Assuming subnets are valid as selected from CFT")
+        LOGGER.info("New creation. Assuming subnets are valid as selected from CFT")
         return ",".join(subnet_list)
+    ctrl_subnet = os.environ.get('CTRL_SUBNET')
+    subnet_ids = sorted({sub.strip() for sub in subnet_list} | ({ctrl_subnet} - {None, ''}))
     try:
-        client = boto3.client('ec2')
-        response = client.describe_subnets(Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}])
+        paginator = aws_client('ec2').get_paginator('describe_subnets')
+        sub_aws_list = {sub['SubnetId'] for page in paginator.paginate(
+            Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]},
+                     {'Name': 'subnet-id', 'Values': subnet_ids}])
+                        for sub in page['Subnets']}
     except botocore.exceptions.ClientError as err:
         raise AvxError(str(err)) from err
-    sub_aws_list = [sub['SubnetId'] for sub in response['Subnets']]
     sub_list_new = [sub for sub in subnet_list if sub.strip() in sub_aws_list]
     if not sub_list_new:
-        ctrl_subnet = os.environ.get('CTRL_SUBNET')
         if ctrl_subnet not in sub_aws_list:
-            raise AvxError("All subnets %s or controller subnet %s are not found in vpc %s")
-        print("All subnets are invalid. Using existing controller subnet")
+            raise AvxError("All subnets %s or controller subnet %s are not found in vpc %s"
+                           % (subnet_list, ctrl_subnet, vpc_id))
+        LOGGER.warning("All subnets are invalid. Using existing controller subnet")
         return ctrl_subnet
     return ",".join(sub_list_new)
 
 
-def setup_ha(ami_id, inst_type, inst_id, key_name, sg_list, context,
-             attach_instance=True):
-    """ Setup HA """
-    print("HA config ami_id %s, inst_type %s, inst_id %s, key_name %s, sg_list %s, "
-          "attach_instance %s" % (ami_id, inst_type, inst_id, key_name, sg_list, attach_instance))
-    lc_name = asg_name = sns_topic = os.environ.get('AVIATRIX_TAG')
-    # AMI_NAME = LC_NAME
-    # ami_id = client.describe_images(
-    #     Filters=[{'Name': 'name','Values':
-    #  [AMI_NAME]}],Owners=['self'])['Images'][0]['ImageId']
-    asg_client = boto3.client('autoscaling')
-    sub_list = os.environ.get('SUBNETLIST')
-    val_subnets = validate_subnets(sub_list.split(","))
-    print("Valid subnets %s" % val_subnets)
-    if key_name:
-        validate_keypair(key_name)
+def launch_template_data(ami_id, inst_type, key_name, sg_list):
+    """ Launch template data of the controller, from the environment set by set_environ"""
     bld_map = []
-    try:
-        tags = json.loads(os.environ.get('TAGS'))
-    except ValueError:
-        tags = [{'Key': 'Name', 'Value': asg_name, 'PropagateAtLaunch': True}]
-    else:
-        if not tags:
-            tags = [{'Key': 'Name', 'Value': asg_name, 'PropagateAtLaunch': True}]
-        for tag in tags:
-            tag['PropagateAtLaunch'] = True
-
     disks = json.loads(os.environ.get('DISKS'))
     if disks:
         for disk in disks:
@@ -991,160 +2967,540 @@ def setup_ha(ami_id, inst_type, inst_id, key_name, sg_list, context,
             bld_map.append(disk_config)
 
     if not bld_map:
-        print("bld map is empty")
+        LOGGER.info("bld map is empty")
         raise AvxError("Could not find any disks attached to the controller")
 
-    if inst_id:
-        print("Setting launch config from instance")
-        asg_client.create_launch_configuration(
-            LaunchConfigurationName=lc_name,
-            ImageId=ami_id,
-            InstanceId=inst_id,
-            BlockDeviceMappings=bld_map,
-            UserData="# Ignore"
-        )
-    else:
-        print("Setting launch config from environment")
-        iam_arn = os.environ.get('IAM_ARN')
-        monitoring = os.environ.get('MONITORING', 'disabled') == 'enabled'
-
-        kw_args = {
-            "LaunchConfigurationName": lc_name,
-            "ImageId": ami_id,
-            "InstanceType": inst_type,
-            "SecurityGroups": sg_list,
-            "KeyName": key_name,
-            "AssociatePublicIpAddress": True,
-            "InstanceMonitoring": {"Enabled": monitoring},
-            "BlockDeviceMappings": bld_map,
-            "UserData": "# Ignore",
-            "IamInstanceProfile": iam_arn,
-        }
-        if not key_name:
-            del kw_args["KeyName"]
-        if not iam_arn:
-            del kw_args["IamInstanceProfile"]
-        if not bld_map:
-            del kw_args["BlockDeviceMappings"]
-        asg_client.create_launch_configuration(**kw_args)
-    tries = 0
-    while tries < 3:
+    data = {
+        "ImageId": ami_id,
+        "InstanceType": inst_type,
+        "KeyName": key_name,
+        "NetworkInterfaces": [{"DeviceIndex": 0,
+                               "AssociatePublicIpAddress": True,
+                               "DeleteOnTermination": True,
+                               "Groups": sg_list}],
+        "Monitoring": {"Enabled": os.environ.get('MONITORING', 'disabled') == 'enabled'},
+        "BlockDeviceMappings": bld_map,
+        "UserData": base64.b64encode(b"# Ignore").decode(),
+        "IamInstanceProfile": {"Arn": os.environ.get('IAM_ARN')},
+    }
+    if not key_name:
+        del data["KeyName"]
+    if not os.environ.get('IAM_ARN'):
+        del data["IamInstanceProfile"]
+    return data
+
+
+def client_error_code(err):
+    """ Error code of a botocore ClientError"""
+    return err.response.get('Error', {}).get('Code', '')
+
+
+def asg_waiter(waiter_name):
+    """ Autoscaling waiter of ASG_WAITER_MODEL, which botocore does not define"""
+    return botocore.waiter.create_waiter_with_client(
+        waiter_name, botocore.waiter.WaiterModel(ASG_WAITER_MODEL), aws_client('autoscaling'))
+
+
+def sns_source_arn(statement):
+    """ SourceArn condition of a lambda policy statement, None without one"""
+    return statement.get('Condition', {}).get('ArnLike', {}).get('AWS:SourceArn')
+
+
+class HaResources:
+    """ Resources set up for HA of a controller, all named after it: the ASG with its launch
+    template, notification configuration and warm pool, the SNS topic with its subscriptions
+    and the permission of the topic to invoke the lambda. read() gets their state in one
+    parallel pass, after which reconcile() and teardown() only make the calls that change
+    something, in parallel where they do not depend on each other"""
+
+    def __init__(self, name, function_name):
+        self.name = name
+        self.function_name = function_name
+        self.statement_id = re.sub(r'[^a-zA-Z0-9_-]', '-', name)[:90] + '-sns'
+        self.asg = None
+        self.launch_template = None
+        self.notifications = set()
+        self.warm_pool = None
+        self.hooks = []
+        self.topic_arn = None
+        self.subscriptions = []
+        self.function_arn = None
+        self.statements = []
+        self._desired = {}
+
+    def read(self, full=True):
+        """ Read the current state. Without full, only what teardown() needs. Returns self"""
+        reads = [('read_asg', self._read_asg, []),
+                 ('read_launch_template', self._read_launch_template, []),
+                 ('read_topic', self._read_topic, []),
+                 ('read_policy', self._read_policy, [])]
+        if full:
+            reads += [('read_notifications', self._read_notifications, []),
+                      ('read_warm_pool', self._read_warm_pool, ['read_asg']),
+                      ('read_subscriptions', self._read_subscriptions, ['read_topic']),
+                      ('read_function', self._read_function, [])]
+        _, failures = run_checks(reads)
+        if failures:
+            raise AvxError("Could not read the HA resources. %s" % "; ".join(failures))
+        return self
+
+    def _read_asg(self):
+        groups = aws_client('autoscaling').describe_auto_scaling_groups(
+            AutoScalingGroupNames=[self.name])['AutoScalingGroups']
+        self.asg = groups[0] if groups else None
+        return self.asg
+
+    def _read_launch_template(self):
+        try:
+            versions = aws_client('ec2').describe_launch_template_versions(
+                LaunchTemplateName=self.name, Versions=['$Default'])['LaunchTemplateVersions']
+        except botocore.exceptions.ClientError as err:
+            if client_error_code(err) != 'InvalidLaunchTemplateName.NotFoundException':
+                raise
+            versions = []
+        self.launch_template = versions[0] if versions else None
+
+    def _read_notifications(self):
+        paginator = aws_client('autoscaling').get_paginator('describe_notification_configurations')
+        self.notifications = {(notification['TopicARN'], notification['NotificationType'])
+                              for page in paginator.paginate(AutoScalingGroupNames=[self.name])
+                              for notification in page['NotificationConfigurations']}
+
+    def _read_warm_pool(self, asg):
+        if not asg or not os.environ.get('WARM_POOL'):
+            return
+        asg_client = aws_client('autoscaling')
+        self.warm_pool = asg_client.describe_warm_pool(
+            AutoScalingGroupName=self.name).get('WarmPoolConfiguration')
+        self.hooks = [hook['LifecycleHookName'] for hook in asg_client.describe_lifecycle_hooks(
+            AutoScalingGroupName=self.name)['LifecycleHooks']]
+
+    def _read_topic(self):
+        topic_arn = os.environ.get('TOPIC_ARN')
+        if not topic_arn or topic_arn == "N/A":
+            return None
+        try:
+            aws_client('sns').get_topic_attributes(TopicArn=topic_arn)
+        except botocore.exceptions.ClientError as err:
+            if client_error_code(err) != 'NotFound':
+                raise
+            return None
+        self.topic_arn = topic_arn
+        return topic_arn
+
+    def _read_subscriptions(self, topic_arn):
+        if not topic_arn:
+            return
+        paginator = aws_client('sns').get_paginator('list_subscriptions_by_topic')
+        self.subscriptions = [subscription for page in paginator.paginate(TopicArn=topic_arn)
+                              for subscription in page['Subscriptions']]
+
+    def _read_function(self):
+        self.function_arn = aws_client('lambda').get_function(
+            FunctionName=self.function_name)['Configuration']['FunctionArn']
+
+    def _read_policy(self):
+        if fleet_mode():
+            # The fleet template allows every topic of the account once
+            return
         try:
-            print("Trying to create ASG")
+            policy = aws_client('lambda').get_policy(FunctionName=self.function_name)['Policy']
+        except botocore.exceptions.ClientError as err:
+            if client_error_code(err) != 'ResourceNotFoundException':
+                raise
+            return
+        self.statements = json.loads(policy).get('Statement', [])
+
+    def reconcile(self, data, subnets, tags, inst_id=None, attach_instance=True):
+        """ Make the calls which bring the resources read to the desired state: the ASG in
+        subnets launching from a launch template with data, inst_id attached to it or else a
+        desired capacity of 1, and its launch notifications sent to the lambda through the
+        topic. inst_id is attached before the notifications are set up, like the controller
+        it already is. Returns the topic ARN"""
+        actions = [('launch_template', self._reconcile_launch_template, []),
+                   ('asg', self._reconcile_asg, ['launch_template']),
+                   ('attach_instance', self._reconcile_instance, ['asg']),
+                   ('topic', self._reconcile_topic, []),
+                   ('lambda_subscription', self._reconcile_lambda_subscription, ['topic']),
+                   ('email_subscription', self._reconcile_email_subscription, ['topic']),
+                   ('permission', self._reconcile_permission, ['topic']),
+                   ('notifications', self._reconcile_notifications,
+                    ['asg', 'topic', 'attach_instance']),
+                   ('warm_pool', self._reconcile_warm_pool, ['asg', 'topic'])]
+        self._desired = {'data': data, 'subnets': subnets, 'tags': tags, 'inst_id': inst_id,
+                         'attach_instance': attach_instance}
+        results, failures = run_checks(actions)
+        if failures:
+            raise AvxError("; ".join(failures))
+        return results['topic']
+
+    def _reconcile_launch_template(self):
+        client = aws_client('ec2')
+        data = self._desired['data']
+        if self.launch_template is None:
+            version = client.create_launch_template(
+                LaunchTemplateName=self.name,
+                LaunchTemplateData=data)['LaunchTemplate']['LatestVersionNumber']
+            LOGGER.info("Created launch template %s", self.name)
+            return version
+        current = self.launch_template['LaunchTemplateData']
+        if all(current.get(key) == data.get(key)
+               for key in set(data) | {'KeyName', 'IamInstanceProfile'}):
+            return self.launch_template['VersionNumber']
+        version = client.create_launch_template_version(
+            LaunchTemplateName=self.name,
+            LaunchTemplateData=data)['LaunchTemplateVersion']['VersionNumber']
+        client.modify_launch_template(LaunchTemplateName=self.name, DefaultVersion=str(version))
+        LOGGER.info("Created launch template %s version %s", self.name, version)
+        return version
+
+    def _reconcile_asg(self, version):
+        asg_client = aws_client('autoscaling')
+        launch_template = {'LaunchTemplateName': self.name, 'Version': str(version)}
+        subnets = self._desired['subnets']
+        if self.asg and self.asg.get('Status') == 'Delete in progress':
+            LOGGER.info("ASG %s is pending delete. Waiting for it to be deleted", self.name)
+            asg_waiter('GroupNotExists').wait(
+                AutoScalingGroupNames=[self.name],
+                WaiterConfig={'Delay': ASG_PENDING_DELETE_WAIT,
+                              'MaxAttempts': ASG_DELETE_WAIT_ATTEMPTS})
+            self.asg = None
+        if self.asg is None:
+            LOGGER.info("Trying to create ASG")
             asg_client.create_auto_scaling_group(
-                AutoScalingGroupName=asg_name,
-                LaunchConfigurationName=lc_name,
+                AutoScalingGroupName=self.name,
+                LaunchTemplate=launch_template,
                 MinSize=0,
                 MaxSize=1,
-                DesiredCapacity=0 if attach_instance else 1,
-                VPCZoneIdentifier=val_subnets,
-                Tags=tags
+                DesiredCapacity=0 if self._desired['attach_instance'] else 1,
+                VPCZoneIdentifier=subnets,
+                Tags=self._desired['tags']
             )
+            LOGGER.info('Created ASG')
+            return
+        changes = {}
+        current = self.asg.get('LaunchTemplate') or {}
+        if current.get('LaunchTemplateName') != self.name or \
+                current.get('Version') != str(version):
+            changes['LaunchTemplate'] = launch_template
+        if set(self.asg.get('VPCZoneIdentifier', '').split(',')) != set(subnets.split(',')):
+            changes['VPCZoneIdentifier'] = subnets
+        if not self._desired['attach_instance'] and self.asg['DesiredCapacity'] != 1:
+            changes['DesiredCapacity'] = 1
+        if not changes:
+            LOGGER.info("ASG %s is up to date", self.name)
+            return
+        asg_client.update_auto_scaling_group(AutoScalingGroupName=self.name, **changes)
+        LOGGER.info("Updated %s of ASG %s", ", ".join(sorted(changes)), self.name)
+        if self.asg.get('LaunchConfigurationName') and 'LaunchTemplate' in changes:
+            # Set up by versions which launched the controller from a launch configuration
+            self._delete_launch_configuration()
+
+    def _reconcile_instance(self, _):
+        inst_id = self._desired['inst_id']
+        if not self._desired['attach_instance'] or inst_id in [
+                instance['InstanceId'] for instance in (self.asg or {}).get('Instances', [])]:
+            return
+        aws_client('autoscaling').attach_instances(InstanceIds=[inst_id],
+                                                   AutoScalingGroupName=self.name)
+        LOGGER.info("Attached %s to ASG %s", inst_id, self.name)
+
+    def _reconcile_topic(self):
+        if self.topic_arn:
+            return self.topic_arn
+        self.topic_arn = aws_client('sns').create_topic(Name=self.name).get('TopicArn')
+        LOGGER.info('Created SNS topic %s', self.topic_arn)
+        # The topic may have been there without its ARN in the state
+        self._read_subscriptions(self.topic_arn)
+        return self.topic_arn
+
+    def _subscribed(self, protocol, endpoint):
+        return any(subscription['Protocol'] == protocol and subscription['Endpoint'] == endpoint
+                   for subscription in self.subscriptions)
+
+    def _reconcile_lambda_subscription(self, topic_arn):
+        if self._subscribed('lambda', self.function_arn):
+            return
+        aws_client('sns').subscribe(TopicArn=topic_arn, Protocol='lambda',
+                                    Endpoint=self.function_arn)
+        LOGGER.info('SNS topic: Added lambda subscription.')
+
+    def _reconcile_email_subscription(self, topic_arn):
+        email = os.environ.get('NOTIF_EMAIL')
+        if not email:
+            LOGGER.info("Not adding email notification")
+            return
+        if self._subscribed('email', email):
+            return
+        try:
+            aws_client('sns').subscribe(TopicArn=topic_arn, Protocol='email', Endpoint=email)
         except botocore.exceptions.ClientError as err:
-            if "AlreadyExists" in str(err):
-                print("ASG already exists")
-                if "pending delete" in str(err):
-                    print("Pending delete. Trying again in 10 secs")
-                    time.sleep(10)
-            else:
-                raise
-        else:
-            break
+            LOGGER.warning("Could not add email notification %s", err)
 
-    print('Created ASG')
-    if attach_instance:
-        asg_client.attach_instances(InstanceIds=[inst_id],
-                                    AutoScalingGroupName=asg_name)
-    sns_client = boto3.client('sns')
-    sns_topic_arn = sns_client.create_topic(Name=sns_topic).get('TopicArn')
-    os.environ['TOPIC_ARN'] = sns_topic_arn
-    print('Created SNS topic %s' % sns_topic_arn)
-    lambda_client = boto3.client('lambda')
-    update_env_dict(lambda_client, context, {'TOPIC_ARN': sns_topic_arn})
-    lambda_fn_arn = lambda_client.get_function(
-        FunctionName=context.function_name).get('Configuration').get(
-            'FunctionArn')
-    sns_client.subscribe(TopicArn=sns_topic_arn,
-                         Protocol='lambda',
-                         Endpoint=lambda_fn_arn).get('SubscriptionArn')
-    if os.environ.get('NOTIF_EMAIL'):
+    def _reconcile_permission(self, topic_arn):
+        if fleet_mode() or any(sns_source_arn(statement) == topic_arn
+                               for statement in self.statements):
+            return
+        aws_client('lambda').add_permission(FunctionName=self.function_name,
+                                            StatementId=self.statement_id,
+                                            Action='lambda:InvokeFunction',
+                                            Principal='sns.amazonaws.com',
+                                            SourceArn=topic_arn)
+        LOGGER.info('Allowed SNS topic %s to invoke the lambda', topic_arn)
+
+    def _reconcile_notifications(self, _, topic_arn, __):
+        if all((topic_arn, notification_type) in self.notifications
+               for notification_type in ASG_NOTIFICATION_TYPES):
+            return
+        aws_client('autoscaling').put_notification_configuration(
+            AutoScalingGroupName=self.name,
+            NotificationTypes=ASG_NOTIFICATION_TYPES,
+            TopicARN=topic_arn)
+        LOGGER.info('Attached ASG')
+
+    def _reconcile_warm_pool(self, _, topic_arn):
+        if not os.environ.get('WARM_POOL'):
+            return
+        if self.name + WARM_POOL_HOOK_SUFFIX in self.hooks and self.warm_pool and \
+                self.warm_pool.get('PoolState') == os.environ.get('WARM_POOL'):
+            return
+        setup_warm_pool(aws_client('autoscaling'), self.name, topic_arn)
+
+    def teardown(self, inst_id, detach_instances=True, delete_sns=True):
+        """ Delete the resources read, keeping the controller instance inst_id. The ASG is
+        force deleted with its warm pool and notification configuration, and the topic with
+        its subscriptions"""
+        actions = [('delete_asg', self._delete_asg, []),
+                   ('delete_launch_template', self._delete_launch_template, [])]
+        if delete_sns:
+            actions += [('delete_topic', self._delete_topic, []),
+                        ('remove_permission', self._remove_permission, [])]
+        self._desired = {'inst_id': inst_id, 'detach_instances': detach_instances}
+        _, failures = run_checks(actions)
+        if failures:
+            raise AvxError("; ".join(failures))
+
+    def _delete_asg(self):
+        if self.asg is None:
+            LOGGER.info('ASG already deleted')
+            return
+        asg_client = aws_client('autoscaling')
+        inst_id = self._desired['inst_id']
+        if self._desired['detach_instances'] and inst_id in [
+                instance['InstanceId'] for instance in self.asg.get('Instances', [])]:
+            asg_client.detach_instances(InstanceIds=[inst_id], AutoScalingGroupName=self.name,
+                                        ShouldDecrementDesiredCapacity=True)
+            LOGGER.info("Controller instance detached from autoscaling group")
         try:
-            sns_client.subscribe(TopicArn=sns_topic_arn,
-                                 Protocol='email',
-                                 Endpoint=os.environ.get('NOTIF_EMAIL'))
+            asg_client.delete_auto_scaling_group(AutoScalingGroupName=self.name,
+                                                 ForceDelete=True)
         except botocore.exceptions.ClientError as err:
-            print("Could not add email notification %s" % str(err))
-    else:
-        print("Not adding email notification")
-    lambda_client.add_permission(FunctionName=context.function_name,
-                                 StatementId=str(uuid.uuid4()),
-                                 Action='lambda:InvokeFunction',
-                                 Principal='sns.amazonaws.com',
-                                 SourceArn=sns_topic_arn)
-    print('SNS topic: Added lambda subscription.')
-    asg_client.put_notification_configuration(
-        AutoScalingGroupName=asg_name,
-        NotificationTypes=['autoscaling:EC2_INSTANCE_LAUNCH',
-                           'autoscaling:EC2_INSTANCE_LAUNCH_ERROR'],
-        TopicARN=sns_topic_arn)
-    print('Attached ASG')
+            if "not found" not in str(err):
+                raise AvxError(str(err)) from err
+        LOGGER.info("Autoscaling group deleted")
+        if self.asg.get('LaunchConfigurationName'):
+            self._delete_launch_configuration()
 
-
-def delete_resources(inst_id, delete_sns=True, detach_instances=True):
-    """ Cloud formation cleanup"""
-    lc_name = asg_name = os.environ.get('AVIATRIX_TAG')
-
-    asg_client = boto3.client('autoscaling')
-    if detach_instances:
+    def _delete_launch_configuration(self):
         try:
-            asg_client.detach_instances(
-                InstanceIds=[inst_id],
-                AutoScalingGroupName=asg_name,
-                ShouldDecrementDesiredCapacity=True)
-            print("Controller instance detached from autoscaling group")
+            aws_client('autoscaling').delete_launch_configuration(
+                LaunchConfigurationName=self.asg['LaunchConfigurationName'])
         except botocore.exceptions.ClientError as err:
-            print(str(err))
-    try:
-        asg_client.delete_auto_scaling_group(AutoScalingGroupName=asg_name,
-                                             ForceDelete=True)
-    except botocore.exceptions.ClientError as err:
-        if "AutoScalingGroup name not found" in str(err):
-            print('ASG already deleted')
+            LOGGER.warning("%s", err)
         else:
-            raise AvxError(str(err)) from err
-    print("Autoscaling group deleted")
-    try:
-        asg_client.delete_launch_configuration(LaunchConfigurationName=lc_name)
-    except botocore.exceptions.ClientError as err:
-        if "Launch configuration name not found" in str(err):
-            print('LC already deleted')
-        else:
-            print(str(err))
-    print("Launch configuration deleted")
-    if delete_sns:
-        print("Deleting SNS topic")
-        sns_client = boto3.client('sns')
-        topic_arn = os.environ.get('TOPIC_ARN')
-        if topic_arn == "N/A" or not topic_arn:
-            print("Topic not created. Exiting")
+            LOGGER.info("Launch configuration deleted")
+
+    def _delete_launch_template(self):
+        if self.launch_template is None:
+            LOGGER.info('Launch template already deleted')
             return
         try:
-            response = sns_client.list_subscriptions_by_topic(TopicArn=topic_arn)
+            aws_client('ec2').delete_launch_template(
+                LaunchTemplateId=self.launch_template['LaunchTemplateId'])
         except botocore.exceptions.ClientError as err:
-            print('Could not delete topic due to %s' % str(err))
+            LOGGER.warning("%s", err)
         else:
-            for subscription in response.get('Subscriptions', []):
-                try:
-                    sns_client.unsubscribe(SubscriptionArn=subscription.get('SubscriptionArn', ''))
-                except botocore.exceptions.ClientError as err:
-                    print(str(err))
-            print("Deleted subscriptions")
+            LOGGER.info("Launch template deleted")
+
+    def _delete_topic(self):
+        if not self.topic_arn:
+            LOGGER.info("Topic not created")
+            return
         try:
-            sns_client.delete_topic(TopicArn=topic_arn)
+            aws_client('sns').delete_topic(TopicArn=self.topic_arn)
         except botocore.exceptions.ClientError as err:
-            print('Could not delete topic due to %s' % str(err))
+            LOGGER.warning('Could not delete topic due to %s', err)
         else:
-            print("SNS topic deleted")
+            LOGGER.info("SNS topic deleted")
+
+    def _remove_permission(self):
+        topic_arn = self.topic_arn or os.environ.get('TOPIC_ARN')
+        # Policy updates of a function conflict with each other, so one at a time
+        for statement in self.statements:
+            if sns_source_arn(statement) != topic_arn:
+                continue
+            try:
+                aws_client('lambda').remove_permission(FunctionName=self.function_name,
+                                                       StatementId=statement['Sid'])
+            except botocore.exceptions.ClientError as err:
+                LOGGER.warning("%s", err)
+        LOGGER.info("Removed the permissions of the SNS topic")
+
+
+def setup_ha(ami_id, inst_type, inst_id, key_name, sg_list, context, store,
+             attach_instance=True):
+    """ Setup HA """
+    LOGGER.info("HA config ami_id %s, inst_type %s, inst_id %s, key_name %s, sg_list %s, "
+                "attach_instance %s", ami_id, inst_type, inst_id, key_name, sg_list,
+                attach_instance)
+    asg_name = os.environ.get('AVIATRIX_TAG')
+    # AMI_NAME = LC_NAME
+    # ami_id = client.describe_images(
+    #     Filters=[{'Name': 'name','Values':
+    #  [AMI_NAME]}],Owners=['self'])['Images'][0]['ImageId']
+    sub_list = os.environ.get('SUBNETLIST')
+    val_subnets = validate_subnets(sub_list.split(","))
+    LOGGER.info("Valid subnets %s", val_subnets)
+    if key_name:
+        validate_keypair(key_name)
+    try:
+        tags = json.loads(os.environ.get('TAGS'))
+    except ValueError:
+        tags = [{'Key': 'Name', 'Value': asg_name, 'PropagateAtLaunch': True}]
+    else:
+        if not tags:
+            tags = [{'Key': 'Name', 'Value': asg_name, 'PropagateAtLaunch': True}]
+        for tag in tags:
+            tag['PropagateAtLaunch'] = True
+
+    data = launch_template_data(ami_id, inst_type, key_name, sg_list)
+    resources = HaResources(asg_name, context.function_name).read()
+    # A launch notification of the attached instance must find it saved as the controller
+    store.commit()
+    try:
+        resources.reconcile(data, val_subnets, tags, inst_id, attach_instance)
+    finally:
+        # Delete needs the topic even when the rest failed
+        if resources.topic_arn:
+            store.update({'TOPIC_ARN': resources.topic_arn})
+
+
+def setup_warm_pool(asg_client, asg_name, sns_topic_arn):
+    """ Keep a stopped standby instance in a warm pool of the ASG. The launch lifecycle hook
+    notifies the lambda, which runs initial setup on the standby before it is stopped"""
+    asg_client.put_lifecycle_hook(
+        LifecycleHookName=asg_name + WARM_POOL_HOOK_SUFFIX,
+        AutoScalingGroupName=asg_name,
+        LifecycleTransition='autoscaling:EC2_INSTANCE_LAUNCHING',
+        NotificationTargetARN=sns_topic_arn,
+        RoleARN=os.environ.get('WARM_POOL_ROLE_ARN'),
+        HeartbeatTimeout=WARM_POOL_HOOK_TIMEOUT,
+        DefaultResult='CONTINUE')
+    asg_client.put_warm_pool(AutoScalingGroupName=asg_name,
+                             PoolState=os.environ.get('WARM_POOL'),
+                             MinSize=1)
+    LOGGER.info('Created %s warm pool', os.environ.get('WARM_POOL'))
+
+
+def handle_lifecycle_action(client, store, message):
+    """ Launch lifecycle hook of the warm pool. Instances entering the warm pool are set up to
+    the version of the backup. Instances leaving it, or launched without it, continue right
+    away and are restored on the launch notification"""
+    LOGGER.info("Lifecycle action %s for %s from %s to %s", message.get('LifecycleTransition'),
+                message.get('EC2InstanceId'), message.get('Origin'), message.get('Destination'))
+    try:
+        if message.get('Destination') == 'WarmPool' and \
+                os.environ.get('WARM_INST_ID') == message.get('EC2InstanceId'):
+            LOGGER.info("Standby %s is already set up", message['EC2InstanceId'])
+        elif message.get('Destination') == 'WarmPool':
+            timeline = FailoverTimeline("warm_pool")
+            try:
+                prepare_standby(client, store, message['EC2InstanceId'], timeline)
+            finally:
+                timeline.emit()
+    finally:
+        try:
+            aws_client('autoscaling').complete_lifecycle_action(
+                LifecycleHookName=message['LifecycleHookName'],
+                AutoScalingGroupName=message['AutoScalingGroupName'],
+                LifecycleActionToken=message['LifecycleActionToken'],
+                LifecycleActionResult='CONTINUE')
+        except botocore.exceptions.ClientError as err:
+            LOGGER.warning("Could not complete the lifecycle action. %s", err)
+
+
+def is_entering_warm_pool(message):
+    """ Whether an ASG notification is about an instance launched into the warm pool"""
+    if message.get('Destination') == 'WarmPool':
+        return True
+    if not os.environ.get('WARM_POOL') or not message.get('EC2InstanceId'):
+        return False
+    instances = aws_client('autoscaling').describe_auto_scaling_instances(
+        InstanceIds=[message['EC2InstanceId']])['AutoScalingInstances']
+    return bool(instances) and instances[0]['LifecycleState'].startswith('Warmed')
+
+
+def prepare_standby(client, store, inst_id, timeline):
+    """ Run initial setup on a new warm pool instance, so that a failover to it only has to
+    restore the backup"""
+    with timeline.phase('wait_running'):
+        client.get_waiter('instance_running').wait(InstanceIds=[inst_id])
+        instanceobj = client.describe_instances(
+            InstanceIds=[inst_id])['Reservations'][0]['Instances'][0]
+    private_ip = instanceobj['PrivateIpAddress']
+    api_private_access = os.environ.get('API_PRIVATE_ACCESS')
+    api_paths = controller_api_paths(instanceobj.get('PublicIpAddress'), private_ip)
+    if not api_paths:
+        LOGGER.warning("Standby %s has no public IP. Initial setup will run on failover", inst_id)
+        timeline.outcome = 'skipped'
+        return
+    ctrl_version = retrieve_controller_version(
+        "CloudN_" + os.environ.get('PRIV_IP') + "_save_cloudx_version.txt")
+    with timeline.phase('sg_change'):
+        duplicate, sg_modified = temp_add_security_group_access(client, instanceobj,
+                                                                api_private_access)
+    held = not duplicate or bool(security_group_holders(sg_modified))
+    try:
+        if held:
+            hold_security_group(store, 'standby', sg_modified)
+            store.commit()
+        with timeline.phase('first_login'):
+            api, api_path = login_first_path(api_paths, private_ip, MAX_LOGIN_TIMEOUT)
+            if not api.cid:
+                raise AvxError("Could not login to the standby %s" % inst_id)
+        timeline.attributes['api_path'] = api_path
+        with timeline.phase('run_initial_setup'):
+            setup_complete = run_initial_setup(api, ctrl_version)
+        with timeline.phase('initial_setup_poll'):
+            deadline = time.monotonic() + INITIAL_SETUP_WAIT
+            delays = backoff_delays()
+            while not setup_complete and time.monotonic() < deadline:
+                # The upgrade restarts the services and invalidates the session
+                wait_for_api(api, deadline - time.monotonic())
+                try:
+                    api.login()
+                    setup_complete = get_initial_setup_status(api).get('return') is True
+                except AvxError as err:
+                    LOGGER.warning("%s", err)
+                if not setup_complete:
+                    time.sleep(min(next(delays), max(0, deadline - time.monotonic())))
+        if not setup_complete:
+            raise AvxError("Initial setup of the standby %s did not complete" % inst_id)
+        LOGGER.info("Standby %s is set up for version %s", inst_id, ctrl_version)
+        store.update({'WARM_INST_ID': inst_id, 'WARM_VERSION': ctrl_version})
+        timeline.outcome = 'success'
+    finally:
+        if held:
+            hold_security_group(store, 'standby')
+        store.commit()
+        if held:
+            release_security_group(client, store, sg_modified)
+
+
+def delete_resources(inst_id, context, delete_sns=True, detach_instances=True):
+    """ Cloud formation cleanup"""
+    resources = HaResources(os.environ.get('AVIATRIX_TAG'), context.function_name)
+    resources.read(full=False).teardown(inst_id, detach_instances, delete_sns)
 
 
 def send_response(event, context, response_status, reason='',
@@ -1165,16 +3521,11 @@ def send_response(event, context, response_status, reason='',
             'Data': response_data
         }
     )
-    opener = build_opener(HTTPHandler)
-    request = Request(event['ResponseURL'], data=response_body.encode())
-    request.add_header('Content-Type', '')
-    request.add_header('Content-Length', len(response_body.encode()))
-    request.get_method = lambda: 'PUT'
-    try:
-        response = opener.open(request)
-        print("Status code: {}".format(response.getcode()))
-        print("Status message: {}".format(response.msg))
-        return True
-    except HTTPError as exc:
-        print("Failed executing HTTP request: {}".format(exc.code))
+    response = transport.request('PUT', event['ResponseURL'], data=response_body,
+                                 headers={'Content-Type': ''})
+    if response.status_code >= 400:
+        LOGGER.error("Failed executing HTTP request: %s", response.status_code)
         return False
+    LOGGER.info("Status code: %s", response.status_code)
+    LOGGER.info("Status message: %s", response.reason)
+    return True
@@ -0,0 +1,344 @@
+""" End to end RTO benchmark of the HA lambda against the offline simulator
+use as python3 benchmark.py [--runs 5] [--scale 0.01] [--save out.json] [--baseline out.json]
+Delays of the fake controller and the waits of the lambda are both multiplied by --scale,
+so reported times are in scaled seconds. Divide by the scale to estimate real seconds.
+"""
+import argparse
+import contextlib
+import io
+import json
+import statistics
+import sys
+import threading
+import time
+
+from moto import mock_aws
+
+import simulator
+
+SCENARIOS = ['cft_create', 'warm_pool', 'ha_event', 'duplicate', 'launch_error', 'health_check',
+             'cft_delete']
+
+
+def _import_lambda():
+    """ Import the lambda module the way the lambda runtime would"""
+    import aviatrix_ha  # pylint: disable=import-outside-toplevel
+    return aviatrix_ha
+
+
+def _invoke(module, event, context, log):
+    """ Invoke the handler, capturing its output. Returns (seconds, timeline records)"""
+    output = io.StringIO()
+    start = time.monotonic()
+    with contextlib.redirect_stdout(output):
+        module.lambda_handler(event, context)
+    elapsed = time.monotonic() - start
+    log.write(output.getvalue())
+    timelines = []
+    for line in output.getvalue().splitlines():
+        if line.startswith('{') and '"ha_timeline"' in line:
+            timelines.append(json.loads(line))
+    return elapsed, timelines
+
+
+def _invoke_continued(module, event, account, timeout, log):
+    """ Invoke the handler, then the continuations it handed the event over to, each with
+    a new context. Returns (seconds, timeline records)"""
+    elapsed, timelines = _invoke(module, event, account.context(timeout), log)
+    queued = simulator.queued_invocations()
+    while queued:
+        for _, continuation in queued:
+            account.load_environment()
+            more, records = _invoke(module, continuation, account.context(timeout), log)
+            elapsed += more
+            timelines.extend(records)
+        queued = simulator.queued_invocations()
+    return elapsed, timelines
+
+
+def _dropped(module, event, account, log):
+    """ Deliver event again. Returns (seconds, whether it was dropped as a duplicate or found
+    already handled)"""
+    account.load_environment()
+    output = io.StringIO()
+    elapsed, _ = _invoke(module, event, account.context(), output)
+    log.write(output.getvalue())
+    return elapsed, any(marker in output.getvalue() for marker in (
+        "Dropping the duplicate", "Controller is already saved"))
+
+
+def _health_check(module, account, controller, log):
+    """ Scheduled health checks of the restored controller. It stays in service while healthy
+    and when fewer probes in a row than the threshold fail, and is set Unhealthy once its API
+    hangs. Returns (seconds from the hang until it is set Unhealthy, ok, {})"""
+    import boto3  # pylint: disable=import-outside-toplevel
+    asg_client = boto3.client('autoscaling', region_name=simulator.REGION)
+
+    def health():
+        return asg_client.describe_auto_scaling_instances(InstanceIds=[account.instance_id])[
+            'AutoScalingInstances'][0]['HealthStatus'].upper()
+
+    def check():
+        account.load_environment()
+        return _invoke(module, simulator.health_check_event(), account.context(), log)[0]
+
+    # The controller was just launched
+    grace, module.HEALTH_CHECK_GRACE = module.HEALTH_CHECK_GRACE, 0
+    try:
+        check()
+        healthy = health() == 'HEALTHY'
+        # Two probes fail, the third one is answered
+        controller.api_hung = True
+        timer = threading.Timer(module.HEALTH_PROBE_INTERVAL * 1.5, setattr,
+                                (controller, 'api_hung', False))
+        timer.start()
+        check()
+        timer.join()
+        missed = health() == 'HEALTHY'
+        controller.api_hung = True
+        elapsed = check()
+        marked = health() == 'UNHEALTHY'
+    finally:
+        controller.api_hung = False
+        module.HEALTH_CHECK_GRACE = grace
+    return elapsed, healthy and missed and marked, {}
+
+
+def run_once(module, scale, delays, private_access, log, state_backend='lambda',
+             warm_pool=False, lambda_timeout=900, slow_path=None, slow_path_delay=0,
+             duplicates=False, health_check=False):
+    """ One Create, failover and Delete cycle in a fresh simulated account. With warm_pool,
+    a standby is set up through the lifecycle hook before the failover and replaces the
+    controller. The failover is handed over to continuations when it takes longer than
+    lambda_timeout, a failover running initial setup twice fails. The public or private
+    slow_path of the new controller is only up slow_path_delay real seconds after it.
+    With duplicates, the launch notification is delivered again after the failover and a
+    launch error twice, and the second deliveries have to be dropped or find the failover
+    done. With health_check, scheduled health checks have to set the restored controller
+    Unhealthy once its API hangs.
+    Returns a dict of scenario -> (seconds, ok, phase durations)"""
+    results = {}
+    with mock_aws():
+        account = simulator.SimulatedAccount(private_access=private_access,
+                                             state_backend=state_backend, warm_pool=warm_pool)
+        responder = simulator.Responder(
+            {'BYOL': {simulator.REGION: account.ami_id}}).start()
+        module.AMI_ID = responder.url + '/ami_id.json'
+        controller = None
+        try:
+            account.load_environment()
+            elapsed, timelines = _invoke(module, simulator.cft_event('Create', responder.url),
+                                         account.context(), log)
+            created = bool(responder.responses) and \
+                responder.responses[-1]['Status'] == 'SUCCESS'
+            results['cft_create'] = (elapsed, created, _phases(timelines))
+
+            standby = None
+            if warm_pool:
+                standby = account.launch_standby()
+                controller = simulator.FakeController(standby[1], [standby[1]], **delays).start()
+                module.CONTROLLER_PORT = controller.port
+                account.load_environment()
+                elapsed, timelines = _invoke(
+                    module, simulator.lifecycle_event(standby[0], 'EC2', 'WarmPool'),
+                    account.context(), log)
+                variables = account.load_environment()
+                results['warm_pool'] = (elapsed, controller.setup_state == 'done' and
+                                        variables.get('WARM_INST_ID') == standby[0],
+                                        _phases(timelines))
+                controller.stop()
+                account.stop_standby(standby[0])
+
+            old_instance = account.instance_id
+            new_instance, new_private_ip = account.replace_instance(standby)
+            slow_address = {'public': account.eip, 'private': new_private_ip}.get(slow_path)
+            controller = simulator.FakeController(
+                new_private_ip, [account.eip, new_private_ip], initial_setup_done=bool(standby),
+                path_delays={slow_address: slow_path_delay * scale} if slow_address else None,
+                **delays).start()
+            module.CONTROLLER_PORT = controller.port
+            elapsed = 0
+            if standby:
+                account.load_environment()
+                elapsed, _ = _invoke(
+                    module, simulator.lifecycle_event(new_instance, 'WarmPool', 'AutoScalingGroup'),
+                    account.context(), log)
+            account.load_environment()
+            launch_event = simulator.sns_event('autoscaling:EC2_INSTANCE_LAUNCH', new_instance)
+            launch_elapsed, timelines = _invoke_continued(module, launch_event, account,
+                                                          lambda_timeout * scale, log)
+            elapsed += launch_elapsed
+            variables = account.load_environment()
+            restored = controller.restored and variables.get('INST_ID') == new_instance \
+                and old_instance != new_instance and not variables.get('FAILOVER_STEP') \
+                and controller.stats.get('initial_setup_run', 0) <= 1
+            results['ha_event'] = (elapsed, restored, _phases(timelines))
+
+            if duplicates:
+                restores = controller.stats.get('restore_cloudx_config', 0)
+                elapsed, dropped = _dropped(module, launch_event, account, log)
+                results['duplicate'] = (elapsed, dropped and controller.stats.get(
+                    'restore_cloudx_config', 0) == restores, {})
+                launch_error = simulator.sns_event('autoscaling:EC2_INSTANCE_LAUNCH_ERROR')
+                account.load_environment()
+                _invoke(module, launch_error, account.context(), log)
+                elapsed, dropped = _dropped(module, launch_error, account, log)
+                results['launch_error'] = (elapsed, dropped, {})
+
+            if health_check:
+                results['health_check'] = _health_check(module, account, controller, log)
+
+            responses = len(responder.responses)
+            elapsed, timelines = _invoke(module, simulator.cft_event('Delete', responder.url),
+                                         account.context(), log)
+            deleted = len(responder.responses) > responses and \
+                responder.responses[-1]['Status'] == 'SUCCESS'
+            results['cft_delete'] = (elapsed, deleted, _phases(timelines))
+        finally:
+            if controller:
+                controller.stop()
+            responder.stop()
+    return results
+
+
+def _phases(timelines):
+    """ Total seconds per phase of the timeline records"""
+    totals = {}
+    for timeline in timelines:
+        for entry in timeline['phases']:
+            totals[entry['phase']] = totals.get(entry['phase'], 0) + entry['duration']
+    return totals
+
+
+def percentile(values, pct):
+    """ Nearest rank percentile"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))]
+
+
+def summarize(runs):
+    """ p50/p95 of every scenario and phase over all runs"""
+    summary = {}
+    for scenario in SCENARIOS:
+        samples = [run[scenario] for run in runs if scenario in run]
+        if not samples:
+            continue
+        times = [sample[0] for sample in samples]
+        phases = {}
+        for sample in samples:
+            for phase, duration in sample[2].items():
+                phases.setdefault(phase, []).append(duration)
+        summary[scenario] = {
+            'runs': len(samples),
+            'failures': len([sample for sample in samples if not sample[1]]),
+            'p50': statistics.median(times),
+            'p95': percentile(times, 95),
+            'phases': {phase: {'p50': statistics.median(values), 'p95': percentile(values, 95)}
+                       for phase, values in phases.items()},
+        }
+    return summary
+
+
+def print_summary(summary, scale):
+    """ Print the result table"""
+    print("%-32s %5s %5s %10s %10s %12s" % ('scenario / phase', 'runs', 'fail', 'p50 (s)',
+                                           'p95 (s)', 'p50 real (s)'))
+    for scenario, result in summary.items():
+        print("%-32s %5d %5d %10.3f %10.3f %12.1f" % (
+            scenario, result['runs'], result['failures'], result['p50'], result['p95'],
+            result['p50'] / scale))
+        for phase, values in result['phases'].items():
+            print("  %-30s %5s %5s %10.3f %10.3f %12.1f" % (
+                phase, '', '', values['p50'], values['p95'], values['p50'] / scale))
+
+
+def compare(summary, baseline, tolerance):
+    """ Returns the list of scenarios whose p50 regressed by more than tolerance"""
+    regressions = []
+    for scenario, result in summary.items():
+        previous = baseline.get(scenario)
+        if previous and result['p50'] > previous['p50'] * (1 + tolerance):
+            regressions.append("%s p50 %.3fs > baseline %.3fs" % (scenario, result['p50'],
+                                                                  previous['p50']))
+        if result['failures']:
+            regressions.append("%s failed %d times" % (scenario, result['failures']))
+    return regressions
+
+
+def main():
+    """ Run the benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--scale', type=float, default=simulator.DEFAULT_SCALE)
+    parser.add_argument('--private-access', action='store_true',
+                        help='Reach the controller through its private IP')
+    parser.add_argument('--dual-path', action='store_true',
+                        help='Race the public and the private IP of the controller')
+    parser.add_argument('--slow-path', choices=['public', 'private'],
+                        help='Path to the new controller that comes up late')
+    parser.add_argument('--slow-path-delay', type=float, default=300,
+                        help='Real seconds the slow path stays down')
+    parser.add_argument('--state-backend', default='lambda', choices=['lambda', 's3', 'dynamodb'],
+                        help='Where the lambda keeps the failover state')
+    parser.add_argument('--warm-pool', action='store_true',
+                        help='Fail over to a standby set up through the warm pool lifecycle hook.'
+                             ' Implies --private-access, moto public IPs are not reachable')
+    parser.add_argument('--lambda-timeout', type=float, default=900,
+                        help='Real seconds before the lambda hands a failover over to a '
+                             'continuation invocation')
+    parser.add_argument('--duplicates', action='store_true',
+                        help='Deliver the launch notification and a launch error twice')
+    parser.add_argument('--health-check', action='store_true',
+                        help='Run scheduled health checks against the restored controller, '
+                             'then hang its API')
+    parser.add_argument('--drop-rate', type=float, default=0,
+                        help='Probability that the fake controller drops the response of an '
+                             'API request, after running it')
+    parser.add_argument('--session-ttl', type=float, default=None,
+                        help='Real seconds after which controller sessions expire')
+    parser.add_argument('--log', default='bench_output.txt',
+                        help='File receiving the lambda output')
+    parser.add_argument('--save', help='Write the summary as json to this file')
+    parser.add_argument('--baseline', help='Fail if p50 regressed against this summary')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+    if args.duplicates and args.state_backend not in ('s3', 'dynamodb'):
+        parser.error("--duplicates needs --state-backend s3 or dynamodb, the lambda backend "
+                     "takes no leases")
+
+    simulator.configure_offline_environment()
+    simulator.patch_moto_gaps()
+    module = _import_lambda()
+    simulator.scale_lambda_delays(module, args.scale)
+    overrides = {}
+    if args.session_ttl is not None:
+        overrides['session_ttl'] = args.session_ttl
+    delays = simulator.scaled_delays(args.scale, **overrides)
+    delays['drop_rate'] = args.drop_rate
+    runs = []
+    with open(args.log, 'w') as log:
+        for run in range(args.runs):
+            access = 'Both' if args.dual_path else args.private_access or args.warm_pool
+            runs.append(run_once(module, args.scale, delays, access, log, args.state_backend,
+                                 args.warm_pool, args.lambda_timeout, args.slow_path,
+                                 args.slow_path_delay, args.duplicates, args.health_check))
+            print("run %d: %s" % (run + 1, ", ".join(
+                "%s %.3fs%s" % (name, result[0], "" if result[1] else " FAILED")
+                for name, result in runs[-1].items())))
+    summary = summarize(runs)
+    print_summary(summary, args.scale)
+    if args.save:
+        with open(args.save, 'w') as fileh:
+            json.dump(summary, fileh, indent=2)
+    if args.baseline:
+        with open(args.baseline) as fileh:
+            regressions = compare(summary, json.load(fileh), args.tolerance)
+        if regressions:
+            print("Regressions:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+    elif any(result['failures'] for result in summary.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
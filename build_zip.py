@@ -0,0 +1,62 @@
+""" Build the lambda zip from the lambda files of this tree
+use as python3 build_zip.py [--check] [--zip aviatrix_ha.zip]
+The zip bundles no libraries, boto3 comes with the lambda runtime. Entries have a fixed
+timestamp and mode, so building twice from the same files gives the same zip. With --check
+nothing is written, and it exits non zero when the zip does not hold the files of the tree.
+"""
+import argparse
+import sys
+import zipfile
+
+LAMBDA_FILES = ['aviatrix_ha.py', 'transport.py', 'version.py']
+LAMBDA_ZIP_FILE = 'aviatrix_ha.zip'
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+def build_zip(path=LAMBDA_ZIP_FILE):
+    """ Zip the lambda files of this tree to path. Returns path"""
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as target:
+        for name in LAMBDA_FILES:
+            info = zipfile.ZipInfo(name, ZIP_DATE_TIME)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            with open(name, 'rb') as fileh:
+                target.writestr(info, fileh.read())
+    return path
+
+
+def stale_files(path=LAMBDA_ZIP_FILE):
+    """ Names of the lambda files missing from the zip or differing from the tree, and of
+    the files the zip holds besides them"""
+    try:
+        with zipfile.ZipFile(path) as zip_:
+            entries = {name: zip_.read(name) for name in zip_.namelist()}
+    except (OSError, zipfile.BadZipFile):
+        return list(LAMBDA_FILES)
+    stale = []
+    for name in LAMBDA_FILES:
+        with open(name, 'rb') as fileh:
+            if entries.pop(name, None) != fileh.read():
+                stale.append(name)
+    return stale + sorted(entries)
+
+
+def main():
+    """ Build or check the zip"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--zip', default=LAMBDA_ZIP_FILE)
+    parser.add_argument('--check', action='store_true',
+                        help='Only check that the zip holds the files of the tree')
+    args = parser.parse_args()
+    if not args.check:
+        build_zip(args.zip)
+    stale = stale_files(args.zip)
+    if stale:
+        print("%s is stale: %s%s" % (args.zip, ", ".join(stale[:5]),
+                                    " and %d more" % (len(stale) - 5) if len(stale) > 5 else ""))
+        sys.exit(1)
+    print("%s holds %s" % (args.zip, ", ".join(LAMBDA_FILES)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+""" Benchmark of the AMI catalog lookup done by every CFT Create
+use as python3 catalog_benchmark.py [--runs 20] [--delay 0.15] [--timeout 1]
+The catalog is served by the simulator with --delay seconds of latency, like the public
+bucket seen from a lambda. The offline case points AMI_ID at a socket that never answers,
+like a lambda without internet access, which the lookup gives up on after --timeout seconds.
+"""
+import argparse
+import contextlib
+import io
+import os
+import socket
+import statistics
+import tempfile
+import time
+
+import simulator
+
+CASES = ['uncached', 'cold', 'tmp', 'warm', 'revalidate', 'offline_stale']
+
+
+def synthetic_catalog(image_types=8, regions=30):
+    """ Catalog shaped like the published one: image type -> region -> AMI ID"""
+    return {'type%d' % image: {'region-%d' % region: 'ami-%08x%08x' % (image, region)
+                               for region in range(regions)}
+            for image in range(image_types)}
+
+
+def uncached_lookup(module, ami_id):
+    """ The lookup before the catalog was cached: one GET and a scan per image type"""
+    ami_dict = module.transport.request('GET', module.AMI_ID).json()
+    for image_type in ami_dict:
+        if ami_id in list(ami_dict[image_type].values()):
+            return True
+    return False
+
+
+def run_case(module, case, responder, blackhole_url, catalog, ami_id):
+    """ Prepare the cache for case and time one lookup. Returns (seconds, catalog requests)"""
+    module._AMI_CATALOG.clear()  # pylint: disable=protected-access
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(module.AMI_CATALOG_CACHE)
+    module.AMI_ID = responder.url + '/ami_id.json'
+    with contextlib.redirect_stdout(io.StringIO()):
+        if case in ('tmp', 'warm', 'revalidate'):
+            module.ami_catalog()
+        if case == 'tmp':
+            # A new container of the same lambda
+            module._AMI_CATALOG.clear()  # pylint: disable=protected-access
+        elif case == 'revalidate':
+            module._AMI_CATALOG[module.AMI_ID].fetched = 0  # pylint: disable=protected-access
+        elif case == 'offline_stale':
+            module.AMI_ID = blackhole_url
+            module.AmiCatalog(blackhole_url, catalog, '"stale"', 0).save()
+    requests_before = len(responder.catalog_requests)
+    start = time.monotonic()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if case == 'uncached':
+            found = uncached_lookup(module, ami_id)
+        else:
+            found = module._check_ami_id(ami_id)  # pylint: disable=protected-access
+    elapsed = time.monotonic() - start
+    if not found:
+        raise AssertionError("%s: AMI was not found" % case)
+    return elapsed, responder.catalog_requests[requests_before:]
+
+
+def main():
+    """ Run the benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--delay', type=float, default=0.15,
+                        help='Seconds the catalog server takes to answer')
+    parser.add_argument('--timeout', type=float, default=1,
+                        help='AMI_CATALOG_TIMEOUT of the lambda in the offline cases')
+    args = parser.parse_args()
+
+    simulator.configure_offline_environment()
+    import aviatrix_ha  # pylint: disable=import-outside-toplevel
+    catalog = synthetic_catalog()
+    ami_id = catalog['type3']['region-17']
+    responder = simulator.Responder(catalog, catalog_delay=args.delay).start()
+    # Accepts connections into its backlog and never answers them
+    blackhole = socket.socket()
+    blackhole.bind(('127.0.0.1', 0))
+    blackhole.listen(64)
+    blackhole_url = 'http://127.0.0.1:%d/ami_id.json' % blackhole.getsockname()[1]
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        aviatrix_ha.AMI_CATALOG_CACHE = os.path.join(tmp, 'ami_catalog.json')
+        aviatrix_ha.AMI_CATALOG_TIMEOUT = args.timeout
+        try:
+            for case in CASES:
+                samples = [run_case(aviatrix_ha, case, responder, blackhole_url, catalog, ami_id)
+                           for _ in range(args.runs)]
+                results[case] = ([elapsed for elapsed, _ in samples], samples[-1][1])
+        finally:
+            responder.stop()
+            blackhole.close()
+
+    print("%-18s %10s %10s  %s" % ('case', 'p50 (ms)', 'max (ms)', 'catalog requests'))
+    for case, (times, requests_made) in results.items():
+        print("%-18s %10.2f %10.2f  %s" % (case, statistics.median(times) * 1000,
+                                           max(times) * 1000,
+                                           ", ".join(str(code) for code in requests_made) or
+                                           "none"))
+    print("Before the cache, an unreachable catalog blocked the lookup with no timeout")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+""" Import time and cold start benchmark of the lambda zip
+use as python3 coldstart.py [--zip aviatrix_ha.zip] [--runs 10] [--save out.json]
+    [--baseline out.json]
+Without --zip, the zip is built like the released one from the lambda files of this tree.
+It bundles no libraries, boto3 comes with the lambda runtime. Every run extracts the zip
+and imports from a fresh interpreter with it first on sys.path, like /var/task in the
+lambda runtime.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from build_zip import build_zip
+
+# Runs in the fresh interpreter. Times the import of the handler module, the clients every
+# invocation creates and the controller API client the HA event path uses. The released
+# zips from before transport.py use requests, imported with the module
+PROBE = """
+import json, os, sys, time
+sys.path.insert(0, sys.argv[1])
+start = time.perf_counter()
+import aviatrix_ha
+imported = time.perf_counter()
+client = getattr(aviatrix_ha, 'aws_client', None)
+if client is None:
+    import boto3
+    client = boto3.client
+client('ec2')
+client('lambda')
+clients = time.perf_counter()
+client('ec2')
+client('lambda')
+warm = time.perf_counter()
+getattr(aviatrix_ha, 'transport', None) or aviatrix_ha.requests.Session
+api = time.perf_counter()
+print(json.dumps({'import': imported - start, 'clients': clients - imported,
+                  'warm_clients': warm - clients, 'controller_api': api - warm,
+                  'total': api - start}))
+"""
+
+METRICS = ['unzip', 'import', 'clients', 'warm_clients', 'controller_api', 'total']
+
+
+def extract(zip_path, task_dir):
+    """ Extract the zip to task_dir and compile it. Returns the seconds the extraction took"""
+    start = time.perf_counter()
+    with zipfile.ZipFile(zip_path) as zip_:
+        zip_.extractall(task_dir)
+    elapsed = time.perf_counter() - start
+    # Compiled files of another python version are ignored, compile like the runtime would
+    subprocess.run([sys.executable, '-m', 'compileall', '-q', task_dir], check=True)
+    return elapsed
+
+
+def measure(zip_path, tmp, runs):
+    """ Extract the zip and run the probe in runs fresh interpreters. Returns a list of
+    timings"""
+    env = dict(os.environ, AWS_DEFAULT_REGION=os.environ.get('AWS_DEFAULT_REGION', 'us-east-1'),
+               PYTHONDONTWRITEBYTECODE='1')
+    samples = []
+    for run in range(runs):
+        task_dir = os.path.join(tmp, 'task%d' % run)
+        unzip = extract(zip_path, task_dir)
+        output = subprocess.run([sys.executable, '-c', PROBE, task_dir], env=env, check=True,
+                                stdout=subprocess.PIPE).stdout
+        sample = json.loads(output.decode().splitlines()[-1])
+        sample['unzip'] = unzip
+        sample['total'] += unzip
+        samples.append(sample)
+    return samples
+
+
+def heaviest_imports(task_dir, count=10):
+    """ Top level packages with the largest cumulative import time, from -X importtime"""
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                             'import sys; sys.path.insert(0, sys.argv[1]); import aviatrix_ha',
+                             task_dir], check=True, stderr=subprocess.PIPE).stderr
+    packages = {}
+    for line in stderr.decode().splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = [field.strip() for field in line[len('import time:'):].split('|')]
+        if not name.startswith(' ') and '.' not in name:
+            packages[name] = max(packages.get(name, 0), int(cumulative))
+    return sorted(packages.items(), key=lambda item: -item[1])[:count]
+
+
+def main():
+    """ Run the benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--zip', help='Lambda zip to measure instead of building one')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--save', help='Write the summary as json to this file')
+    parser.add_argument('--baseline', help='Fail if the p50 total regressed against this summary')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        zip_path = args.zip or build_zip(os.path.join(tmp, 'aviatrix_ha.zip'))
+        samples = measure(zip_path, tmp, args.runs)
+        heaviest = heaviest_imports(os.path.join(tmp, 'task0'))
+        with zipfile.ZipFile(zip_path) as zip_:
+            files = len(zip_.infolist())
+        size = os.path.getsize(zip_path)
+
+    summary = {metric: {'p50': statistics.median(sample[metric] for sample in samples),
+                        'max': max(sample[metric] for sample in samples)}
+               for metric in METRICS}
+    summary['zip'] = {'bytes': size, 'files': files}
+    print("Zip of %d files, %.1f KB" % (files, size / 1024))
+    print("%-16s %10s %10s" % ('phase', 'p50 (ms)', 'max (ms)'))
+    for metric in METRICS:
+        values = summary[metric]
+        print("%-16s %10.1f %10.1f" % (metric, values['p50'] * 1000, values['max'] * 1000))
+    print("Heaviest imports (cumulative ms): " +
+          ", ".join("%s %.1f" % (name, micros / 1000) for name, micros in heaviest))
+    if args.save:
+        with open(args.save, 'w') as fileh:
+            json.dump(summary, fileh, indent=2)
+    if args.baseline:
+        with open(args.baseline) as fileh:
+            baseline = json.load(fileh)
+        if summary['total']['p50'] > baseline['total']['p50'] * (1 + args.tolerance):
+            print("Regression: total p50 %.1fms > baseline %.1fms" % (
+                summary['total']['p50'] * 1000, baseline['total']['p50'] * 1000))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
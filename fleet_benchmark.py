@@ -0,0 +1,183 @@
+""" Load benchmark of fleet mode: simultaneous failovers of many controllers
+use as python3 fleet_benchmark.py [--controllers 8] [--concurrency 8] [--runs 3] [--scale 0.01]
+Worker processes share a moto server. Each worker is one lambda container and --concurrency
+bounds how many run at once, like the reserved concurrency of the fleet function.
+All controllers are registered with CFT Create events, then fail over together: their launch
+notifications are dispatched at once. Reports the time from dispatch to the end of each
+restore and of the whole fleet, in scaled seconds. Needs moto[server].
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import statistics
+import sys
+import time
+import urllib.request
+
+import simulator
+from benchmark import percentile
+
+_MODULE = None
+
+
+def _init_worker(endpoint, scale, ami_url, port):
+    """ Import the lambda in a worker process, pointed at the moto server"""
+    global _MODULE  # pylint: disable=global-statement
+    simulator.configure_offline_environment()
+    os.environ['AWS_ENDPOINT_URL'] = endpoint
+    import aviatrix_ha  # pylint: disable=import-outside-toplevel
+    simulator.scale_lambda_delays(aviatrix_ha, scale)
+    aviatrix_ha.AMI_ID = ami_url
+    aviatrix_ha.CONTROLLER_PORT = port
+    _MODULE = aviatrix_ha
+
+
+def _invoke(event, environment, function_name, dispatched):
+    """ Handle one event in a worker. Returns (seconds since dispatched, output)"""
+    os.environ.update(environment)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        _MODULE.lambda_handler(event, simulator.lambda_context(function_name, 'fleet'))
+    return time.time() - dispatched, output.getvalue()
+
+
+def _reset(endpoint):
+    """ Drop every resource of the moto server"""
+    urllib.request.urlopen(urllib.request.Request(endpoint + '/moto-api/reset', data=b'',
+                                                  method='POST')).read()
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run_once(pool, endpoint, args, delays, port, responder, log):
+    """ Register a fleet, fail every controller over at once and delete the fleet.
+    Returns a dict with the registration and failover times and the failures"""
+    _reset(endpoint)
+    fleet = simulator.SimulatedFleet(args.controllers, args.private_access, args.state_backend)
+    environment = fleet.environment()
+
+    def dispatch(events):
+        start = time.time()
+        futures = [pool.submit(_invoke, event, environment, fleet.function_name, start)
+                   for event in events]
+        results = [future.result() for future in futures]
+        for _, output in results:
+            log.write(output)
+        return [elapsed for elapsed, _ in results]
+
+    events = [simulator.cft_event('Create', responder.url, fleet.properties(account))
+              for account in fleet.accounts]
+    registered = dispatch(events)
+    statuses = {response['RequestId']: response['Status'] for response in responder.responses}
+    failures = ['%s create' % account.name for account, event in zip(fleet.accounts, events)
+                if statuses.get(event['RequestId']) != 'SUCCESS']
+
+    controllers = []
+    try:
+        for account in fleet.accounts:
+            _, private_ip = account.replace_instance()
+            controllers.append(simulator.FakeController(
+                private_ip, [account.eip, private_ip], port=port, **delays).start())
+        restored = dispatch([simulator.sns_event('autoscaling:EC2_INSTANCE_LAUNCH',
+                                                 account.instance_id, asg_name=account.name)
+                             for account in fleet.accounts])
+        for account, controller in zip(fleet.accounts, controllers):
+            if not controller.restored or \
+                    account.committed_state().get('INST_ID') != account.instance_id:
+                failures.append('%s failover' % account.name)
+    finally:
+        for controller in controllers:
+            controller.stop()
+
+    dispatch([simulator.cft_event('Delete', responder.url, fleet.properties(account))
+              for account in fleet.accounts])
+    failures.extend('%s delete' % account.name for account in fleet.accounts
+                    if account.committed_state())
+    return {'register': max(registered), 'failover_p50': statistics.median(restored),
+            'failover_p95': percentile(restored, 95), 'failover_max': max(restored),
+            'failures': failures}
+
+
+def main():
+    """ Run the benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--controllers', type=int, default=8)
+    parser.add_argument('--concurrency', type=int, default=None,
+                        help='Worker processes, the controllers by default')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--scale', type=float, default=simulator.DEFAULT_SCALE)
+    parser.add_argument('--state-backend', default='s3', choices=['s3', 'dynamodb'])
+    parser.add_argument('--private-access', action='store_true')
+    parser.add_argument('--log', default='bench_output.txt',
+                        help='File receiving the lambda output')
+    parser.add_argument('--save', help='Write the summary as json to this file')
+    parser.add_argument('--baseline', help='Fail if the failover max regressed against this')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    from moto.server import ThreadedMotoServer  # pylint: disable=import-outside-toplevel
+    simulator.configure_offline_environment()
+    simulator.patch_moto_gaps()
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=_free_port())
+    server.start()
+    endpoint = 'http://127.0.0.1:%d' % server._port  # pylint: disable=protected-access
+    os.environ['AWS_ENDPOINT_URL'] = endpoint
+    import boto3  # pylint: disable=import-outside-toplevel
+    ami_id = boto3.client('ec2', region_name=simulator.REGION).describe_images()['Images'][0][
+        'ImageId']
+    responder = simulator.Responder({'BYOL': {simulator.REGION: ami_id}}).start()
+    port = _free_port()
+    delays = simulator.scaled_delays(args.scale)
+    concurrency = args.concurrency or args.controllers
+    runs = []
+    try:
+        with open(args.log, 'w') as log, concurrent.futures.ProcessPoolExecutor(
+                max_workers=concurrency, mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(endpoint, args.scale, responder.url + '/ami_id.json', port)) as pool:
+            for run in range(args.runs):
+                runs.append(run_once(pool, endpoint, args, delays, port, responder, log))
+                print("run %d: register %.3fs, failover p50 %.3fs max %.3fs%s" % (
+                    run + 1, runs[-1]['register'], runs[-1]['failover_p50'],
+                    runs[-1]['failover_max'],
+                    "" if not runs[-1]['failures'] else
+                    " FAILED " + ", ".join(runs[-1]['failures'])))
+    finally:
+        responder.stop()
+        server.stop()
+
+    summary = {'controllers': args.controllers, 'concurrency': concurrency}
+    for metric in ('register', 'failover_p50', 'failover_p95', 'failover_max'):
+        summary[metric] = statistics.median(run[metric] for run in runs)
+    summary['failures'] = sum(len(run['failures']) for run in runs)
+    print("%d controllers, %d in flight. Median over %d runs, scaled seconds "
+          "(real: divide by %g)" % (args.controllers, concurrency, len(runs), args.scale))
+    for metric in ('register', 'failover_p50', 'failover_p95', 'failover_max'):
+        print("  %-14s %8.3f" % (metric, summary[metric]))
+    if args.save:
+        with open(args.save, 'w') as fileh:
+            json.dump(summary, fileh, indent=2)
+    if args.baseline:
+        with open(args.baseline) as fileh:
+            baseline = json.load(fileh)
+        if summary['failover_max'] > baseline['failover_max'] * (1 + args.tolerance):
+            print("Regression: failover max %.3fs > baseline %.3fs" % (
+                summary['failover_max'], baseline['failover_max']))
+            sys.exit(1)
+    if summary['failures']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,22 @@
 """ Push script for lambda files
-use as ACCESS_KEY=xxxx SECRET_KEY=yyyy python3 push_to_s3.py
+use as ACCESS_KEY=xxxx SECRET_KEY=yyyy python3 push_to_s3.py [--dev] [--force] [--workers 8]
+Objects whose content has not changed are skipped: the SHA-256 of the local file is compared
+with the sha256 metadata of the remote object, or with its ETag, the MD5 of objects uploaded
+before the metadata was set. Ends with a table of what was sent to each region and exits non
+zero when any upload failed. The lambda zip is not pushed when it does not hold the lambda
+files of the tree, build it first with python3 build_zip.py.
 """
 from __future__ import print_function
+import argparse
+import base64
+import concurrent.futures
+import hashlib
 import os
 import sys
-import traceback
-import threading
-import requests
+import time
 import boto3
 from botocore.exceptions import ClientError
+from build_zip import LAMBDA_ZIP_FILE, stale_files
 
 try:
     ACCESS_KEY = os.environ['ACCESS_KEY']
@@ -18,7 +26,6 @@ except KeyError as err:
                     " For dev add --dev") from err
 
 BUCKET_PREFIX = "aviatrix-lambda-"
-LAMBDA_ZIP_FILE = 'aviatrix_ha.zip'
 LAMBDA_ZIP_DEV_FILE = 'aviatrix_ha_dev.zip'
 
 CFT_BUCKET_NAME = "aviatrix-cloudformation-templates"
@@ -26,97 +33,144 @@ CFT_BUCKET_REGION = "us-west-2"
 CFT_FILE_NAME = "aviatrix-aws-existing-controller-ha.json"
 CFT_DEV_FILE_NAME = "aviatrix-aws-existing-controller-ha-dev.json"
 
+# Regions uploaded to at once
+MAX_WORKERS = 8
 
-def push_cft_s3():
-    """ Push CFT to S3"""
-    print(" Pushing CFT")
-    s3_ = boto3.client('s3', aws_access_key_id=ACCESS_KEY, aws_secret_access_key=SECRET_KEY,
-                       region_name=CFT_BUCKET_REGION)
-    dst_file = CFT_FILE_NAME
-    dev = False
-    try:
-        if sys.argv[1] == "--dev":
-            print("Pushing CFT to dev bucket")
-            dev = True
-            dst_file = CFT_DEV_FILE_NAME
-            with open(CFT_FILE_NAME) as fileh:
-                if LAMBDA_ZIP_DEV_FILE not in fileh.read():
-                    raise Exception(LAMBDA_ZIP_DEV_FILE + " not found in lambda in CFT")
-
-    except IndexError:
-        pass
-    if not dev:
-        with open(CFT_FILE_NAME) as fileh:
-            if LAMBDA_ZIP_DEV_FILE in fileh.read():
-                raise Exception(LAMBDA_ZIP_DEV_FILE + " found in lambda in CFT. Not pushing")
 
-    try:
-        s3_.upload_file(CFT_FILE_NAME, CFT_BUCKET_NAME, dst_file,
-                        ExtraArgs={'ACL': 'public-read'})
-    except ClientError:
-        print(traceback.format_exc())
+class LocalFile:
+    """ Content of a file to publish with its digests"""
 
-    # Validate file push
-    url = f'https://{CFT_BUCKET_NAME}.s3.amazonaws.com/{dst_file}'
-    try:
-        requests.get(url)
-    except Exception:
-        print("Validation failed for CFT")
-    print("Pushed CFT")
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fileh:
+            self.body = fileh.read()
+        self.sha256 = hashlib.sha256(self.body).hexdigest()
+        self.md5 = hashlib.md5(self.body)
 
+    def matches(self, head):
+        """ Check if the head_object response of a remote object has the same content"""
+        if head.get('Metadata', {}).get('sha256'):
+            return head['Metadata']['sha256'] == self.sha256
+        return head.get('ETag', '').strip('"') == self.md5.hexdigest()
 
-def push_lambda_file_s3():
-    """ Push lambda file to each region"""
-    ec2_ = boto3.client('ec2', aws_access_key_id=ACCESS_KEY, aws_secret_access_key=SECRET_KEY,
-                        region_name='us-west-1')
-    regions = [reg['RegionName'] for reg in ec2_.describe_regions()['Regions']]
 
-    for region in regions:
-        print (region)
-        threading.Thread(target=push_lambda_file_in_region, args=[region]).start()
-
-
-def push_lambda_file_in_region(region):
-    """ Push"""
-    bucket_name = BUCKET_PREFIX + region
-    s3_ = boto3.client('s3', aws_access_key_id=ACCESS_KEY, aws_secret_access_key=SECRET_KEY,
-                       region_name=region)
-
-    # # Buckets are already created now
-    # try:
-    #     if region == 'us-east-1':
-    #         s3_.create_bucket(Bucket=bucket_name)
-    #     else:
-    #         s3_.create_bucket(Bucket=bucket_name,
-    #                           CreateBucketConfiguration={'LocationConstraint': region})
-    # except ClientError as err:
-    #     if "BucketAlreadyOwnedByYou" in str(err):
-    #         pass
-    #     else:
-    #         print traceback.format_exc()
-
-    dst_file = LAMBDA_ZIP_FILE
-    try:
-        if sys.argv[1] == "--dev":
-            print("Pushing to dev bucket")
-            dst_file = LAMBDA_ZIP_DEV_FILE
-    except IndexError:
-        pass
+class Result:
+    """ Outcome of the publication of a file to a region"""
+
+    def __init__(self, region, bucket, key):
+        self.region = region
+        self.bucket = bucket
+        self.key = key
+        self.status = 'failed'
+        self.bytes_sent = 0
+        self.seconds = 0
+        self.error = ''
 
-    try:
-        s3_.upload_file(LAMBDA_ZIP_FILE, bucket_name, dst_file, ExtraArgs={'ACL': 'public-read'})
-    except ClientError:
-        print(traceback.format_exc())
 
-    # Validate file push
-    url = f'https://{bucket_name}.s3.amazonaws.com/{dst_file}'
+def publish(s3_, local, bucket, key, region, force=False):
+    """ Upload local to bucket/key unless the remote object has the same content, then check
+    that the remote object has the digest of local. Returns a Result"""
+    result = Result(region, bucket, key)
+    start = time.monotonic()
     try:
-        requests.get(url)
-    except Exception:
-        print("Lambda zip validation failed for %s" % region)
-    print("pushed successfully to " + region)
+        head = None
+        try:
+            head = s3_.head_object(Bucket=bucket, Key=key)
+        except ClientError as err:
+            if err.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+                raise
+        if head is not None and not force and local.matches(head):
+            result.status = 'unchanged'
+        else:
+            s3_.put_object(Bucket=bucket, Key=key, Body=local.body, ACL='public-read',
+                           ContentMD5=base64.b64encode(local.md5.digest()).decode(),
+                           Metadata={'sha256': local.sha256})
+            result.bytes_sent = len(local.body)
+            # Validate file push
+            if not local.matches(s3_.head_object(Bucket=bucket, Key=key)):
+                raise Exception("Remote object does not match %s" % local.path)
+            result.status = 'uploaded'
+    except Exception as err:  # pylint: disable=broad-except
+        result.error = str(err)
+    result.seconds = time.monotonic() - start
+    return result
+
+
+def s3_client(region):
+    """ S3 client of region"""
+    return boto3.client('s3', aws_access_key_id=ACCESS_KEY, aws_secret_access_key=SECRET_KEY,
+                        region_name=region)
+
+
+def push_cft_s3(dev=False, force=False):
+    """ Push CFT to S3"""
+    print(" Pushing CFT")
+    dst_file = CFT_FILE_NAME
+    with open(CFT_FILE_NAME) as fileh:
+        template = fileh.read()
+    if dev:
+        print("Pushing CFT to dev bucket")
+        dst_file = CFT_DEV_FILE_NAME
+        if LAMBDA_ZIP_DEV_FILE not in template:
+            raise Exception(LAMBDA_ZIP_DEV_FILE + " not found in lambda in CFT")
+    elif LAMBDA_ZIP_DEV_FILE in template:
+        raise Exception(LAMBDA_ZIP_DEV_FILE + " found in lambda in CFT. Not pushing")
+    return publish(s3_client(CFT_BUCKET_REGION), LocalFile(CFT_FILE_NAME), CFT_BUCKET_NAME,
+                   dst_file, CFT_BUCKET_REGION, force)
+
+
+def push_lambda_file_s3(dev=False, force=False, workers=MAX_WORKERS):
+    """ Push lambda file to each region, workers regions at a time. Returns the list of
+    Results"""
+    ec2_ = boto3.client('ec2', aws_access_key_id=ACCESS_KEY, aws_secret_access_key=SECRET_KEY,
+                        region_name='us-west-1')
+    regions = [reg['RegionName'] for reg in ec2_.describe_regions()['Regions']]
+    dst_file = LAMBDA_ZIP_DEV_FILE if dev else LAMBDA_ZIP_FILE
+    if dev:
+        print("Pushing to dev bucket")
+    local = LocalFile(LAMBDA_ZIP_FILE)
+    # Clients are created here, creating them in the threads is not thread safe
+    clients = {region: s3_client(region) for region in regions}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(publish, clients[region], local, BUCKET_PREFIX + region,
+                               dst_file, region, force) for region in regions]
+        return [future.result() for future in futures]
+
+
+def print_results(results):
+    """ Print the result table"""
+    print("%-16s %-10s %10s %8s  %s" % ('region', 'status', 'bytes sent', 'time (s)', 'object'))
+    for result in results:
+        print("%-16s %-10s %10d %8.2f  %s/%s%s" % (
+            result.region, result.status, result.bytes_sent, result.seconds, result.bucket,
+            result.key, "  " + result.error if result.error else ""))
+    print("%d uploaded, %d unchanged, %d failed, %d bytes sent" % (
+        len([result for result in results if result.status == 'uploaded']),
+        len([result for result in results if result.status == 'unchanged']),
+        len([result for result in results if result.status == 'failed']),
+        sum(result.bytes_sent for result in results)))
+
+
+def main():
+    """ Push the CFT and the lambda zip"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dev', action='store_true', help='Push to the dev objects')
+    parser.add_argument('--force', action='store_true', help='Upload unchanged objects too')
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS,
+                        help='Regions uploaded to at once')
+    args = parser.parse_args()
+    stale = stale_files(LAMBDA_ZIP_FILE)
+    if stale:
+        raise Exception("%s is stale: %s. Run python3 build_zip.py" % (
+            LAMBDA_ZIP_FILE, ", ".join(stale[:5])))
+    start = time.monotonic()
+    results = [push_cft_s3(args.dev, args.force)]
+    results.extend(push_lambda_file_s3(args.dev, args.force, args.workers))
+    print_results(results)
+    print("Done in %.1fs" % (time.monotonic() - start))
+    if any(result.status == 'failed' for result in results):
+        sys.exit(1)
 
 
 if __name__ == '__main__':
-    push_cft_s3()
-    push_lambda_file_s3()
+    main()
@@ -0,0 +1,676 @@
+""" Offline failover simulator
+Runs a fake Aviatrix controller over HTTPS and a moto backed AWS account so that
+aviatrix_ha.lambda_handler can be exercised without AWS or a real controller.
+Needs moto: pip install "moto[ec2,autoscaling,s3,sns,awslambda,sts,iam]"
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+REGION = 'us-west-2'
+CONTROLLER_NAME = 'ha_ctrl'
+BACKUP_BUCKET = 'sim-backup-bucket'
+STATE_TABLE = 'sim-ha-state'
+CONTROLLER_VERSION = '6.4.2499'
+
+DEFAULT_SCALE = 0.01
+# Delays of a real failover in seconds, multiplied by the scale of the run
+DEFAULT_DELAYS = {
+    'boot_time': 150,
+    'setup_time': 240,
+    'restart_time': 45,
+    'restore_time': 60,
+    'latency': 0.2,
+}
+QUEUED_INVOCATIONS = []
+LAMBDA_TUNABLES = ['MAX_LOGIN_TIMEOUT', 'WAIT_DELAY', 'INITIAL_SETUP_WAIT', 'INITIAL_SETUP_DELAY',
+                   'INITIAL_SETUP_API_WAIT', 'READINESS_PROBE_TIMEOUT', 'READINESS_BACKOFF_BASE',
+                   'READINESS_BACKOFF_CAP', 'CONTINUATION_MARGIN', 'HEALTH_PROBE_INTERVAL']
+
+
+def configure_offline_environment():
+    """ Fake credentials and region so that boto3 never reaches AWS"""
+    for key, value in (('AWS_ACCESS_KEY_ID', 'testing'), ('AWS_SECRET_ACCESS_KEY', 'testing'),
+                       ('AWS_SESSION_TOKEN', 'testing'), ('AWS_DEFAULT_REGION', REGION)):
+        os.environ[key] = value
+
+
+def patch_moto_gaps():
+    """ Fill in the EC2 and autoscaling actions used by the lambda that moto does not
+    implement"""
+    # pylint: disable=import-outside-toplevel
+    from moto.autoscaling.responses import AutoScalingResponse
+    from moto.awslambda.models import LambdaBackend
+    from moto.ec2.responses.instances import InstanceResponse
+    from moto.core.responses import ActionResult, EmptyResult
+
+    def put_notification_configuration(self):
+        configurations = getattr(self.autoscaling_backend, 'notification_configurations', {})
+        self.autoscaling_backend.notification_configurations = configurations
+        group_name = self._get_param('AutoScalingGroupName')
+        for notification_type in self._get_param('NotificationTypes', []):
+            configurations[(group_name, notification_type)] = self._get_param('TopicARN')
+        return EmptyResult()
+
+    def describe_notification_configurations(self):
+        configurations = getattr(self.autoscaling_backend, 'notification_configurations', {})
+        group_names = self._get_param('AutoScalingGroupNames', [])
+        return ActionResult({'NotificationConfigurations': [
+            {'AutoScalingGroupName': group_name, 'NotificationType': notification_type,
+             'TopicARN': topic_arn}
+            for (group_name, notification_type), topic_arn in configurations.items()
+            if not group_names or group_name in group_names]})
+
+    def complete_lifecycle_action(self):
+        completed = getattr(self.autoscaling_backend, 'completed_lifecycle_actions', [])
+        self.autoscaling_backend.completed_lifecycle_actions = completed
+        completed.append((self._get_param('LifecycleActionToken'),
+                          self._get_param('LifecycleActionResult')))
+        return EmptyResult()
+
+    def invoke(self, function_name, qualifier, body, headers, response_headers):
+        if headers.get('X-Amz-Invocation-Type') != 'Event':
+            return invoke.original(self, function_name, qualifier, body, headers,
+                                   response_headers)
+        # Asynchronous invocations are queued for the caller to run, see queued_invocations
+        self.get_function(function_name, qualifier)
+        QUEUED_INVOCATIONS.append((function_name, json.loads(body)))
+        return b''
+
+    def modify_instance_credit_specification(self):  # pylint: disable=unused-argument
+        return ActionResult({'SuccessfulInstanceCreditSpecifications': [],
+                             'UnsuccessfulInstanceCreditSpecifications': []})
+
+    if not hasattr(InstanceResponse, 'modify_instance_credit_specification'):
+        InstanceResponse.modify_instance_credit_specification = \
+            modify_instance_credit_specification
+    if not hasattr(AutoScalingResponse, 'put_notification_configuration'):
+        AutoScalingResponse.put_notification_configuration = put_notification_configuration
+    if not hasattr(AutoScalingResponse, 'complete_lifecycle_action'):
+        AutoScalingResponse.complete_lifecycle_action = complete_lifecycle_action
+    if not hasattr(AutoScalingResponse, 'describe_notification_configurations'):
+        AutoScalingResponse.describe_notification_configurations = \
+            describe_notification_configurations
+    if not hasattr(LambdaBackend.invoke, 'original'):
+        invoke.original = LambdaBackend.invoke
+        LambdaBackend.invoke = invoke
+
+
+def queued_invocations():
+    """ Take the events of the asynchronous lambda invocations made so far, as a list of
+    (function name, event)"""
+    queued = list(QUEUED_INVOCATIONS)
+    del QUEUED_INVOCATIONS[:len(queued)]
+    return queued
+
+
+def generate_certificate(directory):
+    """ Creates a self signed certificate for the fake controller. Returns (cert, key)"""
+    cert = os.path.join(directory, 'controller.crt')
+    key = os.path.join(directory, 'controller.key')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-subj', '/CN=fake-controller', '-keyout', key, '-out', cert],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
+
+
+class FakeController:
+    """ HTTPS server modelling the controller API used during a restore:
+    login -> initial_setup check|run -> setup_account_profile -> restore_cloudx_config.
+    All delays are in seconds of wall time. The same state is served on every address
+    in addresses so that the public and the private path reach the same controller.
+    path_delays maps an address to the seconds it stays unreachable after the start.
+    Connections are refused while hung is set. While api_hung is set the TLS handshake
+    succeeds but API requests get no response, like a controller whose web server is stuck"""
+
+    def __init__(self, private_ip, addresses, port=0, boot_time=0, setup_time=0,
+                 restart_time=0, restore_time=0, latency=0, session_ttl=None, drop_rate=0,
+                 drop_on_setup_run=True, initial_setup_done=False, cert_dir=None,
+                 path_delays=None):
+        self.private_ip = private_ip
+        self.boot_time = boot_time
+        self.setup_time = setup_time
+        self.restart_time = restart_time
+        self.restore_time = restore_time
+        self.latency = latency
+        self.session_ttl = session_ttl
+        self.drop_rate = drop_rate
+        self.drop_on_setup_run = drop_on_setup_run
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.unavailable_until = self.started + boot_time
+        self.path_delays = path_delays or {}
+        self.setup_state = 'done' if initial_setup_done else 'not run'
+        self.sessions = {}
+        self.accounts = set()
+        self.restored = False
+        self.hung = False
+        self.api_hung = False
+        self.stats = {}
+        self._own_cert_dir = cert_dir is None
+        self.cert_dir = cert_dir or tempfile.mkdtemp(prefix='fake-controller-')
+        cert, key = generate_certificate(self.cert_dir)
+        self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.ssl_context.load_cert_chain(cert, key)
+        self.servers = []
+        self.port = port
+        for address in addresses:
+            server = _ControllerHTTPServer((address, self.port), _ControllerHandler, self)
+            self.port = server.server_address[1]
+            self.servers.append(server)
+
+    def start(self):
+        """ Serve on every address in background threads"""
+        for server in self.servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        """ Stop serving and remove the certificate"""
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        if self._own_cert_dir:
+            shutil.rmtree(self.cert_dir, ignore_errors=True)
+
+    def available(self, address=None):
+        """ False while the instance boots or the services restart, or while the path to
+        address is not up yet"""
+        now = time.monotonic()
+        return not self.hung and now >= self.unavailable_until and \
+            now >= self.started + self.path_delays.get(address, 0)
+
+    def count(self, name):
+        """ Count a request or an event for reporting"""
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + 1
+
+    def handle(self, params):
+        """ Run one API action. Returns the response json or None to drop the connection"""
+        action = params.get('action', '')
+        self.count(action or 'probe')
+        if self.latency:
+            time.sleep(self.latency)
+        if not action:
+            return {'return': False, 'reason': 'valid action required'}
+        if action == 'login':
+            return self._login(params)
+        response = self._run(action, params)
+        # Like a controller restarting its services, the action ran but its response is lost
+        if self.drop_rate and random.random() < self.drop_rate:
+            self.count('dropped')
+            return None
+        return response
+
+    def _run(self, action, params):
+        cid = params.get('CID', '')
+        with self.lock:
+            created = self.sessions.get(cid)
+        if created is None:
+            return {'return': False, 'reason': 'CID is invalid or expired.'}
+        if self.session_ttl is not None and time.monotonic() - created > self.session_ttl:
+            return {'return': False, 'reason': 'Session %s expired' % cid}
+        if action == 'initial_setup':
+            if params.get('subaction') == 'run':
+                return self._run_initial_setup()
+            return self._check_initial_setup()
+        if self.setup_state != 'done':
+            return {'return': False, 'reason': 'account_password required.'}
+        if action == 'setup_account_profile':
+            return self._setup_account(params)
+        if action == 'restore_cloudx_config':
+            return self._restore(params)
+        if action == 'setup_customer_id':
+            return {'return': True, 'results': 'Customer ID saved'}
+        return {'return': False, 'reason': 'valid action required'}
+
+    def _login(self, params):
+        if params.get('username') != 'admin' or params.get('password') != self.private_ip:
+            return {'return': False, 'reason': 'Invalid username or password'}
+        cid = uuid.uuid4().hex
+        with self.lock:
+            self.sessions[cid] = time.monotonic()
+        return {'return': True, 'CID': cid}
+
+    def _check_initial_setup(self):
+        if self.setup_state == 'done':
+            return {'return': True, 'results': 'initial setup complete'}
+        return {'return': False, 'reason': 'not run'}
+
+    def _run_initial_setup(self):
+        if self.setup_state == 'done':
+            return {'return': True, 'results': 'initial setup complete'}
+        self.setup_state = 'running'
+        self.count('initial_setup_run')
+        time.sleep(self.setup_time)
+        with self.lock:
+            # Upgrading restarts apache and cloudxd. Every session is lost
+            self.setup_state = 'done'
+            self.sessions.clear()
+            self.unavailable_until = time.monotonic() + self.restart_time
+        if self.drop_on_setup_run:
+            return None
+        return {'return': True, 'results': 'initial setup complete'}
+
+    def _setup_account(self, params):
+        name = params.get('account_name')
+        with self.lock:
+            if name in self.accounts:
+                return {'return': False, 'reason': 'Account %s already exists' % name}
+            self.accounts.add(name)
+        return {'return': True, 'results': 'Account %s created' % name}
+
+    def _restore(self, params):
+        if params.get('account_name') not in self.accounts:
+            return {'return': False, 'reason': 'Account not found'}
+        time.sleep(self.restore_time)
+        self.restored = True
+        return {'return': True, 'results': 'Restored %s' % params.get('file_name')}
+
+
+class _ControllerHTTPServer(ThreadingHTTPServer):
+    """ Refuses connections before the TLS handshake while the controller is unavailable"""
+    daemon_threads = True
+
+    def __init__(self, server_address, handler, controller):
+        self.controller = controller
+        super().__init__(server_address, handler)
+
+    def get_request(self):
+        sock, addr = self.socket.accept()
+        if not self.controller.available(self.server_address[0]):
+            self.controller.count('refused')
+            sock.close()
+            raise OSError("controller unavailable")
+        try:
+            return self.controller.ssl_context.wrap_socket(sock, server_side=True), addr
+        except (ssl.SSLError, OSError):
+            sock.close()
+            raise
+
+    def handle_error(self, request, client_address):
+        """ Dropped connections are part of the simulation"""
+
+
+class _ControllerHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """ login and the readiness probe"""
+        self._dispatch({k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()})
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """ Every other action"""
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        self._dispatch({k: v[0] for k, v in parse_qs(body).items()})
+
+    def _dispatch(self, params):
+        controller = self.server.controller
+        if controller.api_hung or not controller.available():
+            controller.count('unanswered')
+            self.close_connection = True
+            return
+        response = controller.handle(params)
+        if response is None:
+            self.close_connection = True
+            return
+        body = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Responder:
+    """ Plain HTTP server standing in for the CloudFormation response URL and the public
+    AMI catalog. The catalog is served with an ETag, after catalog_delay seconds"""
+
+    def __init__(self, ami_catalog, catalog_delay=0):
+        self.ami_catalog = ami_catalog
+        self.catalog_delay = catalog_delay
+        self.catalog_requests = []
+        self.responses = []
+        self.server = HTTPServer(('127.0.0.1', 0), _ResponderHandler)
+        self.server.responder = self
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def start(self):
+        """ Serve in a background thread"""
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        """ Stop serving"""
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _ResponderHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """ AMI catalog"""
+        responder = self.server.responder
+        body = json.dumps(responder.ami_catalog).encode()
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        time.sleep(responder.catalog_delay)
+        if self.headers.get('If-None-Match') == etag:
+            responder.catalog_requests.append(304)
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        responder.catalog_requests.append(200)
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PUT(self):  # pylint: disable=invalid-name
+        """ CloudFormation custom resource response"""
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.responder.responses.append(json.loads(body))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class SimulatedAccount:
+    """ A moto backed AWS account holding one controller with its EIP, backups and the
+    HA lambda function. Must be used inside moto.mock_aws() or against a moto server.
+    Controllers of different index use different loopback networks, 127.<index>.0.0/16,
+    so that several can share an account. With function=False the lambda function is left
+    to the caller, see SimulatedFleet"""
+
+    def __init__(self, name=CONTROLLER_NAME, private_access=False, state_backend='lambda',
+                 warm_pool=False, index=0, function=True):
+        import boto3  # pylint: disable=import-outside-toplevel
+        self.name = name
+        self.private_access = private_access
+        self.state_backend = state_backend
+        self.warm_pool = warm_pool
+        self.network = '127.%d' % index
+        self.eip = self.network + '.0.1'
+        self.ec2 = boto3.client('ec2', region_name=REGION)
+        self.lambda_client = boto3.client('lambda', region_name=REGION)
+        self.s3_client = boto3.client('s3', region_name=REGION)
+        self.vpc_id = self.ec2.create_vpc(CidrBlock=self.network + '.0.0/16')['Vpc']['VpcId']
+        self.subnets = [self.ec2.create_subnet(VpcId=self.vpc_id,
+                                               CidrBlock='%s.%d.0/24' % (self.network, subnet))
+                        ['Subnet']['SubnetId'] for subnet in (1, 2)]
+        self.sg_id = self.ec2.create_security_group(
+            GroupName=name + '-sg', Description='controller', VpcId=self.vpc_id)['GroupId']
+        self.ami_id = self.ec2.describe_images()['Images'][0]['ImageId']
+        self.ec2.create_key_pair(KeyName=name + '-key')
+        self.iam = boto3.client('iam', region_name=REGION)
+        self._create_shared_resources()
+        self.instance_count = 0
+        self.instance_id, self.private_ip = self.launch_instance()
+        self.eip_alloc_id = self.ec2.allocate_address(Domain='vpc',
+                                                      Address=self.eip)['AllocationId']
+        self.ec2.associate_address(AllocationId=self.eip_alloc_id, InstanceId=self.instance_id)
+        self.write_backup(self.private_ip)
+        self.function_name = name + '-ha'
+        self._env_keys = set()
+        if function:
+            self._create_function()
+
+    def _create_shared_resources(self):
+        """ Instance profile, backup bucket and state table, created by the first controller
+        of the account"""
+        import boto3  # pylint: disable=import-outside-toplevel
+        profiles = self.iam.list_instance_profiles()['InstanceProfiles']
+        if any(profile['InstanceProfileName'] == 'aviatrix-role-ec2' for profile in profiles):
+            self.instance_profile_arn = [profile['Arn'] for profile in profiles if
+                                         profile['InstanceProfileName'] == 'aviatrix-role-ec2'][0]
+        else:
+            self.instance_profile_arn = self.iam.create_instance_profile(
+                InstanceProfileName='aviatrix-role-ec2')['InstanceProfile']['Arn']
+        if BACKUP_BUCKET not in [bucket['Name'] for bucket in
+                                 self.s3_client.list_buckets()['Buckets']]:
+            self.s3_client.create_bucket(Bucket=BACKUP_BUCKET, CreateBucketConfiguration={
+                'LocationConstraint': REGION})
+        dynamodb = boto3.client('dynamodb', region_name=REGION)
+        if self.state_backend == 'dynamodb' and \
+                STATE_TABLE not in dynamodb.list_tables()['TableNames']:
+            dynamodb.create_table(
+                TableName=STATE_TABLE, BillingMode='PAY_PER_REQUEST',
+                AttributeDefinitions=[{'AttributeName': 'controller', 'AttributeType': 'S'}],
+                KeySchema=[{'AttributeName': 'controller', 'KeyType': 'HASH'}])
+
+    def launch_instance(self):
+        """ Run a controller instance with the Name tag. Returns (instance id, private ip)"""
+        self.instance_count += 1
+        private_ip = '%s.1.%d' % (self.network, 9 + self.instance_count)
+        instance = self.ec2.run_instances(
+            ImageId=self.ami_id, MinCount=1, MaxCount=1, InstanceType='t3.large',
+            SubnetId=self.subnets[0], PrivateIpAddress=private_ip,
+            SecurityGroupIds=[self.sg_id], KeyName=self.name + '-key',
+            IamInstanceProfile={'Arn': self.instance_profile_arn},
+            TagSpecifications=[{'ResourceType': 'instance',
+                                'Tags': [{'Key': 'Name', 'Value': self.name}]}],
+        )['Instances'][0]
+        return instance['InstanceId'], private_ip
+
+    def write_backup(self, private_ip, size=1024 * 1024):
+        """ Upload the encrypted backup and the version file of a controller"""
+        self.s3_client.put_object(Bucket=BACKUP_BUCKET,
+                                  Key='CloudN_%s_save_cloudx_config.enc' % private_ip,
+                                  Body=os.urandom(size))
+        self.s3_client.put_object(Bucket=BACKUP_BUCKET,
+                                  Key='CloudN_%s_save_cloudx_version.txt' % private_ip,
+                                  Body=('UserConnect-%s' % CONTROLLER_VERSION).encode())
+
+    def _create_function(self):
+        role = self.iam.create_role(
+            RoleName=self.name + '-role-lambda', AssumeRolePolicyDocument='{}')['Role']['Arn']
+        code = io.BytesIO()
+        with zipfile.ZipFile(code, 'w') as zip_:
+            zip_.writestr('aviatrix_ha.py', '')
+        self.lambda_client.create_function(
+            FunctionName=self.function_name, Runtime='python3.12', Role=role,
+            Handler='aviatrix_ha.lambda_handler', Code={'ZipFile': code.getvalue()},
+            Environment={'Variables': {
+                'AVIATRIX_TAG': self.name,
+                'SUBNETLIST': ','.join(self.subnets),
+                'S3_BUCKET_BACK': BACKUP_BUCKET,
+                'API_PRIVATE_ACCESS': str(self.private_access),
+                'NOTIF_EMAIL': '',
+                'STATE_BACKEND': self.state_backend,
+                'STATE_TABLE': STATE_TABLE,
+                'WARM_POOL': 'Stopped' if self.warm_pool else '',
+                'WARM_POOL_ROLE_ARN': role if self.warm_pool else ''}})
+
+    def load_environment(self):
+        """ Make os.environ look like a fresh lambda container of the function"""
+        variables = self.lambda_client.get_function_configuration(
+            FunctionName=self.function_name)['Environment']['Variables']
+        for key in self._env_keys:
+            os.environ.pop(key, None)
+        state = self.committed_state()
+        self._env_keys = set(variables) | set(state)
+        os.environ.update({key: value for key, value in variables.items() if value is not None})
+        return dict(variables, **state)
+
+    def committed_state(self):
+        """ State written to the s3 or dynamodb state store by the lambda"""
+        import boto3  # pylint: disable=import-outside-toplevel
+        if self.state_backend == 's3':
+            try:
+                body = self.s3_client.get_object(
+                    Bucket=BACKUP_BUCKET, Key='aviatrix-ha-state/%s.json' % self.name)['Body']
+            except self.s3_client.exceptions.NoSuchKey:
+                return {}
+            return json.loads(body.read())
+        if self.state_backend == 'dynamodb':
+            item = boto3.client('dynamodb', region_name=REGION).get_item(
+                TableName=STATE_TABLE, Key={'controller': {'S': self.name}}).get('Item')
+            return json.loads(item['state']['S']) if item else {}
+        return {}
+
+    def launch_standby(self):
+        """ Launch an instance into the warm pool. Returns (instance id, private ip)"""
+        return self.launch_instance()
+
+    def stop_standby(self, instance_id):
+        """ Stop the standby once its lifecycle action is complete, like the warm pool does"""
+        self.ec2.stop_instances(InstanceIds=[instance_id])
+
+    def replace_instance(self, standby=None):
+        """ Terminate the controller and launch a replacement like the ASG would. standby is
+        the (instance id, private ip) of a stopped warm pool instance to start instead.
+        Returns (instance id, private ip) of the new instance"""
+        import boto3  # pylint: disable=import-outside-toplevel
+        asg_client = boto3.client('autoscaling', region_name=REGION)
+        in_asg = bool(asg_client.describe_auto_scaling_groups(
+            AutoScalingGroupNames=[self.name])['AutoScalingGroups'])
+        if in_asg:
+            # The replacement is launched below, with a private IP the fake controller knows
+            asg_client.detach_instances(InstanceIds=[self.instance_id],
+                                        AutoScalingGroupName=self.name,
+                                        ShouldDecrementDesiredCapacity=True)
+        # Terminating an instance releases its EIP association, moto does not
+        for address in self.ec2.describe_addresses(Filters=[
+                {'Name': 'instance-id', 'Values': [self.instance_id]}])['Addresses']:
+            self.ec2.disassociate_address(AssociationId=address['AssociationId'])
+        self.ec2.terminate_instances(InstanceIds=[self.instance_id])
+        if standby:
+            self.ec2.start_instances(InstanceIds=[standby[0]])
+            self.instance_id, self.private_ip = standby
+        else:
+            self.instance_id, self.private_ip = self.launch_instance()
+        if in_asg:
+            asg_client.attach_instances(InstanceIds=[self.instance_id],
+                                        AutoScalingGroupName=self.name)
+        return self.instance_id, self.private_ip
+
+    def context(self, timeout=900):
+        """ Lambda context object"""
+        return lambda_context(self.function_name, 'simulator/' + self.name, timeout)
+
+
+def lambda_context(function_name, log_stream_name, timeout=900):
+    """ Lambda context object of an invocation starting now, timing out after timeout
+    seconds"""
+    deadline = time.monotonic() + timeout
+    return argparse.Namespace(
+        function_name=function_name, log_stream_name=log_stream_name,
+        aws_request_id=str(uuid.uuid4()),
+        get_remaining_time_in_millis=lambda: max(0, int((deadline - time.monotonic()) * 1000)))
+
+
+class SimulatedFleet:
+    """ Controllers sharing one account and one HA lambda function in fleet mode"""
+
+    def __init__(self, size, private_access=False, state_backend='s3'):
+        import boto3  # pylint: disable=import-outside-toplevel
+        self.accounts = [SimulatedAccount('%s_%d' % (CONTROLLER_NAME, index + 1), private_access,
+                                          state_backend, index=index + 1, function=False)
+                         for index in range(size)]
+        self.function_name = 'fleet-ha'
+        self.lambda_client = boto3.client('lambda', region_name=REGION)
+        role = self.accounts[0].iam.create_role(
+            RoleName='fleet-role-lambda', AssumeRolePolicyDocument='{}')['Role']['Arn']
+        code = io.BytesIO()
+        with zipfile.ZipFile(code, 'w') as zip_:
+            zip_.writestr('aviatrix_ha.py', '')
+        self.lambda_client.create_function(
+            FunctionName=self.function_name, Runtime='python3.12', Role=role,
+            Handler='aviatrix_ha.lambda_handler', Code={'ZipFile': code.getvalue()},
+            Environment={'Variables': {'FLEET_MODE': 'True', 'STATE_BACKEND': state_backend,
+                                       'STATE_TABLE': STATE_TABLE,
+                                       'STATE_BUCKET': BACKUP_BUCKET}})
+        for account in self.accounts:
+            account.function_name = self.function_name
+
+    def environment(self):
+        """ Environment of the fleet function"""
+        return self.lambda_client.get_function_configuration(
+            FunctionName=self.function_name)['Environment']['Variables']
+
+    @staticmethod
+    def properties(account):
+        """ Custom::SetupHA properties registering a controller"""
+        return {'AviatrixTag': account.name, 'SubnetList': account.subnets,
+                'S3BucketBack': BACKUP_BUCKET, 'PrivateAccess': str(account.private_access),
+                'NotifEmail': ''}
+
+
+def cft_event(request_type, response_url, properties=None):
+    """ CloudFormation custom resource event"""
+    event = {'StackId': 'arn:aws:cloudformation:%s:123456789012:stack/sim/1' % REGION,
+             'ResponseURL': response_url + '/cft',
+             'RequestType': request_type,
+             'ResourceType': 'Custom::SetupHA',
+             'RequestId': str(uuid.uuid4()),
+             'LogicalResourceId': 'SetupHA'}
+    if properties:
+        event['ResourceProperties'] = properties
+    return event
+
+
+def sns_event(asg_event, instance_id='', asg_name=CONTROLLER_NAME, description=''):
+    """ SNS notification from the autoscaling group"""
+    message = {'Event': asg_event, 'EC2InstanceId': instance_id,
+               'AutoScalingGroupName': asg_name, 'Description': description,
+               'AccountId': '123456789012', 'Service': 'AWS Auto Scaling'}
+    return {'Records': [{'EventSource': 'aws:sns',
+                         'Sns': {'MessageId': str(uuid.uuid4()),
+                                 'TopicArn': 'arn:aws:sns:%s:123456789012:%s' % (REGION,
+                                                                                 asg_name),
+                                 'Message': json.dumps(message)}}]}
+
+
+def lifecycle_event(instance_id, origin, destination, asg_name=CONTROLLER_NAME):
+    """ SNS notification of the launch lifecycle hook of the warm pool"""
+    message = {'Origin': origin, 'Destination': destination,
+               'LifecycleHookName': asg_name + '-warm-pool', 'AccountId': '123456789012',
+               'RequestId': str(uuid.uuid4()), 'Service': 'AWS Auto Scaling',
+               'LifecycleTransition': 'autoscaling:EC2_INSTANCE_LAUNCHING',
+               'AutoScalingGroupName': asg_name, 'EC2InstanceId': instance_id,
+               'LifecycleActionToken': str(uuid.uuid4())}
+    return {'Records': [{'EventSource': 'aws:sns',
+                         'Sns': {'MessageId': str(uuid.uuid4()),
+                                 'TopicArn': 'arn:aws:sns:%s:123456789012:%s' % (REGION,
+                                                                                 asg_name),
+                                 'Message': json.dumps(message)}}]}
+
+
+def health_check_event(controller_name=None):
+    """ Input of the scheduled health check rule. controller_name in fleet mode"""
+    return {'HealthCheck': controller_name or True}
+
+
+def scale_lambda_delays(module, scale):
+    """ Scale the waits of the lambda module. Returns the previous values"""
+    previous = {name: getattr(module, name) for name in LAMBDA_TUNABLES}
+    for name, value in previous.items():
+        setattr(module, name, value * scale)
+    return previous
+
+
+def scaled_delays(scale, **overrides):
+    """ Fake controller delays for a run at the given scale"""
+    delays = dict(DEFAULT_DELAYS, **overrides)
+    return {name: value * scale for name, value in delays.items()}
@@ -0,0 +1,129 @@
+""" Tests of the scheduled health check against a fake controller whose API hangs.
+Run as python3 -m unittest test_health_check"""
+import os
+import unittest
+from unittest import mock
+
+import boto3
+from moto import mock_aws
+
+import aviatrix_ha
+import simulator
+
+
+class MemoryStateStore(aviatrix_ha.StateStore):
+    """ State kept in a dict"""
+    name = 'memory'
+
+    def __init__(self):
+        super().__init__()
+        self.state = {}
+
+    def _read(self):
+        return dict(self.state)
+
+    def _write(self, values):
+        self.state.update(values)
+
+
+class HealthCheckTest(unittest.TestCase):
+    """ check_controller_health only sets the controller Unhealthy once
+    HEALTH_FAILURE_THRESHOLD probes in a row failed"""
+
+    def setUp(self):
+        simulator.configure_offline_environment()
+        simulator.patch_moto_gaps()
+        self.mock = mock_aws()
+        self.mock.start()
+        self.addCleanup(self.mock.stop)
+        self.account = simulator.SimulatedAccount(private_access=True, function=False)
+        self.asg_client = boto3.client('autoscaling', region_name=simulator.REGION)
+        self.asg_client.create_launch_configuration(
+            LaunchConfigurationName=self.account.name, ImageId=self.account.ami_id,
+            InstanceType='t3.large')
+        self.asg_client.create_auto_scaling_group(
+            AutoScalingGroupName=self.account.name,
+            LaunchConfigurationName=self.account.name, MinSize=0, MaxSize=1,
+            DesiredCapacity=0, VPCZoneIdentifier=self.account.subnets[0])
+        self.asg_client.attach_instances(InstanceIds=[self.account.instance_id],
+                                         AutoScalingGroupName=self.account.name)
+        self.controller = simulator.FakeController(
+            self.account.private_ip, [self.account.private_ip], initial_setup_done=True).start()
+        self.addCleanup(self.controller.stop)
+        environ = {'INST_ID': self.account.instance_id, 'PRIV_IP': self.account.private_ip,
+                   'EIP': self.account.eip, 'API_PRIVATE_ACCESS': 'True', 'HEALTH_WINDOW': ''}
+        patcher = mock.patch.dict(os.environ, environ)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for name, value in (('CONTROLLER_PORT', self.controller.port),
+                            ('HEALTH_CHECK_GRACE', 0), ('HEALTH_PROBE_INTERVAL', 0),
+                            ('READINESS_PROBE_TIMEOUT', 0.2)):
+            patcher = mock.patch.object(aviatrix_ha, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.store = MemoryStateStore()
+
+    def health(self):
+        """ Health status of the controller instance in the ASG"""
+        return self.asg_client.describe_auto_scaling_instances(
+            InstanceIds=[self.account.instance_id])['AutoScalingInstances'][0]['HealthStatus']
+
+    def check(self, answered_after=None):
+        """ Run a health check. With answered_after, the API hangs for that many probes.
+        Returns (whether the instance was set Unhealthy, number of probes)"""
+        probes = []
+        probe_api_paths = aviatrix_ha.probe_api_paths
+
+        def probe(paths):
+            probes.append(paths)
+            self.controller.api_hung = answered_after is None or len(probes) <= answered_after
+            return probe_api_paths(paths)
+
+        with mock.patch.object(aviatrix_ha, 'probe_api_paths', probe):
+            unhealthy = aviatrix_ha.check_controller_health(
+                aviatrix_ha.aws_client('ec2'), self.store)
+        self.controller.api_hung = False
+        return unhealthy, len(probes)
+
+    def test_healthy(self):
+        self.assertEqual(self.check(answered_after=0), (False, 1))
+        self.assertEqual(self.health(), 'Healthy')
+        self.assertNotIn('HEALTH_WINDOW', self.store.state)
+
+    def test_missed_probes_below_threshold(self):
+        self.assertEqual(self.check(answered_after=2), (False, 3))
+        self.assertEqual(self.health(), 'Healthy')
+        self.assertEqual(self.store.state['HEALTH_WINDOW'], '001')
+        self.assertEqual(aviatrix_ha.consecutive_failures(os.environ['HEALTH_WINDOW']), 0)
+
+    def test_healthy_probe_resets_count(self):
+        # Failures of earlier checks add up until a probe is answered
+        os.environ['HEALTH_WINDOW'] = '0' * (aviatrix_ha.HEALTH_FAILURE_THRESHOLD - 1)
+        self.assertEqual(self.check(answered_after=0), (False, 1))
+        self.assertEqual(self.health(), 'Healthy')
+        self.assertEqual(aviatrix_ha.consecutive_failures(self.store.state['HEALTH_WINDOW']), 0)
+        # The count starts over, a single failure is not enough
+        self.assertEqual(self.check(answered_after=1), (False, 2))
+        self.assertEqual(self.health(), 'Healthy')
+        self.assertEqual(aviatrix_ha.consecutive_failures(os.environ['HEALTH_WINDOW']), 0)
+
+    def test_failures_add_up_across_checks(self):
+        os.environ['HEALTH_WINDOW'] = '0' * (aviatrix_ha.HEALTH_FAILURE_THRESHOLD - 1)
+        self.assertEqual(self.check(), (True, 1))
+        self.assertEqual(self.health(), 'Unhealthy')
+        # The window is reset for the replacement
+        self.assertEqual(self.store.state['HEALTH_WINDOW'], '')
+
+    def test_threshold_sets_unhealthy(self):
+        self.assertEqual(self.check(), (True, aviatrix_ha.HEALTH_FAILURE_THRESHOLD))
+        self.assertEqual(self.health(), 'Unhealthy')
+
+    def test_consecutive_failures(self):
+        self.assertEqual(aviatrix_ha.consecutive_failures(''), 0)
+        self.assertEqual(aviatrix_ha.consecutive_failures('0010'), 1)
+        self.assertEqual(aviatrix_ha.consecutive_failures('1000'), 3)
+        self.assertEqual(aviatrix_ha.consecutive_failures('0001'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+""" HTTP client on the standard library for the controller API, the AMI catalog and the
+CloudFormation responses, so that the lambda zip does not need requests and its
+dependencies"""
+import http.client
+import json
+import select
+import ssl
+import threading
+import urllib.parse
+
+# Idle keep-alive connections kept per host
+POOL_SIZE = 4
+
+
+class TransportError(Exception):
+    """ A request that failed or was answered with an error status"""
+
+
+class ConnectionFailed(TransportError):
+    """ No response was received: connection refused, reset, timed out or closed by the
+    server. The message starts with "Failed to establish a new connection" when the
+    connection could not be opened, and keeps the one of the underlying error, such as
+    "Remote end closed connection without response" """
+
+
+class HttpStatusError(TransportError):
+    """ Response with a 4xx or 5xx status"""
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+class Response:
+    """ Status, headers and the whole body of a response"""
+
+    def __init__(self, status, reason, headers, content):
+        self.status_code = status
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        """ Body decoded as JSON. Raises ValueError when it is not"""
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        """ Raise HttpStatusError for 4xx and 5xx responses"""
+        if self.status_code >= 400:
+            raise HttpStatusError("HTTP %d %s" % (self.status_code, self.reason),
+                                  self.status_code)
+
+
+def _unverified_context():
+    """ The controller uses a self signed certificate"""
+    return ssl._create_unverified_context()  # pylint: disable=protected-access
+
+
+def _closed_by_peer(conn):
+    """ An idle connection with something to read has been closed by the server"""
+    if conn.sock is None:
+        return True
+    try:
+        return bool(select.select([conn.sock], [], [], 0)[0])
+    except (OSError, ValueError):
+        return True
+
+
+class HttpSession:
+    """ Keep-alive connections reused across requests, at most pool_size idle ones per host.
+    Can be shared by threads. timeout is in seconds for connecting and for every read,
+    None waits as long as the server takes"""
+
+    def __init__(self, verify=True, timeout=None, pool_size=POOL_SIZE):
+        self.context = ssl.create_default_context() if verify else _unverified_context()
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _connection(self, scheme, netloc):
+        """ Idle connection to netloc that is still open, or a new one"""
+        with self._lock:
+            idle = self._idle.get((scheme, netloc), [])
+            while idle:
+                conn = idle.pop()
+                if not _closed_by_peer(conn):
+                    conn.sock.settimeout(self.timeout)
+                    return conn
+                conn.close()
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout,
+                                               context=self.context)
+        if scheme == 'http':
+            return http.client.HTTPConnection(netloc, timeout=self.timeout)
+        raise TransportError("Unsupported URL scheme %s" % scheme)
+
+    def _release(self, scheme, netloc, conn):
+        with self._lock:
+            idle = self._idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.pool_size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, method, url, params=None, data=None, headers=None):
+        """ Send a request and read the whole response. params are added to the query
+        string, a dict of data is sent form encoded. Raises ConnectionFailed when no
+        response was received"""
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or '/'
+        query = parts.query
+        if params:
+            query = '&'.join(filter(None, [query, urllib.parse.urlencode(params)]))
+        if query:
+            path += '?' + query
+        headers = dict(headers or {})
+        if isinstance(data, dict):
+            data = urllib.parse.urlencode(data)
+            headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+        if isinstance(data, str):
+            data = data.encode()
+        conn = self._connection(parts.scheme, parts.netloc)
+        if conn.sock is None:
+            try:
+                conn.connect()
+            except OSError as err:
+                conn.close()
+                raise ConnectionFailed("Failed to establish a new connection to %s://%s: %s" % (
+                    parts.scheme, parts.netloc, str(err) or repr(err))) from err
+        try:
+            conn.request(method, path, body=data, headers=headers)
+            response = conn.getresponse()
+            content = response.read()
+        except (OSError, http.client.HTTPException) as err:
+            conn.close()
+            raise ConnectionFailed("%s %s://%s%s failed: %s" % (
+                method, parts.scheme, parts.netloc, parts.path, str(err) or repr(err))) from err
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(parts.scheme, parts.netloc, conn)
+        return Response(response.status, response.reason, response.headers, content)
+
+    def get(self, url, params=None, headers=None):
+        """ GET url"""
+        return self.request('GET', url, params=params, headers=headers)
+
+    def post(self, url, data=None, headers=None):
+        """ POST data to url"""
+        return self.request('POST', url, data=data, headers=headers)
+
+    def close(self):
+        """ Close the idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+def request(method, url, verify=True, timeout=None, **kwargs):
+    """ One request on a connection of its own"""
+    session = HttpSession(verify=verify, timeout=timeout, pool_size=0)
+    return session.request(method, url, **kwargs)